@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HH Pipeline 性能基准
+
+使用方法：
+    python benchmark.py parse --html-dir ./input_html [--repeat 5]
+    python benchmark.py gemini-client [--calls 1000]
+    python benchmark.py pipeline --html-dir ./input_html [--engine thread] [--latency lognormal:0.8,0.5] [--rate-429 0.05]
+    python benchmark.py tag-extractor --html-dir ./input_html [--sizes 0,100,1000]
+"""
+
+import argparse
+import json
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import pipeline
+from mock_ai_server import MockQwenServer, add_profile_arguments, profile_from_args, synthesize_result
+from pipeline import parse_html
+from tag_extractor import TagExtractor
+
+
+def _timeit(fn: Callable[[], object], repeat: int) -> float:
+    """返回 repeat 次运行的中位耗时（毫秒）"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+# ==================== parse ====================
+
+def bench_parse(html_dir: Path, repeat: int):
+    """对比 BeautifulSoup 路径与 lxml 单次解析快速通道（逐文件）"""
+    html_files = sorted(html_dir.glob("*.html"))
+    if not html_files:
+        print(f"❌ 未找到HTML文件: {html_dir}")
+        return
+
+    print(f"📁 {len(html_files)} 个HTML文件，每个文件重复 {repeat} 次取中位数\n")
+    print(f"{'文件':<20} {'大小':>8} {'bs4(ms)':>10} {'lxml(ms)':>10} {'加速比':>8}  一致")
+    print("-" * 70)
+
+    total_bs4 = total_lxml = 0.0
+    speedups: List[float] = []
+    mismatched = 0
+    for html_path in html_files:
+        bs4_ms = _timeit(lambda: parse_html(html_path, engine="bs4"), repeat)
+        lxml_ms = _timeit(lambda: parse_html(html_path, engine="lxml"), repeat)
+        same = parse_html(html_path, engine="bs4") == parse_html(html_path, engine="lxml")
+        if not same:
+            mismatched += 1
+        total_bs4 += bs4_ms
+        total_lxml += lxml_ms
+        speedup = bs4_ms / lxml_ms if lxml_ms else 0.0
+        speedups.append(speedup)
+        print(f"{html_path.name:<20} {html_path.stat().st_size:>8} {bs4_ms:>10.3f} {lxml_ms:>10.3f} {speedup:>7.2f}x  {'✅' if same else '❌'}")
+
+    print("-" * 70)
+    print(f"总耗时: bs4 {total_bs4:.1f} ms, lxml {total_lxml:.1f} ms, 整体加速 {total_bs4 / total_lxml:.2f}x")
+    print(f"逐文件加速比: 中位 {statistics.median(speedups):.2f}x, 最小 {min(speedups):.2f}x, 最大 {max(speedups):.2f}x")
+    print(f"输出不一致: {mismatched} 个")
+
+
+# ==================== gemini-client ====================
+
+def bench_gemini_client(calls: int):
+    """对比每次调用都 configure + 新建 GenerativeModel 与按线程缓存客户端的单次开销（不发送请求）"""
+    try:
+        import google.generativeai as genai
+    except ImportError:
+        print("❌ 需要安装 google-generativeai: pip install google-generativeai")
+        return
+    api_key = pipeline.GEMINI_API_KEY or "benchmark-key"
+    pipeline.GEMINI_API_KEY = api_key
+
+    def per_call_setup():
+        genai.configure(api_key=api_key)
+        return genai.GenerativeModel(pipeline.GEMINI_MODEL)
+
+    start = time.perf_counter()
+    pipeline.warm_up_gemini()
+    warm_up_ms = (time.perf_counter() - start) * 1000
+
+    samples = {"per_call": [], "cached": []}
+    for _ in range(calls):
+        for name, fn in (("per_call", per_call_setup), ("cached", pipeline.get_gemini_model)):
+            t0 = time.perf_counter()
+            fn()
+            samples[name].append((time.perf_counter() - t0) * 1e6)
+
+    print(f"🔁 {calls} 次调用（只计客户端准备，不含网络请求），预热耗时 {warm_up_ms:.1f} ms\n")
+    print(f"{'路径':<12} {'中位(µs)':>10} {'p95(µs)':>10} {'合计(ms)':>10}")
+    print("-" * 46)
+    for name, values in samples.items():
+        values.sort()
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print(f"{name:<12} {statistics.median(values):>10.2f} {p95:>10.2f} {sum(values) / 1000:>10.2f}")
+    cached = statistics.median(samples["cached"])
+    if cached:
+        print(f"\n单次开销减少 {statistics.median(samples['per_call']) / cached:.0f}x")
+
+
+# ==================== pipeline ====================
+
+def bench_pipeline(html_dir: Path, args: argparse.Namespace):
+    """用本地模拟 Qwen API 跑完整 Pipeline（不使用AI响应缓存），统计端到端吞吐；不需要真实的API Key"""
+    html_files = sorted(html_dir.glob("*.html"))
+    if not html_files:
+        print(f"❌ 未找到HTML文件: {html_dir}")
+        return
+
+    with MockQwenServer(profile_from_args(args)) as server, tempfile.TemporaryDirectory() as tmp:
+        pipeline.QWEN_API_URL = server.url
+        pipeline.QWEN_API_KEY = pipeline.AI_API_KEY = "mock"
+        pipeline.AI_TYPE = "qwen"
+        out_dir = Path(tmp) / "out"
+        start = time.perf_counter()
+        pipeline.run_pipeline(html_dir, out_dir, engine=args.engine, use_ai_cache=False, batch_size=args.batch_size,
+                              near_dup_distance=None, stream=args.stream)
+        elapsed = time.perf_counter() - start
+        ok = len(list((out_dir / "final").glob("*.json")))
+        bad = len(list((out_dir / "bad").glob("*.error.txt")))
+
+    print(f"\n{'='*50}")
+    print(f"🧪 模拟API: 延迟 {args.latency}，429 {args.rate_429:.0%}，超时 {args.timeout_rate:.0%}，"
+          f"格式错误 {args.malformed_rate:.0%}（seed={args.seed}）")
+    print(f"   {server.summary()}")
+    print(f"⏱️  {len(html_files)} 个文件，耗时 {elapsed:.2f} s，吞吐 {len(html_files) / elapsed:.2f} 文件/s"
+          f"（成功 {ok}，失败 {bad}）")
+
+
+# ==================== tag-extractor ====================
+
+def _legacy_matches(extractor: TagExtractor, title: str, text: str) -> tuple:
+    """预编译之前的实现：每次调用按优先级逐个关键词构建正则并搜索全文（公司别名、类别、招聘类型）"""
+    def search_each(keywords, target):
+        for keyword, value in keywords:
+            if re.search(r'\b' + re.escape(keyword.lower()) + r'\b', target, re.IGNORECASE):
+                return value
+        return None
+
+    dims = extractor.dimensions
+    combined = f"{title.lower()} {text}"
+    aliases = sorted(dims['company']['aliases'].items(), key=lambda x: len(x[0]), reverse=True)
+    company = search_each(aliases, combined)
+    if company is None:
+        company = search_each([(c, c) for c in dims['company']['predefined']], combined)
+    category = search_each([(k, c['value']) for c in dims['category']['values'] for k in c['keywords']], text)
+    recruit_type = search_each([(k, r['value']) for r in dims['recruitType']['values'] for k in r['keywords']], text)
+    return company, category, recruit_type
+
+
+def _compiled_matches(extractor: TagExtractor, title: str, text: str) -> tuple:
+    combined = f"{title.lower()} {text}"
+    matchers = extractor.matchers()
+    company = matchers['company_alias'].search(combined)
+    if company is None:
+        company = matchers['company_predefined'].search(combined)
+    return company, matchers['category'].search(text), matchers['recruitType'].search(text)
+
+
+def bench_tag_extractor(html_dir: Path, sizes: List[int], repeat: int):
+    """
+    对比逐个关键词搜索与预编译单次扫描匹配器（公司别名/预定义公司、类别、招聘类型）的单篇耗时
+
+    每个规模在配置中追加该数量的不会命中的合成公司别名和类别关键词，观察耗时随词典大小的变化；
+    另外统计Pipeline热路径 build_final_data 的单篇耗时：每篇新建 TagValidator/TagExtractor vs 进程内共用
+    """
+    html_files = sorted(html_dir.glob("*.html"))
+    if not html_files:
+        print(f"❌ 未找到HTML文件: {html_dir}")
+        return
+    posts = []
+    documents = []
+    for html_path in html_files:
+        raw_data = parse_html(html_path)
+        posts.append((raw_data["title"], f"{raw_data['title']} {raw_data['originalContentText']} ".lower()))
+        documents.append((raw_data, synthesize_result(raw_data["title"], raw_data["originalContentText"])))
+
+    def build_each(fresh_tools: bool):
+        for raw_data, processed in documents:
+            if fresh_tools:
+                pipeline._tag_tools = None  # 模拟每篇都重新加载配置、新建验证器与提取器
+            pipeline.build_final_data(raw_data, json.loads(json.dumps(processed)))
+
+    fresh_ms = _timeit(lambda: build_each(True), repeat) / len(documents)
+    shared_ms = _timeit(lambda: build_each(False), repeat) / len(documents)
+    print(f"📁 {len(posts)} 篇面经，每项重复 {repeat} 次取中位数\n")
+    print(f"build_final_data: 每篇新建 {fresh_ms:.3f} ms/篇，共用 {shared_ms:.3f} ms/篇"
+          f"（{fresh_ms / shared_ms:.1f}x）\n")
+
+    base_config = TagExtractor().config
+    rng = random.Random(0)
+    print(f"{'追加关键词':>10} {'别名数':>8} {'逐个(ms/篇)':>12} {'预编译(ms/篇)':>14} {'加速比':>8}  一致")
+    print("-" * 66)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            config = json.loads(json.dumps(base_config))
+            dims = config["dimensions"]
+            for n in range(size):
+                word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 12)))
+                dims["company"]["aliases"][f"{word}{n}"] = "Synthetic"
+                dims["category"]["values"][-1]["keywords"].append(f"{word}{n}")
+            config_path = Path(tmp) / f"tags_{size}.json"
+            config_path.write_text(json.dumps(config, ensure_ascii=False), encoding="utf-8")
+            extractor = TagExtractor(str(config_path))
+
+            legacy_ms = _timeit(lambda: [_legacy_matches(extractor, t, x) for t, x in posts], repeat) / len(posts)
+            compiled_ms = _timeit(lambda: [_compiled_matches(extractor, t, x) for t, x in posts], repeat) / len(posts)
+            same = all(_legacy_matches(extractor, t, x) == _compiled_matches(extractor, t, x) for t, x in posts)
+            speedup = legacy_ms / compiled_ms if compiled_ms else 0.0
+            print(f"{size:>10} {len(dims['company']['aliases']):>8} {legacy_ms:>12.3f} {compiled_ms:>14.3f} "
+                  f"{speedup:>7.1f}x  {'✅' if same else '❌'}")
+
+
+# ==================== 命令行入口 ====================
+
+def main():
+    parser = argparse.ArgumentParser(description="HH Pipeline 性能基准")
+    subparsers = parser.add_subparsers(dest="command", help="基准项")
+
+    parse_parser = subparsers.add_parser("parse", help="HTML解析：bs4 vs lxml 快速通道")
+    parse_parser.add_argument("--html-dir", default="./input_html", help="HTML文件目录（默认: ./input_html）")
+    parse_parser.add_argument("--repeat", type=int, default=5, help="每个文件重复次数（默认: 5）")
+
+    gemini_parser = subparsers.add_parser("gemini-client", help="Gemini客户端：每次新建 vs 按线程缓存")
+    gemini_parser.add_argument("--calls", type=int, default=1000, help="调用次数（默认: 1000）")
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="完整Pipeline吞吐（本地模拟Qwen API，离线）")
+    pipeline_parser.add_argument("--html-dir", default="./input_html", help="HTML文件目录（默认: ./input_html）")
+    pipeline_parser.add_argument("--engine", choices=["thread", "async"], default=pipeline.AI_ENGINE,
+                                 help=f"AI调用引擎（默认: {pipeline.AI_ENGINE}）")
+    pipeline_parser.add_argument("--batch-size", type=int, default=pipeline.AI_BATCH_SIZE,
+                                 help=f"每个AI请求最多合并的短面经篇数（默认: {pipeline.AI_BATCH_SIZE}）")
+    pipeline_parser.add_argument("--stream", action="store_true", help="使用SSE流式输出")
+    add_profile_arguments(pipeline_parser)
+
+    tag_parser = subparsers.add_parser("tag-extractor", help="标签提取：逐个关键词搜索 vs 预编译单次扫描")
+    tag_parser.add_argument("--html-dir", default="./input_html", help="HTML文件目录（默认: ./input_html）")
+    tag_parser.add_argument("--sizes", default="0,100,1000", help="追加的合成关键词数量，逗号分隔（默认: 0,100,1000）")
+    tag_parser.add_argument("--repeat", type=int, default=3, help="每个规模重复次数（默认: 3）")
+
+    args = parser.parse_args()
+
+    if args.command == "parse":
+        html_dir = Path(args.html_dir)
+        if not html_dir.exists():
+            print(f"❌ HTML目录不存在: {html_dir}")
+            sys.exit(1)
+        bench_parse(html_dir, args.repeat)
+    elif args.command == "gemini-client":
+        bench_gemini_client(args.calls)
+    elif args.command == "pipeline":
+        html_dir = Path(args.html_dir)
+        if not html_dir.exists():
+            print(f"❌ HTML目录不存在: {html_dir}")
+            sys.exit(1)
+        try:
+            profile_from_args(args)
+        except ValueError as e:
+            parser.error(str(e))
+        bench_pipeline(html_dir, args)
+    elif args.command == "tag-extractor":
+        html_dir = Path(args.html_dir)
+        if not html_dir.exists():
+            print(f"❌ HTML目录不存在: {html_dir}")
+            sys.exit(1)
+        bench_tag_extractor(html_dir, [int(s) for s in args.sizes.split(",") if s.strip()], args.repeat)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
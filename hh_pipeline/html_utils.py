@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTML解析快速通道 - 基于 lxml 的单次解析
+
+功能：
+1. 只构建一棵 lxml 树，同时取出标题、时间、正文HTML和正文文本
+2. 预编译 XPath 选择器（.jammer / .thread_subject / .post_time / .article_body）
+3. 输出与 BeautifulSoup 路径逐字节一致（属性排序、空白折叠、转义规则均按 bs4 复刻）
+
+遇到快速通道无法保证一致的结构（缺少正文节点、<meta>、处理指令等）时返回 None，
+由调用方回退到 BeautifulSoup。
+"""
+
+import re
+import threading
+from typing import Dict, List, Optional
+
+try:
+    from lxml import etree
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+# ==================== bs4 行为常量 ====================
+
+# bs4 HTMLTreeBuilder 的空元素（序列化为 <br/>）
+VOID_ELEMENTS = frozenset([
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen",
+    "link", "menuitem", "meta", "param", "source", "track", "wbr",
+    "basefont", "bgsound", "command", "frame", "image", "isindex",
+    "nextid", "spacer",
+])
+
+# 多值属性（bs4 会按空白拆分后用单个空格重新拼接）
+MULTI_VALUED_ATTRIBUTES = {
+    "*": frozenset(["class", "accesskey", "dropzone"]),
+    "a": frozenset(["rel", "rev"]),
+    "link": frozenset(["rel", "rev"]),
+    "td": frozenset(["headers"]),
+    "th": frozenset(["headers"]),
+    "form": frozenset(["accept-charset"]),
+    "object": frozenset(["archive"]),
+    "area": frozenset(["rel"]),
+    "icon": frozenset(["sizes"]),
+    "iframe": frozenset(["sandbox"]),
+    "output": frozenset(["for"]),
+}
+
+# 空白不折叠的标签
+PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+
+# libxml2 在树中把无值的布尔属性补成属性名（<input disabled> → disabled="disabled"），
+# 而 bs4 得到空字符串；两者在树上无法区分，遇到时交给 bs4
+LIBXML2_BOOLEAN_ATTRIBUTES = frozenset([
+    "checked", "compact", "declare", "defer", "disabled", "ismap", "multiple",
+    "nohref", "noresize", "noshade", "nowrap", "readonly", "selected",
+])
+
+# 内容原样输出、不做实体转义的标签
+CDATA_CONTAINING_TAGS = frozenset(["script", "style"])
+
+# get_text() 不会返回这些标签内的文本（bs4 的 Script/Stylesheet/TemplateString 等）
+NON_TEXT_CONTAINERS = frozenset(["script", "style", "template", "rt", "rp"])
+
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+_ESCAPE_RE = re.compile(r"[&<>]")
+_ESCAPE_MAP = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+
+
+class _Unsupported(Exception):
+    """快速通道无法保证与 bs4 输出一致"""
+
+
+# ==================== 预编译选择器 ====================
+
+_local = threading.local()
+
+if LXML_AVAILABLE:
+    _SELECTORS = {
+        name: etree.XPath(f"//*[contains(@class, '{name}')]")
+        for name in ("jammer", "thread_subject", "post_time", "article_body")
+    }
+
+
+def _get_parser():
+    """lxml 解析器不可跨线程并发使用，每个线程持有一个"""
+    parser = getattr(_local, "parser", None)
+    if parser is None:
+        parser = _local.parser = etree.HTMLParser(recover=True)
+    return parser
+
+
+def _has_class(el, name: str) -> bool:
+    """与 soupsieve 一致：class 按空白拆分后精确匹配"""
+    return name in (el.get("class") or "").split()
+
+
+def _select(root, name: str) -> List:
+    return [el for el in _SELECTORS[name](root) if _has_class(el, name)]
+
+
+# ==================== 序列化（复刻 bs4 minimal formatter）====================
+
+def _escape(text: str) -> str:
+    if "&" in text or "<" in text or ">" in text:
+        return _ESCAPE_RE.sub(lambda m: _ESCAPE_MAP[m.group(0)], text)
+    return text
+
+
+def _collapse(text: Optional[str], preserve: bool) -> str:
+    """bs4 endData：非 pre/textarea 内的纯ASCII空白字符串折叠为一个换行或空格"""
+    if not text:
+        return ""
+    if preserve or text.strip(ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def _quote_attr(value: str) -> str:
+    value = _escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', "&quot;") + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def _format_attrs(el) -> str:
+    if not len(el.attrib):
+        return ""
+    multi = MULTI_VALUED_ATTRIBUTES["*"] | MULTI_VALUED_ATTRIBUTES.get(el.tag, frozenset())
+    parts = []
+    for key, value in sorted(el.attrib.items()):
+        if value == key and key in LIBXML2_BOOLEAN_ATTRIBUTES:
+            raise _Unsupported(f"ambiguous boolean attribute: {key}")
+        if key in multi:
+            value = " ".join(value.split())
+        parts.append(f"{key}={_quote_attr(value)}")
+    return " " + " ".join(parts)
+
+
+class _BodyWriter:
+    """遍历正文子树，同时产出 bs4 风格的HTML与 get_text 所需的字符串片段"""
+
+    def __init__(self, jammers: set):
+        self.jammers = jammers
+        self.html: List[str] = []
+        self.texts: List[str] = []
+        self._pending: List[str] = []
+
+    def _boundary(self):
+        # 标签/注释会切断文本；被移除的 jammer 两侧的文本在重新解析时会合并成一个字符串
+        if self._pending:
+            self.texts.append("".join(self._pending))
+            self._pending = []
+
+    def _data(self, text: str, parent_tag: str, preserve: bool, hidden: bool):
+        text = _collapse(text, preserve)
+        if not text:
+            return
+        if parent_tag in CDATA_CONTAINING_TAGS:
+            self.html.append(text)
+        else:
+            self.html.append(_escape(text))
+        if not hidden:
+            self._pending.append(text)
+
+    def write(self, el, preserve: bool = False, hidden: bool = False):
+        tag = el.tag
+        if not isinstance(tag, str):
+            if tag is not etree.Comment:
+                raise _Unsupported(f"unsupported node: {tag!r}")
+            self._boundary()
+            self.html.append("<!--" + _collapse(el.text, preserve) + "-->")
+            return
+        if tag == "meta":
+            # bs4 会把 meta charset 替换为输出编码，交给 bs4 处理
+            raise _Unsupported("meta tag in body")
+
+        self._boundary()
+        preserve = preserve or tag in PRESERVE_WHITESPACE_TAGS
+        hidden = hidden or tag in NON_TEXT_CONTAINERS
+        attrs = _format_attrs(el)
+        if tag in VOID_ELEMENTS and not el.text and not len(el):
+            self.html.append(f"<{tag}{attrs}/>")
+            return
+        self.html.append(f"<{tag}{attrs}>")
+        if el.text:
+            self._data(el.text, tag, preserve, hidden)
+        for child in el:
+            if child not in self.jammers:
+                self.write(child, preserve, hidden)
+            if child.tail:
+                self._data(child.tail, tag, preserve, hidden)
+        self._boundary()
+        self.html.append(f"</{tag}>")
+
+    def finish(self):
+        self._boundary()
+
+
+def _node_text(el, jammers: set, separator: str) -> str:
+    """复刻 bs4 get_text(separator, strip=True)：jammer 两侧的字符串保持独立"""
+    strings: List[str] = []
+
+    def walk(node, hidden: bool):
+        if not isinstance(node.tag, str):
+            return
+        hidden = hidden or node.tag in NON_TEXT_CONTAINERS
+        if node.text and not hidden:
+            strings.append(node.text)
+        for child in node:
+            if child not in jammers:
+                walk(child, hidden)
+            if child.tail and not hidden:
+                strings.append(child.tail)
+
+    hidden = any(a.tag in NON_TEXT_CONTAINERS for a in el.iterancestors())
+    walk(el, hidden)
+    return separator.join(s.strip() for s in strings if s.strip())
+
+
+def parse_html_fast(raw_html: str) -> Optional[Dict[str, str]]:
+    """
+    单次 lxml 解析，返回 title / publishTimeRaw / originalContentHtml / originalContentText
+
+    Returns:
+        解析结果；快速通道不适用时返回 None（调用方应回退到 BeautifulSoup）
+    """
+    if not LXML_AVAILABLE:
+        return None
+
+    try:
+        root = etree.fromstring(raw_html, _get_parser())
+    except (etree.ParserError, ValueError):
+        return None
+    if root is None:
+        return None
+
+    jammers = set(_select(root, "jammer"))
+
+    def first(name: str):
+        for el in _select(root, name):
+            # 位于 jammer 内部的节点在 bs4 中已被删除，交给 bs4 处理
+            if el in jammers or any(a in jammers for a in el.iterancestors()):
+                raise _Unsupported(f".{name} inside .jammer")
+            return el
+        return None
+
+    try:
+        title_node = first("thread_subject")
+        body_node = first("article_body")
+        if title_node is None or body_node is None:
+            return None
+        time_node = first("post_time")
+
+        writer = _BodyWriter(jammers)
+        preserve = any(a.tag in PRESERVE_WHITESPACE_TAGS for a in body_node.iterancestors())
+        hidden = any(a.tag in NON_TEXT_CONTAINERS for a in body_node.iterancestors())
+        writer.write(body_node, preserve, hidden)
+        writer.finish()
+    except _Unsupported:
+        return None
+
+    return {
+        "title": _node_text(title_node, jammers, " "),
+        "publishTimeRaw": _node_text(time_node, jammers, " ") if time_node is not None else "",
+        "originalContentHtml": "".join(writer.html),
+        "originalContentText": "\n".join(s.strip() for s in writer.texts if s.strip()),
+    }
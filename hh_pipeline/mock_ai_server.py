@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Qwen API 本地模拟服务器（离线压测用）
+
+模拟 DashScope 文本生成接口（result_format=message，请求带 X-DashScope-SSE 头时按SSE增量输出），
+按提示词生成符合输出规范的合成面经（单篇与批量提示词都支持），并可注入延迟分布、429、超时和格式错误的JSON。
+同一个 --seed 下注入的故障序列可重复，用于对比并发/重试相关改动前后的吞吐。
+
+使用方法：
+    python mock_ai_server.py --port 8765 --latency lognormal:0.8,0.5 --rate-429 0.05 --timeout-rate 0.01 --malformed-rate 0.02
+
+    # 另一个终端：把 Pipeline 指向模拟服务器（Key 可以是任意值）
+    export QWEN_API_KEY=mock
+    export QWEN_API_URL=http://127.0.0.1:8765/generation
+    python pipeline.py run --html-dir ./input_html --out-dir ./out_mock --no-ai-cache
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from pipeline import API_TIMEOUT, estimate_tokens
+
+# ==================== 延迟分布 ====================
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    解析延迟分布（秒），返回 rng → 延迟 的采样函数
+
+    支持：fixed:0.5 / uniform:0.2,1.5 / lognormal:中位数,sigma（长尾，最接近真实模型的生成耗时）
+    """
+    kind, _, params = spec.partition(":")
+    try:
+        values = [float(v) for v in params.split(",")] if params else []
+    except ValueError:
+        raise ValueError(f"无效的延迟分布参数: {spec}")
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        low, high = values
+        return lambda rng: rng.uniform(low, high)
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        if median <= 0:
+            return lambda rng: 0.0
+        mu = math.log(median)
+        return lambda rng: rng.lognormvariate(mu, sigma)
+    raise ValueError(f"无效的延迟分布: {spec}（支持 fixed:秒 / uniform:最小,最大 / lognormal:中位数,sigma）")
+
+# ==================== 合成输出 ====================
+
+_TITLE_RE = re.compile(r"原始标题（可能很糙）：\n(.*)")
+_BATCH_SECTION_RE = re.compile(r"^=== 面经 (\d+) ===$", re.M)
+_COMPANIES = ["Google", "Meta", "Amazon", "Microsoft", "Apple", "Netflix", "Uber", "Airbnb", "TikTok", "LinkedIn"]
+_ROLES = ["Software Engineer", "Data Scientist", "Machine Learning Engineer", "Product Manager"]
+_TECHNOLOGIES = ["Python", "Java", "C++", "Go", "React", "SQL", "Kubernetes"]
+_RECRUIT_TYPES = ["intern", "newgrad", "experienced"]
+
+# 以合法JSON开头、随后字段类型错误且不闭合：流式输出会被 StreamingJSONGuard 提前中止，非流式解析失败
+MALFORMED_OUTPUT = '{"title": "模拟面经", "company": "Google", "difficulty": ["难", "'
+
+def synthesize_result(title: str, content: str = "") -> Dict[str, Any]:
+    """
+    为一篇面经生成符合输出规范的合成结果（同样的标题与正文总是得到同样的结果）
+
+    原文出现已知公司名时使用该公司，否则按内容哈希选择；正文是固定骨架的 Markdown，能通过结构化质量检查。
+    """
+    seed = int.from_bytes(hashlib.blake2b(f"{title}\n{content}".encode("utf-8"), digest_size=8).digest(), "big")
+    rng = random.Random(seed)
+    text = f"{title}\n{content}".lower()
+    company = next((c for c in _COMPANIES if c.lower() in text), rng.choice(_COMPANIES))
+    role = rng.choice(_ROLES)
+    rounds = rng.randint(2, 4)
+    body = "\n\n".join([
+        f"## 基本信息\n\n公司：{company}\n\n岗位：{role}\n\n结果：未提及",
+        "## 面试过程\n\n" + "\n".join(f"- 第{i}轮：算法题与项目讨论。" for i in range(1, rounds + 1)),
+        "## 题目总结\n\n- 数组与哈希表\n- 系统设计基础",
+        "## 个人总结\n\n准备充分的话难度中等，建议多练习口头表达。",
+    ])
+    technologies = rng.sample(_TECHNOLOGIES, 2)
+    return {
+        "title": f"{company} {role} 面经（{title.strip()[:20] or '模拟'}）",
+        "processedContent": body,
+        "company": company,
+        "role": role,
+        "difficulty": rng.randint(1, 5),
+        "tags": [company, role, "面经"] + technologies,
+        "tagDimensions": {
+            "technologies": technologies, "recruitType": rng.choice(_RECRUIT_TYPES), "location": "",
+            "category": "SWE", "experience": "", "salary": "", "custom": [],
+        },
+    }
+
+def synthesize_response(prompt: str) -> Dict[str, Any]:
+    """按提示词生成模型输出：批量提示词返回 {"results": [...]}（带 id），单篇提示词返回一个结果"""
+    sections = list(_BATCH_SECTION_RE.finditer(prompt))
+    if not sections:
+        match = _TITLE_RE.search(prompt)
+        return synthesize_result(match.group(1) if match else "", prompt)
+    results = []
+    for n, section in enumerate(sections):
+        end = sections[n + 1].start() if n + 1 < len(sections) else len(prompt)
+        text = prompt[section.end():end]
+        match = _TITLE_RE.search(text)
+        results.append({"id": section.group(1), **synthesize_result(match.group(1) if match else "", text)})
+    return {"results": results}
+
+# ==================== 模拟服务器 ====================
+
+class MockProfile:
+    """注入的故障与延迟：每个请求按比例抽取一种结果（429 / 超时 / 格式错误 / 正常），正常与格式错误的响应按延迟分布等待"""
+
+    def __init__(self, latency: str = "fixed:0", rate_429: float = 0.0, timeout_rate: float = 0.0,
+                 malformed_rate: float = 0.0, hang_seconds: float = API_TIMEOUT + 5,
+                 retry_after: Optional[float] = None, seed: int = 0):
+        if rate_429 + timeout_rate + malformed_rate > 1:
+            raise ValueError("429、超时与格式错误的比例之和不能超过1")
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.timeout_rate = timeout_rate
+        self.malformed_rate = malformed_rate
+        self.hang_seconds = hang_seconds
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self) -> Tuple[str, float]:
+        """抽取一个请求的结果类型（ok / 429 / timeout / malformed）与延迟"""
+        with self._lock:
+            r = self._rng.random()
+            delay = max(0.0, self.latency(self._rng))
+        if r < self.rate_429:
+            return "429", 0.0
+        r -= self.rate_429
+        if r < self.timeout_rate:
+            return "timeout", self.hang_seconds
+        r -= self.timeout_rate
+        return ("malformed" if r < self.malformed_rate else "ok"), delay
+
+class MockQwenServer:
+    """
+    本地 Qwen 生成接口（ThreadingHTTPServer，每个请求一个线程）
+
+    counts 记录各类结果的请求数；超时请求挂起 hang_seconds 后不返回响应直接断开，关闭服务器时立即释放。
+    可作为上下文管理器在进程内使用（端口为0时自动选择空闲端口，见 url）。
+    """
+
+    FIRST_TOKEN_SHARE = 0.3  # 流式输出时首个分块前等待的延迟比例，其余延迟平均分摊到后续分块
+    SSE_CHUNK_CHARS = 16
+
+    def __init__(self, profile: Optional[MockProfile] = None, host: str = "127.0.0.1", port: int = 0):
+        self.profile = profile or MockProfile()
+        self.counts = {"requests": 0, "ok": 0, "429": 0, "timeout": 0, "malformed": 0}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 支持keep-alive
+
+            def do_POST(self):
+                server._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.httpd.server_address[1]}/generation"
+        self._thread: Optional[threading.Thread] = None
+
+    def _handle(self, handler: BaseHTTPRequestHandler):
+        request = json.loads(handler.rfile.read(int(handler.headers.get("Content-Length", 0))) or b"{}")
+        messages = request.get("input", {}).get("messages") or [{}]
+        prompt = messages[-1].get("content", "")
+        outcome, delay = self.profile.draw()
+        with self._lock:
+            self.counts["requests"] += 1
+            self.counts[outcome] += 1
+
+        if outcome == "429":
+            headers = {"Retry-After": f"{self.profile.retry_after:g}"} if self.profile.retry_after is not None else {}
+            self._send_json(handler, 429, {"code": "Throttling.RateQuota", "message": "Requests rate limit exceeded"}, headers)
+            return
+        if outcome == "timeout":
+            self._stopping.wait(delay)
+            handler.close_connection = True
+            return
+
+        content = MALFORMED_OUTPUT if outcome == "malformed" else \
+            "```json\n" + json.dumps(synthesize_response(prompt), ensure_ascii=False) + "\n```"
+        usage = {"input_tokens": estimate_tokens(prompt), "output_tokens": estimate_tokens(content)}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        if handler.headers.get("X-DashScope-SSE") == "enable":
+            self._send_sse(handler, content, usage, delay)
+        else:
+            self._stopping.wait(delay)
+            self._send_json(handler, 200, {"output": {"choices": [{"message": {"role": "assistant", "content": content}}]},
+                                           "usage": usage})
+
+    @staticmethod
+    def _send_json(handler: BaseHTTPRequestHandler, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _send_sse(self, handler: BaseHTTPRequestHandler, content: str, usage: Dict[str, int], delay: float):
+        """按 DashScope 增量输出格式逐块发送（chunked），首块前等待 FIRST_TOKEN_SHARE×延迟"""
+        chunks = [content[i:i + self.SSE_CHUNK_CHARS] for i in range(0, len(content), self.SSE_CHUNK_CHARS)]
+        self._stopping.wait(delay * self.FIRST_TOKEN_SHARE)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        step = delay * (1 - self.FIRST_TOKEN_SHARE) / max(len(chunks), 1)
+        try:
+            for n, chunk in enumerate(chunks, 1):
+                if n > 1:
+                    self._stopping.wait(step)
+                body = {"output": {"choices": [{"message": {"role": "assistant", "content": chunk}}]}}
+                if n == len(chunks):
+                    body["usage"] = usage
+                event = f"id:{n}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(body, ensure_ascii=False)}\n\n".encode("utf-8")
+                handler.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            handler.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            handler.close_connection = True  # 客户端提前中止（格式错误检测）
+
+    def serve_forever(self):
+        """在当前线程运行，直到 Ctrl+C"""
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopping.set()
+            self.httpd.server_close()
+
+    def start(self) -> "MockQwenServer":
+        """在后台线程运行"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "MockQwenServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def summary(self) -> str:
+        c = self.counts
+        return (f"请求 {c['requests']} 次：正常 {c['ok']}，429 {c['429']}，超时 {c['timeout']}，格式错误 {c['malformed']}")
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """模拟服务器的故障注入参数（本模块与 benchmark.py 共用）"""
+    parser.add_argument("--latency", default="lognormal:0.8,0.5",
+                        help="响应延迟分布：fixed:秒 / uniform:最小,最大 / lognormal:中位数,sigma（默认: lognormal:0.8,0.5）")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回429的请求比例（默认: 0）")
+    parser.add_argument("--retry-after", type=float, default=None, help="429响应携带的 Retry-After 秒数（默认: 不携带）")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="挂起不响应的请求比例（默认: 0）")
+    parser.add_argument("--hang-seconds", type=float, default=API_TIMEOUT + 5,
+                        help=f"超时请求挂起的秒数（默认: API_TIMEOUT+5 = {API_TIMEOUT + 5}）")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="返回格式错误JSON的请求比例（默认: 0）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子，相同种子得到相同的故障序列（默认: 0）")
+
+def profile_from_args(args: argparse.Namespace) -> MockProfile:
+    return MockProfile(latency=args.latency, rate_429=args.rate_429, timeout_rate=args.timeout_rate,
+                       malformed_rate=args.malformed_rate, hang_seconds=args.hang_seconds,
+                       retry_after=args.retry_after, seed=args.seed)
+
+# ==================== 命令行入口 ====================
+
+def main():
+    parser = argparse.ArgumentParser(description="Qwen API 本地模拟服务器（离线压测用）")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认: 127.0.0.1）")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口（默认: 8765）")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        server = MockQwenServer(profile_from_args(args), args.host, args.port)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"🧪 模拟 Qwen API: {server.url}")
+    print(f"   export QWEN_API_KEY=mock QWEN_API_URL={server.url}")
+    server.serve_forever()
+    print(f"\n📊 {server.summary()}")
+
+
+if __name__ == "__main__":
+    main()
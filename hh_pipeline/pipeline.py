@@ -4,30 +4,45 @@
 HH Pipeline - 统一的HTML面经处理流程
 
 功能：
-1. 解析HTML文件为raw JSON
+1. 解析HTML文件为raw JSON（按内容hash保存在 out/raw，重跑时不再解析）
 2. 通过AI清洗为final JSON（必须有AI API）
 3. 使用TagExtractor规范化标签值
 4. 幂等去重：基于内容hash，已处理的文件自动跳过
 
 使用方法：
     python pipeline.py run --html-dir ./input_html --out-dir ./out
+    python pipeline.py renormalize --out-dir ./out
+    python pipeline.py stats --out-dir ./out
+    python pipeline.py migrate-hash --html-dir ./input_html --out-dir ./out --to blake2b
 """
 
 import argparse
+import asyncio
+import contextvars
+import gzip
 import hashlib
 import json
+import mmap
+import multiprocessing
 import os
+import queue
+import random
 import re
 import sqlite3
 import sys
+import threading
 import time
 from pathlib import Path
-from typing import Dict, Any, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Tuple
+from contextlib import asynccontextmanager, contextmanager
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from threading import Lock
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 尝试导入 TagExtractor（如果存在）
 try:
@@ -37,6 +52,16 @@ except ImportError:
     TAG_EXTRACTOR_AVAILABLE = False
     print("⚠️  Warning: TagExtractor not found. Tag normalization will be skipped.")
 
+# asyncio AI引擎（可选，--engine async 时需要）
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+# HTML解析快速通道（lxml单次解析，不可用时回退到BeautifulSoup）
+from html_utils import parse_html_fast
+
 # 导入标签验证器（必需）
 try:
     from validators import TagValidator
@@ -54,14 +79,666 @@ GEMINI_API_KEY = os.environ.get("API_KEY") or os.environ.get("GEMINI_API_KEY")
 AI_API_KEY = QWEN_API_KEY or GEMINI_API_KEY
 AI_TYPE = "qwen" if QWEN_API_KEY else ("gemini" if GEMINI_API_KEY else None)
 
-QWEN_API_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+QWEN_API_URL = os.environ.get("QWEN_API_URL", "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation")  # 可指向本地模拟服务器 mock_ai_server.py
+QWEN_MODEL = "qwen-plus"
 GEMINI_MODEL = "gemini-1.5-flash"
 
-CONCURRENCY = int(os.environ.get("CONCURRENCY", "10"))  # 默认并发数从3增加到10
+CONCURRENCY = int(os.environ.get("CONCURRENCY", "10"))  # 默认并发数从3增加到10（AI并发的初始值，运行中自适应调整）
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", str(CONCURRENCY * 4)))  # 自适应并发的上限
+AI_MIN_CONCURRENCY = int(os.environ.get("AI_MIN_CONCURRENCY", "1"))  # 自适应并发的下限
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "3"))
 API_TIMEOUT = int(os.environ.get("API_TIMEOUT", "30"))  # AI API超时时间（秒）
+AI_RPM = int(os.environ.get("AI_RPM", "0"))  # 每分钟最多请求数（0 表示不限制）
+AI_TPM = int(os.environ.get("AI_TPM", "0"))  # 每分钟最多token数（0 表示不限制）
+AI_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("AI_EXPECTED_OUTPUT_TOKENS", "1500"))  # 预约token时为输出预留的数量
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "1"))  # 重试退避的最小等待（秒）
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "20"))  # 重试退避的最大等待（秒）
+AI_CACHE_MAX_MB = float(os.environ.get("AI_CACHE_MAX_MB", "512"))  # AI响应缓存大小上限（MB）
+AI_CACHE_MAX_AGE_DAYS = float(os.environ.get("AI_CACHE_MAX_AGE_DAYS", "30"))  # AI响应缓存保留天数
+AI_LATENCY_TARGET = float(os.environ.get("AI_LATENCY_TARGET", str(API_TIMEOUT / 2)))  # 单次请求超过该延迟（秒）时不再提高并发
+AI_PROVIDERS = [p.strip() for p in os.environ.get("AI_PROVIDERS", "").split(",") if p.strip()]  # 同时使用的服务商，如 "qwen,gemini"（空表示只用 AI_TYPE）
+AI_HEDGE_QUANTILE = float(os.environ.get("AI_HEDGE_QUANTILE", "0.95"))  # 请求超过该分位延迟仍未返回时，向另一服务商发送对冲请求
+AI_HEDGE_MIN_SAMPLES = int(os.environ.get("AI_HEDGE_MIN_SAMPLES", "20"))  # 服务商积累这么多成功样本后才启用对冲
+QWEN_STREAM = os.environ.get("QWEN_STREAM", "0") == "1"  # Qwen流式输出（SSE），边接收边检查JSON
+CIRCUIT_FAILURE_RATE = float(os.environ.get("CIRCUIT_FAILURE_RATE", "0.5"))  # 最近请求中连接失败/超时/5xx/429占比达到该值时熔断（0 表示关闭）
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", "10"))  # 至少有这么多样本才判断失败率
+CIRCUIT_WINDOW = int(os.environ.get("CIRCUIT_WINDOW", "20"))  # 计算失败率的最近请求数
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", "10"))  # 熔断后等待多少秒发送探测请求
+CIRCUIT_MAX_WAIT = float(os.environ.get("CIRCUIT_MAX_WAIT", "60"))  # 故障持续超过该秒数后不再等待，剩余文件快速失败（不标记bad）
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(os.cpu_count() or 1)))  # CPU阶段（解析）进程数
+PREPARED_QUEUE_SIZE = int(os.environ.get("PREPARED_QUEUE_SIZE", str(CONCURRENCY * 2)))  # 解析结果→AI阶段的队列上限
+HTML_PARSER = os.environ.get("HTML_PARSER", "lxml")  # HTML解析引擎：lxml（快速通道）或 bs4
+HASH_ALGO = os.environ.get("HASH_ALGO", "sha256")  # 内容hash算法：sha256（默认）或 blake2b（更快）
+STATE_BATCH_SIZE = int(os.environ.get("STATE_BATCH_SIZE", "200"))  # 状态写入每批最多条数
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "0.5"))  # 状态写入最长间隔（秒）
+NEAR_DUP_MAX_DISTANCE = int(os.environ.get("NEAR_DUP_MAX_DISTANCE", "6"))  # 近似去重的默认阈值：SimHash汉明距离不超过该值视为近似重复（64位）
+NEAR_DUP_MIN_CHARS = int(os.environ.get("NEAR_DUP_MIN_CHARS", "100"))  # 规范化后正文短于该长度时不做近似去重
+AI_ENGINE = os.environ.get("AI_ENGINE", "thread")  # AI阶段引擎：thread（线程池）或 async（asyncio，仅Qwen）
+ASYNC_CONCURRENCY = int(os.environ.get("ASYNC_CONCURRENCY", "200"))  # async引擎的最大并发请求数
+AI_BATCH_SIZE = int(os.environ.get("AI_BATCH_SIZE", "1"))  # 每个AI请求最多合并的短面经篇数（1 表示不合并）
+AI_BATCH_MAX_TOKENS = int(os.environ.get("AI_BATCH_MAX_TOKENS", "800"))  # 正文压缩后不超过该token数的面经才参与合并
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))  # 提示词中原始正文的token上限（0 表示不截断）
+PROMPT_TOKEN_BUDGETS = {  # 按模型覆盖正文上限，格式："qwen-plus=3000,gemini-1.5-flash=6000"
+    model.strip(): int(budget)
+    for model, _, budget in (pair.partition("=") for pair in os.environ.get("PROMPT_TOKEN_BUDGETS", "").split(","))
+    if budget.strip()
+}
+
+# ==================== HTTP会话（连接复用）====================
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = Lock()
+
+def get_http_session() -> requests.Session:
+    """
+    进程内共享的 requests.Session（懒加载，线程安全）
+    
+    连接池大小与 AI_MAX_CONCURRENCY 一致，每个AI线程都能复用一条keep-alive连接，不再每次请求重新做TCP+TLS握手。
+    适配器层只重试连接失败（请求尚未发出，不会重复计费）；429、502/503/504 与超时由 call_with_retries 重试，
+    计入尝试次数、ai_calls、自适应并发与熔断统计。
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                retry = Retry(
+                    total=MAX_RETRIES,
+                    connect=MAX_RETRIES,
+                    read=0,
+                    status=0,
+                    other=0,
+                    backoff_factor=0.5,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(AI_MAX_CONCURRENCY, 1), max_retries=retry)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+# ==================== AI并发控制（AIMD）====================
+
+class _CallOutcome:
+    """一次AI请求的结果分类：ok / overload（429、超时）/ error"""
+    
+    def __init__(self):
+        self.outcome = "ok"
+    
+    def overloaded(self):
+        self.outcome = "overload"
+    
+    def unavailable(self):
+        self.outcome = "error"  # 502/503/504：不算成功也不减半，由熔断器按故障率处理
+    
+    def fail(self, e: BaseException):
+        if isinstance(e, MalformedStreamError):
+            self.outcome = "error"  # 模型输出有问题，与服务端负载无关
+        elif isinstance(e, ServerUnavailableError):
+            self.unavailable()
+        elif self.outcome != "overload":
+            is_timeout = isinstance(e, (requests.Timeout, asyncio.TimeoutError, TimeoutError))
+            self.outcome = "overload" if is_timeout or _is_retryable(e) else "error"
+
+def _resolve_waiter(future: "asyncio.Future"):
+    if not future.done():
+        future.set_result(None)
+
+class AdaptiveConcurrency:
+    """
+    AIMD 自适应并发控制（所有AI请求共用一个实例）
+    
+    - 请求成功且延迟不超过 latency_target：上限加性增长（每完成约 limit 个请求 +1）
+    - 429 / 超时：上限乘性减半；同一轮（上次减半之前发出的请求）只减一次，避免一次拥塞连续减半
+    - 其他错误、延迟过高：上限保持不变
+    
+    线程在条件变量上等待；协程按先来后到排队，名额空出时由释放方通过 call_soon_threadsafe 唤醒，不轮询。
+    
+    用法：
+        with ai_concurrency.call() as call:
+            response = session.post(...)
+            if response.status_code == 429:
+                call.overloaded()
+    """
+    
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: Optional[int] = None,
+                 latency_target: float = AI_LATENCY_TARGET):
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._async_waiters: "deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]" = deque()
+        self.configure(initial, min_limit, max_limit)
+    
+    def configure(self, initial: int, min_limit: int = 1, max_limit: Optional[int] = None):
+        """重置上下限与当前上限（每次运行开始时调用）"""
+        with self._cond:
+            self.min_limit = max(1, min_limit)
+            self.max_limit = max(self.min_limit, max_limit or initial)
+            self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+            self._last_decrease = 0.0
+            self.overloads = 0
+            self._wake_async_waiters()
+            self._cond.notify_all()
+    
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+    
+    def _wake_async_waiters(self):
+        """持有锁时调用：按排队顺序把空出的名额交给等待中的协程（名额在这里占用，协程醒来后直接使用）"""
+        while self._async_waiters and self.in_flight < self.limit:
+            loop, future = self._async_waiters.popleft()
+            if loop.is_closed():
+                continue
+            self.in_flight += 1
+            loop.call_soon_threadsafe(_resolve_waiter, future)
+    
+    def acquire(self) -> float:
+        """阻塞直到在途请求数低于上限，返回开始时间"""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+    
+    def try_acquire(self) -> Optional[float]:
+        with self._cond:
+            if self._async_waiters or self.in_flight >= self.limit:
+                return None
+            self.in_flight += 1
+            return time.monotonic()
+    
+    async def acquire_async(self) -> float:
+        """acquire 的 asyncio 版本：没有名额时排队等待唤醒（先来先得），被取消时归还已分到的名额"""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if not self._async_waiters and self.in_flight < self.limit:
+                self.in_flight += 1
+                return time.monotonic()
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._async_waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._cond:
+                try:
+                    self._async_waiters.remove(waiter)
+                except ValueError:
+                    # 名额已经分给了这个协程：交给下一个等待者
+                    self.in_flight -= 1
+                    self._wake_async_waiters()
+                    self._cond.notify_all()
+            raise
+        return time.monotonic()
+    
+    def release(self, started: float, outcome: str):
+        latency = time.monotonic() - started
+        with self._cond:
+            self.in_flight -= 1
+            if outcome == "overload":
+                self.overloads += 1
+                if started >= self._last_decrease:
+                    self._limit = max(float(self.min_limit), self._limit / 2)
+                    self._last_decrease = time.monotonic()
+            elif outcome == "ok" and latency <= self.latency_target:
+                self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+            self._wake_async_waiters()
+            self._cond.notify_all()
+    
+    @contextmanager
+    def call(self):
+        outcome = _CallOutcome()
+        started = self.acquire()
+        try:
+            yield outcome
+        except BaseException as e:
+            outcome.fail(e)
+            raise
+        finally:
+            self.release(started, outcome.outcome)
+    
+    @asynccontextmanager
+    async def call_async(self):
+        outcome = _CallOutcome()
+        started = await self.acquire_async()
+        try:
+            yield outcome
+        except BaseException as e:
+            outcome.fail(e)
+            raise
+        finally:
+            self.release(started, outcome.outcome)
+
+ai_concurrency = AdaptiveConcurrency(CONCURRENCY, AI_MIN_CONCURRENCY, AI_MAX_CONCURRENCY)
+
+# ==================== AI限流与重试 ====================
+
+_CJK_RE = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符约1个token，其他字符约4个一个token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def estimate_request_tokens(prompt: str) -> int:
+    """一次请求预计消耗的token数（输入 + 为输出预留的部分）"""
+    return estimate_tokens(prompt) + AI_EXPECTED_OUTPUT_TOKENS
+
+class RateLimiter:
+    """
+    进程内共享的令牌桶限流：每分钟请求数（rpm）与token数（tpm）两个桶，0 表示不限制
+    
+    采用预约方式：每次调用立即扣减额度（允许余额为负），返回需要等待的时间。
+    等待的调用按顺序依次错开，不会在同一时刻一起醒来形成突发。
+    服务端返回 Retry-After 时 pause() 让所有调用一起暂停。
+    """
+    
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self._lock = Lock()
+        self.configure(rpm, tpm)
+    
+    def configure(self, rpm: int, tpm: int):
+        with self._lock:
+            self.rpm = rpm
+            self.tpm = tpm
+            self._requests = float(rpm)
+            self._tokens = float(tpm)
+            self._updated = time.monotonic()
+            self._paused_until = 0.0
+    
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+    
+    def reserve(self, tokens: int = 0) -> Tuple[float, int]:
+        """预约一次请求，返回 (需要等待的秒数, 实际预约的token数)"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self._paused_until - now)
+            if self.rpm:
+                self._requests -= 1
+                if self._requests < 0:
+                    wait = max(wait, -self._requests * 60 / self.rpm)
+            if self.tpm and tokens:
+                tokens = min(tokens, self.tpm)  # 单个请求超过整桶时按整桶计，避免永远等待
+                self._tokens -= tokens
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens * 60 / self.tpm)
+            return wait, tokens
+    
+    def acquire(self, tokens: int = 0) -> int:
+        """阻塞直到额度可用，返回预约的token数（用于 settle）"""
+        wait, reserved = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return reserved
+    
+    async def acquire_async(self, tokens: int = 0) -> int:
+        wait, reserved = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return reserved
+    
+    def settle(self, reserved: int, actual: Optional[int]):
+        """按响应中的实际用量修正token桶（多退少补）"""
+        if not self.tpm or not actual:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(float(self.tpm), self._tokens + reserved - actual)
+    
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+ai_rate_limiter = RateLimiter(AI_RPM, AI_TPM)
+
+class RateLimitedError(Exception):
+    """服务端限流（429）；retry_after 为服务端建议的等待秒数"""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ServerUnavailableError(Exception):
+    """服务端暂时不可用（SERVER_RETRY_STATUSES）；retry_after 为服务端建议的等待秒数"""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+SERVER_RETRY_STATUSES = (502, 503, 504)  # 网关/服务暂时不可用：与429一样退避后重试
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头（秒数或HTTP日期）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class MalformedStreamError(Exception):
+    """流式输出明显不是预期的JSON（格式错误、未知字段或字段类型不符），提前中止并重新生成"""
+
+class CircuitOpenError(Exception):
+    """服务商熔断中且故障已持续超过 CIRCUIT_MAX_WAIT：不发送请求直接失败，文件不标记为bad，下次运行重试"""
 
-# ==================== AI处理 ====================
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, CircuitOpenError):
+        return False
+    if isinstance(e, (RateLimitedError, ServerUnavailableError, MalformedStreamError, requests.Timeout, TimeoutError)):
+        return True
+    if isinstance(e, ValueError):
+        return False  # 响应内容解析失败，重试无意义
+    return any(k in str(e).lower() for k in ['429', 'rate', 'timeout'])
+
+def next_backoff(previous: float) -> float:
+    """decorrelated jitter 退避：在 [base, 上次等待×3] 中随机取值，各线程的重试时间自然错开"""
+    return min(RETRY_MAX_DELAY, random.uniform(RETRY_BASE_DELAY, max(RETRY_BASE_DELAY, previous * 3)))
+
+def _retry_delay(e: Exception, previous: float) -> float:
+    if isinstance(e, MalformedStreamError):
+        return 0.0  # 不是限流，立即重新生成
+    delay = next_backoff(previous)
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after:
+        ai_rate_limiter.pause(retry_after)  # 服务端给出等待时间时，所有调用一起暂停
+        delay = max(delay, retry_after)
+    return delay
+
+def _exhausted(e: Exception, retries: int) -> Exception:
+    if isinstance(e, RateLimitedError):
+        return Exception(f"Rate limited after {retries} retries")
+    return e
+
+# ==================== AI熔断器 ====================
+
+class CircuitBreaker:
+    """
+    单个AI服务商的熔断器：closed → open → half-open → closed
+    
+    closed：记录最近 window 次请求的结果，网络连接失败、超时与5xx/429响应算失败（本地错误与输出格式错误不算），
+    样本不少于 min_calls 且失败率达到 failure_rate 时打开。
+    open：不再发出新请求，调用方等待 cooldown 秒后进入 half-open；本次故障已持续超过 max_wait 时不再等待，
+    直接抛出 CircuitOpenError（快速失败），避免每个文件都耗尽 MAX_RETRIES × API_TIMEOUT。
+    half-open：只放行一个探测请求，成功则恢复 closed 并唤醒所有等待的调用，失败则重新 open。
+    """
+    
+    def __init__(self, name: str, failure_rate: float = CIRCUIT_FAILURE_RATE, min_calls: int = CIRCUIT_MIN_CALLS,
+                 window: int = CIRCUIT_WINDOW, cooldown: float = CIRCUIT_COOLDOWN, max_wait: float = CIRCUIT_MAX_WAIT):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = max(1, min_calls)
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.state = "closed"
+        self.opens = 0
+        self.fast_failures = 0
+        self.open_seconds = 0.0
+        self._outcomes: "deque[bool]" = deque(maxlen=max(window, self.min_calls))
+        self._opened_at = 0.0
+        self._outage_started: Optional[float] = None
+        self._probing = False
+        self._cond = threading.Condition()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.failure_rate > 0
+    
+    def _enter(self) -> Tuple[Optional[float], bool]:
+        """（持有锁）尝试放行一个请求：返回 (需等待的秒数，None 表示放行; 是否为探测请求)，需要快速失败时抛出 CircuitOpenError"""
+        if not self.enabled or self.state == "closed":
+            return None, False
+        now = time.monotonic()
+        if self.state == "open" and now - self._opened_at >= self.cooldown:
+            self.state = "half-open"
+        if self.state == "half-open" and not self._probing:
+            self._probing = True
+            return None, True
+        remaining = self._outage_started + self.max_wait - now
+        if remaining <= 0:
+            self.fast_failures += 1
+            raise CircuitOpenError(f"{self.name} 熔断中（故障已持续 {now - self._outage_started:.0f}s）")
+        # open：等到 cooldown 结束；half-open：等探测结果（record 会唤醒）
+        wait = self._opened_at + self.cooldown - now if self.state == "open" else self.cooldown
+        return max(0.05, min(wait, remaining)), False
+    
+    def acquire(self) -> bool:
+        """发送请求前调用：closed 时立即返回；熔断中阻塞等待或快速失败。返回本次请求是否为 half-open 探测"""
+        with self._cond:
+            while True:
+                wait, probe = self._enter()
+                if wait is None:
+                    return probe
+                self._cond.wait(wait)
+    
+    async def acquire_async(self) -> bool:
+        """acquire 的 asyncio 版本（轮询状态，不阻塞事件循环）"""
+        while True:
+            with self._cond:
+                wait, probe = self._enter()
+            if wait is None:
+                return probe
+            await asyncio.sleep(min(wait, 0.5))
+    
+    def release(self, probe: bool):
+        """请求没有得到结果就中止（如被取消）：归还探测名额，不改变状态，由下一个调用方重新探测"""
+        if not probe:
+            return
+        with self._cond:
+            self._probing = False
+            self._cond.notify_all()
+    
+    def record(self, ok: bool, probe: bool = False):
+        """记录一次请求结果（ok=False 表示服务商故障，见 _is_outage）"""
+        if not self.enabled:
+            return
+        with self._cond:
+            now = time.monotonic()
+            if probe:
+                self._probing = False
+                if ok:
+                    self.open_seconds += now - self._outage_started
+                    self.state, self._outage_started = "closed", None
+                    self._outcomes.clear()
+                else:
+                    self.state, self._opened_at = "open", now
+                self._cond.notify_all()
+                return
+            if self.state != "closed":
+                return  # 熔断前已发出的请求，结果不再影响状态
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_rate * len(self._outcomes):
+                self.state, self._opened_at, self._outage_started = "open", now, now
+                self.opens += 1
+    
+    def summary(self) -> str:
+        with self._cond:
+            total = self.open_seconds + (time.monotonic() - self._outage_started if self._outage_started is not None else 0.0)
+            return f"{self.name}: 熔断 {self.opens} 次，共 {total:.1f}s，快速失败 {self.fast_failures} 次，当前 {self.state}"
+
+class CircuitBreakers:
+    """按服务商名称管理熔断器（每次运行开始时 configure 重置）"""
+    
+    def __init__(self):
+        self._lock = Lock()
+        self._settings: Dict[str, Any] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+    
+    def configure(self, failure_rate: float, min_calls: int, window: int, cooldown: float, max_wait: float):
+        with self._lock:
+            self._settings = dict(failure_rate=failure_rate, min_calls=min_calls, window=window,
+                                  cooldown=cooldown, max_wait=max_wait)
+            self._breakers = {}
+    
+    def get(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, **self._settings)
+            return breaker
+    
+    def is_open(self, name: str) -> bool:
+        breaker = self._breakers.get(name)
+        return breaker is not None and breaker.state != "closed"
+    
+    def summary(self) -> List[str]:
+        """熔断过的服务商的统计"""
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return [breaker.summary() for breaker in breakers if breaker.opens]
+
+ai_circuits = CircuitBreakers()
+
+def _is_outage(e: Exception, call: "AICall") -> bool:
+    """服务商故障（计入熔断失败率）：网络连接失败、超时，或5xx/429响应；文件、编码等本地错误不计入"""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, TimeoutError, RateLimitedError)):
+        return True
+    if AIOHTTP_AVAILABLE and isinstance(e, aiohttp.ClientConnectionError):
+        return True
+    status = call.http_status or 0
+    return status >= 500 or status == 429
+
+# ==================== AI调用记录 ====================
+
+# (started_at, content_hash, posts, provider, model, attempts, latency, input_tokens, output_tokens, http_status, ok, error)
+AICallRow = Tuple[float, Optional[str], int, str, str, int, float, Optional[int], Optional[int], Optional[int], int, Optional[str]]
+
+class AICall:
+    """一次AI调用（含重试）的观测数据：各服务商的调用函数在每次尝试后填写状态码与token用量"""
+    
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.attempts = 0
+        self.http_status: Optional[int] = None
+        self.input_tokens: Optional[int] = None
+        self.output_tokens: Optional[int] = None
+    
+    def qwen_usage(self, usage: Optional[Dict[str, Any]]):
+        """DashScope 响应中的 usage（input_tokens / output_tokens）"""
+        if usage:
+            self.input_tokens = usage.get("input_tokens", self.input_tokens)
+            self.output_tokens = usage.get("output_tokens", self.output_tokens)
+
+class AICallLog:
+    """
+    逐次AI调用记录：每次调用结束（成功或重试用尽）后生成一行 ai_calls 记录交给 sink
+    
+    运行中 sink 为 StateWriter.record_ai_call（写入 state.sqlite），未配置时不记录。
+    调用对应的文件（content_hash、批量请求的篇数）用 contextvars 传递，线程与 asyncio 任务各自独立。
+    """
+    
+    def __init__(self):
+        self.sink = None
+        self._file: "contextvars.ContextVar[Tuple[Optional[str], int]]" = contextvars.ContextVar("ai_call_file", default=(None, 1))
+    
+    def configure(self, sink):
+        self.sink = sink
+    
+    @contextmanager
+    def file(self, content_hash: Optional[str], posts: int = 1):
+        """标记当前线程/任务中的AI调用属于哪个文件（批量请求 content_hash 为 None，posts 为篇数）"""
+        token = self._file.set((content_hash, posts))
+        try:
+            yield
+        finally:
+            self._file.reset(token)
+    
+    @contextmanager
+    def track(self, call: AICall):
+        """包住一次AI调用（含重试），结束时记录耗时与结果"""
+        error = None
+        try:
+            yield call
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)[:200]}"
+            raise
+        finally:
+            sink = self.sink
+            if sink is not None:
+                content_hash, posts = self._file.get()
+                sink((call.started_at, content_hash, posts, call.provider, call.model, call.attempts,
+                      time.monotonic() - call.started, call.input_tokens, call.output_tokens, call.http_status,
+                      int(error is None), error))
+
+ai_call_log = AICallLog()
+
+def call_with_retries(send, retries: int = MAX_RETRIES, call: Optional[AICall] = None):
+    """
+    执行一次AI请求，可重试的错误（429、502/503/504、超时）按 decorrelated jitter 退避后重试，
+    遇到 Retry-After 时至少等待服务端要求的时间（call 不为空时记录尝试次数）
+    """
+    breaker = ai_circuits.get(call.provider) if call is not None else None
+    delay = RETRY_BASE_DELAY
+    for attempt in range(retries + 1):
+        probe = False
+        if call is not None:
+            call.attempts = attempt + 1
+            probe = breaker.acquire()
+        try:
+            result = send()
+        except Exception as e:
+            if breaker is not None:
+                breaker.record(not _is_outage(e, call), probe)
+            if not _is_retryable(e):
+                raise
+            if attempt >= retries:
+                raise _exhausted(e, retries) from e
+            delay = _retry_delay(e, delay)
+            time.sleep(delay)
+        except BaseException:
+            if breaker is not None:
+                breaker.release(probe)
+            raise
+        else:
+            if breaker is not None:
+                breaker.record(True, probe)
+            return result
+
+async def call_with_retries_async(send, retries: int = MAX_RETRIES, call: Optional[AICall] = None):
+    """call_with_retries 的 asyncio 版本"""
+    breaker = ai_circuits.get(call.provider) if call is not None else None
+    delay = RETRY_BASE_DELAY
+    for attempt in range(retries + 1):
+        probe = False
+        if call is not None:
+            call.attempts = attempt + 1
+            probe = await breaker.acquire_async()
+        try:
+            result = await send()
+        except Exception as e:
+            if breaker is not None:
+                breaker.record(not _is_outage(e, call), probe)
+            if not _is_retryable(e):
+                raise
+            if attempt >= retries:
+                raise _exhausted(e, retries) from e
+            delay = _retry_delay(e, delay)
+            await asyncio.sleep(delay)
+        except BaseException:  # 包括 asyncio.CancelledError
+            if breaker is not None:
+                breaker.release(probe)
+            raise
+        else:
+            if breaker is not None:
+                breaker.record(True, probe)
+            return result
 
 def check_ai_api() -> Tuple[bool, str]:
     """检查AI API是否可用（强制要求）"""
@@ -71,10 +748,10 @@ def check_ai_api() -> Tuple[bool, str]:
     # 测试API可用性
     try:
         if AI_TYPE == "qwen":
-            response = requests.post(
+            response = get_http_session().post(
                 QWEN_API_URL,
                 headers={'Authorization': f'Bearer {AI_API_KEY}'},
-                json={'model': 'qwen-plus', 'input': {'messages': [{'role': 'user', 'content': 'test'}]}},
+                json={'model': QWEN_MODEL, 'input': {'messages': [{'role': 'user', 'content': 'test'}]}},
                 timeout=5
             )
             if response.status_code == 401:
@@ -90,9 +767,129 @@ def check_ai_api() -> Tuple[bool, str]:
     
     return True, "AI API可用"
 
-def build_prompt(title: str, content_text: str) -> str:
-    """构建AI清洗提示词"""
-    return f"""你是一位专业的互联网求职面经主编。
+# ==================== 提示词压缩 ====================
+
+# 整行匹配即删除的论坛模板文字（积分门槛、编辑记录、推广、附件按钮、水印）
+_BOILERPLATE_LINE_RES = [re.compile(p) for p in (
+    r"^(以下内容|本帖隐藏的内容)需要积分高于 ?\d+ ?(您已经可以浏览|才可浏览)$",
+    r"^本帖最后由 .+ 于 \d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{2}(:\d{2})? 编辑$",
+    r"^补充内容 \(\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{2}.*\):?$",
+    r"^查看更多.+(工资与职级|相关主题)$",
+    r"^✅ 高效阅读",
+    r"^(🔥)+ ?欢迎体验$",
+    r"^面经会员专享版$",
+    r"^(点击文件名)?下载附件$",
+    r"^保存到相册$",
+    r"^扫码关注一亩三分地",
+    r"^一亩三分地\S{0,6}$",
+    r"^[-.\s]*(baidu\s*)?(check\s+)?(www\.)?1point3acres(\.com)?(\s+for more\.?)?$",
+)]
+# 薪资/统计小组件的标签行（回退解析整页时混入正文），其后紧跟的纯数字/金额行一并删除
+_WIDGET_LABEL_RE = re.compile(r"^(面经|工资|内推|评价|讨论|基本工资|股票期权|签字奖励|\(平均值\)|收藏|评分|淘帖|好苗|杂草|\|)$")
+_WIDGET_VALUE_RE = re.compile(r"^(\(\d+\)|\$?[\d,]+)$")
+# 页脚标记：之后是上一篇/下一篇与相关帖子列表
+_FOOTER_LINES = {"上一篇：", "相关帖子"}
+# 引用块：回复中的 “xxx 发表于 日期” / “原帖由 xxx 于 日期 发表”，下一行被截断的引用内容以省略号结尾
+_QUOTE_HEADER_RE = re.compile(r"^(.{1,40} 发表于 \d{4}-\d{1,2}-\d{1,2}|原帖由 .{1,40} 于 \d{4}-\d{1,2}-\d{1,2}.* 发表)")
+# 签名式短句：只有求米/攒人品之类，与面经内容无关
+_SIGNATURE_RE = re.compile(r"求(加|大)?米|加米|攒(攒)?人品|攒好运|求rp", re.IGNORECASE)
+_SIGNATURE_MAX_CHARS = 20
+_INLINE_SPACE_RE = re.compile(r"[ \t　\xa0]+")
+TRUNCATION_MARKER = "……（中间内容过长，已省略）……"
+TRUNCATION_HEAD_RATIO = 0.8  # 截断时保留开头的比例，其余留给结尾（面经的总结通常在最后）
+
+def prompt_token_budget(model: Optional[str] = None) -> int:
+    """当前模型的正文token上限（PROMPT_TOKEN_BUDGETS 覆盖 PROMPT_TOKEN_BUDGET）"""
+    return PROMPT_TOKEN_BUDGETS.get(model or ai_model_name(), PROMPT_TOKEN_BUDGET)
+
+def strip_boilerplate(text: str) -> str:
+    """删除论坛模板、水印、引用块和签名式短句，合并行内空白与多余空行"""
+    lines = []
+    skip_quote = False
+    after_widget = False
+    for line in text.split("\n"):
+        line = _INLINE_SPACE_RE.sub(" ", line).strip()
+        if line in _FOOTER_LINES:
+            break
+        if skip_quote:
+            skip_quote = False
+            if line.endswith(("...", "…")):
+                continue
+        if _QUOTE_HEADER_RE.match(line):
+            skip_quote = True
+            continue
+        if _WIDGET_LABEL_RE.match(line):
+            after_widget = True
+            continue
+        if after_widget and _WIDGET_VALUE_RE.match(line):
+            continue
+        after_widget = False
+        if any(r.match(line) for r in _BOILERPLATE_LINE_RES):
+            continue
+        if len(line) <= _SIGNATURE_MAX_CHARS and _SIGNATURE_RE.search(line):
+            continue
+        if not line and (not lines or not lines[-1]):
+            continue
+        lines.append(line)
+    return "\n".join(lines).strip()
+
+def _take_tokens(lines: List[str], budget: int, partial: bool = True) -> List[str]:
+    """按顺序取行，直到累计token数达到 budget；partial=True 时放不下的第一行按字符截断"""
+    taken = []
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if tokens <= budget:
+            taken.append(line)
+            budget -= tokens
+            continue
+        if not partial:
+            break
+        chars = []
+        used = 1.0
+        for ch in line:
+            used += 1 if _CJK_RE.match(ch) else 0.25
+            if used > budget:
+                break
+            chars.append(ch)
+        if chars:
+            taken.append("".join(chars))
+        break
+    return taken
+
+def truncate_to_budget(text: str, budget: int) -> Tuple[str, bool]:
+    """
+    确定性截断：保留开头约80%与结尾约20%的行，中间替换为省略标记
+
+    相同输入总是得到相同输出（AI响应缓存的key依赖提示词内容）；budget<=0 表示不截断。
+    """
+    if budget <= 0 or estimate_tokens(text) <= budget:
+        return text, False
+    lines = text.split("\n")
+    budget -= estimate_tokens(TRUNCATION_MARKER)
+    head = _take_tokens(lines, int(budget * TRUNCATION_HEAD_RATIO))
+    rest = lines[len(head):]
+    tail = _take_tokens(rest[::-1], budget - sum(estimate_tokens(line) for line in head), partial=False)[::-1]
+    return "\n".join(head + [TRUNCATION_MARKER] + tail), True
+
+def compact_content(content_text: str, budget: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    压缩原始正文：去模板 → 合并空白 → 按token上限截断
+
+    Returns:
+        (压缩后的正文, 指标 {"content_tokens", "compact_tokens", "truncated"})
+    """
+    if budget is None:
+        budget = prompt_token_budget()
+    stripped = strip_boilerplate(content_text)
+    compacted, truncated = truncate_to_budget(stripped, budget)
+    return compacted, {
+        "content_tokens": estimate_tokens(content_text),
+        "compact_tokens": estimate_tokens(compacted),
+        "truncated": truncated,
+    }
+
+# 单篇与批量提示词共用的清洗要求
+PROMPT_INSTRUCTIONS = """你是一位专业的互联网求职面经主编。
 请将用户提供的原始面经内容清洗、匿名化并重组为"产品级可读"的结构化面经。
 
 硬性要求：
@@ -122,7 +919,13 @@ def build_prompt(title: str, content_text: str) -> str:
      * category: 部门类别，可选值："SWE"、"Data"、"PM"、"Design"、"Infra"、"Other"（根据role和内容判断）
      * experience: 经验要求，如 "0"、"0-2"、"2-5"、"5-10"、"10+"（从内容推断，不确定则空字符串）
      * salary: 薪资范围，如 "0-100k"、"100k-150k"、"150k-200k"、"200k-300k"、"300k+"（从内容推断，不确定则空字符串）
-     * custom: 自定义标签数组，如 ["手写代码", "系统设计", "算法题"]（其他有价值的标签）
+     * custom: 自定义标签数组，如 ["手写代码", "系统设计", "算法题"]（其他有价值的标签）"""
+
+def build_prompt(title: str, content_text: str, compact: bool = True) -> str:
+    """构建AI清洗提示词（compact=False 表示正文已由 compact_content 压缩过）"""
+    if compact:
+        content_text, _ = compact_content(content_text)
+    return f"""{PROMPT_INSTRUCTIONS}
 
 原始标题（可能很糙）：
 {title}
@@ -134,202 +937,1042 @@ def build_prompt(title: str, content_text: str) -> str:
 tagDimensions 必须包含所有子字段（technologies, recruitType, location, category, experience, salary, custom）。
 只返回 JSON，不要其他文字。"""
 
-def call_qwen_api(prompt: str, retries: int = MAX_RETRIES) -> Dict[str, Any]:
-    """调用Qwen API"""
+def build_batch_prompt(posts: List[Tuple[str, str]]) -> str:
+    """
+    构建批量清洗提示词：多篇短面经共用一份清洗要求，模型返回 {"results": [...]}
+
+    posts 为 [(标题, 已压缩的正文), ...]，编号从1开始，结果用 id 字段对应回编号（见 split_batch_response）。
+    """
+    sections = "\n\n".join(
+        f"=== 面经 {i} ===\n原始标题（可能很糙）：\n{title}\n\n原始正文（已去掉HTML标签，仅保留文本）：\n{content_text}"
+        for i, (title, content_text) in enumerate(posts, 1)
+    )
+    return f"""{PROMPT_INSTRUCTIONS}
+
+下面有 {len(posts)} 篇互相独立的原始面经，请逐篇分别处理，不要合并内容，也不要把一篇的信息用到另一篇。
+
+{sections}
+
+请返回 JSON 对象 {{"results": [...]}}，results 数组按编号顺序为每篇面经给出一个对象，
+包含 id（面经编号，字符串，如 "1"）以及 title, processedContent, company, role, difficulty, tags, tagDimensions 字段。
+tagDimensions 必须包含所有子字段（technologies, recruitType, location, category, experience, salary, custom）。
+只返回 JSON，不要其他文字。"""
+
+def split_batch_response(processed: Any, count: int) -> Dict[int, Dict[str, Any]]:
+    """
+    把批量响应拆回每篇面经：编号(1..count) → 该篇的AI结果（已去掉 id 字段）
+
+    缺少 id 时按数组位置对应；编号越界、重复或结果不是对象的条目被丢弃，由调用方单独重试。
+    """
+    results = processed.get("results") if isinstance(processed, dict) else processed
+    if not isinstance(results, list):
+        return {}
+    by_index: Dict[int, Dict[str, Any]] = {}
+    for position, result in enumerate(results, 1):
+        if not isinstance(result, dict):
+            continue
+        result = dict(result)
+        doc_id = str(result.pop("id", position)).strip()
+        index = int(doc_id) if doc_id.isdigit() else None
+        if index is None or not 1 <= index <= count or index in by_index:
+            continue
+        by_index[index] = result
+    return by_index
+
+def _qwen_request(prompt: str, stream: bool = False) -> Tuple[Dict[str, str], Dict[str, Any]]:
+    """Qwen请求头与请求体（线程引擎与async引擎共用；stream=True 时使用SSE增量输出）"""
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {QWEN_API_KEY}'
     }
     
     data = {
-        'model': 'qwen-plus',
+        'model': QWEN_MODEL,
         'input': {
             'messages': [{'role': 'user', 'content': prompt}]
         },
         'parameters': {'result_format': 'message'}
     }
+    if stream:
+        headers['Accept'] = 'text/event-stream'
+        headers['X-DashScope-SSE'] = 'enable'
+        data['parameters']['incremental_output'] = True
+    return headers, data
+
+def _strip_json_fence(text: str) -> str:
+    """去掉模型输出中的 ```json 代码块标记"""
+    text = text.strip()
+    if text.startswith("```json"):
+        text = text[7:]
+    if text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+def _parse_qwen_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """从Qwen响应中取出模型输出并解析为JSON"""
+    text = result['output']['choices'][0]['message']['content']
+    if not text:
+        raise ValueError("Empty model response text")
+    return json.loads(_strip_json_fence(text))
+
+def _qwen_usage_tokens(result: Dict[str, Any]) -> Optional[int]:
+    usage = result.get("usage") or {}
+    total = usage.get("total_tokens") or (usage.get("input_tokens", 0) + usage.get("output_tokens", 0))
+    return total or None
+
+# ==================== Qwen流式输出（SSE）====================
+
+# 顶层字段 → 值允许的首字符；单篇结果的字段与批量结果的 results
+STREAM_FIELD_STARTS = {
+    "title": '"', "processedContent": '"', "company": '"', "role": '"',
+    "difficulty": '"-0123456789', "tags": "[", "tagDimensions": "{", "results": "[",
+}
+
+class StreamingJSONGuard:
+    """
+    增量检查模型输出的JSON：逐字符跟踪字符串/括号状态与顶层字段
+
+    允许开头的 ```json 代码块标记；出现以下情况时立即抛出 MalformedStreamError，不必等生成结束：
+    开头不是JSON对象、括号不匹配、顶层出现未知字段、字段值类型不符、对象结束后还有多余内容。
+    """
     
-    for attempt in range(retries + 1):
-        try:
-            response = requests.post(QWEN_API_URL, headers=headers, json=data, timeout=API_TIMEOUT)
-            
-            if response.status_code == 200:
-                result = response.json()
-                text = result['output']['choices'][0]['message']['content']
-                if not text:
-                    raise ValueError("Empty model response text")
-                
-                # 提取JSON
-                text = text.strip()
-                if text.startswith("```json"):
-                    text = text[7:]
-                if text.startswith("```"):
-                    text = text[3:]
-                if text.endswith("```"):
-                    text = text[:-3]
-                text = text.strip()
-                
-                return json.loads(text)
-            elif response.status_code == 429:
-                if attempt < retries:
-                    time.sleep(min(2 * (attempt + 1), 12))
-                    continue
-                raise Exception(f"Rate limited after {retries} retries")
-            else:
-                raise Exception(f"API returned {response.status_code}: {response.text[:200]}")
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Failed to parse JSON: {e}")
-        except Exception as e:
-            if attempt < retries and any(k in str(e).lower() for k in ['429', 'rate', 'timeout']):
-                time.sleep(min(2 * (attempt + 1), 12))
-                continue
-            raise
+    def __init__(self, field_starts: Dict[str, str] = STREAM_FIELD_STARTS):
+        self.field_starts = field_starts
+        self._parts: List[str] = []
+        self._prefix = ""
+        self._stack: List[str] = []
+        self._started = False
+        self._done = False
+        self._in_string = False
+        self._escape = False
+        self._key: Optional[str] = None
+        self._field: Optional[str] = None
+        self._expect = "key"  # 顶层对象中下一个期望的成分：key / colon / value / after_value
     
-    raise Exception("Max retries exceeded")
-
-def call_gemini_api(prompt: str, retries: int = MAX_RETRIES) -> Dict[str, Any]:
-    """调用Gemini API（需要google-generativeai库）"""
-    try:
-        import google.generativeai as genai
-    except ImportError:
-        raise ImportError("需要安装 google-generativeai: pip install google-generativeai")
+    def feed(self, delta: str):
+        self._parts.append(delta)
+        for ch in delta:
+            self._step(ch)
     
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(GEMINI_MODEL)
+    def finish(self) -> str:
+        """流结束：返回完整文本；JSON对象未闭合时抛出 MalformedStreamError"""
+        if not self._done:
+            raise MalformedStreamError("流式输出在JSON结束前中断")
+        return "".join(self._parts)
     
-    for attempt in range(retries + 1):
-        try:
-            response = model.generate_content(
-                prompt,
-                generation_config={
-                    "response_mime_type": "application/json",
-                }
-            )
-            text = response.text.strip()
-            if text.startswith("```json"):
-                text = text[7:]
-            if text.startswith("```"):
-                text = text[3:]
-            if text.endswith("```"):
-                text = text[:-3]
-            return json.loads(text.strip())
-        except Exception as e:
-            if attempt < retries and any(k in str(e).lower() for k in ['429', 'rate', 'timeout']):
-                time.sleep(min(2 * (attempt + 1), 12))
-                continue
-            raise
+    def _fail(self, reason: str):
+        raise MalformedStreamError(f"{reason}: {''.join(self._parts)[-80:]!r}")
     
-    raise Exception("Max retries exceeded")
-
-def process_with_ai(raw_data: Dict[str, Any]) -> Dict[str, Any]:
-    """使用AI清洗raw数据为final格式"""
-    prompt = build_prompt(raw_data.get("title", ""), raw_data.get("originalContentText", ""))
+    def _step(self, ch: str):
+        if self._done:
+            if not (ch.isspace() or ch == "`"):
+                self._fail("JSON结束后还有多余内容")
+            return
+        if not self._started:
+            self._prefix += ch
+            head = self._prefix.strip().lower()
+            if ch == "{" and head[:-1].strip() in ("", "```", "```json"):
+                self._started = True
+                self._stack.append("{")
+            elif not "```json".startswith(head):
+                self._fail("输出不是JSON对象")
+            return
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                if self._key is not None:
+                    if self._key not in self.field_starts:
+                        self._fail(f"未知字段 {self._key}")
+                    self._field, self._key = self._key, None
+                    self._expect = "colon"
+                return
+            if self._key is not None:
+                self._key += ch
+            return
+        if ch.isspace():
+            return
+        
+        if len(self._stack) == 1:
+            if self._expect == "key":
+                if ch == '"':
+                    self._in_string, self._key = True, ""
+                elif ch == "}":
+                    self._close(ch)
+                else:
+                    self._fail("期望字段名")
+                return
+            if self._expect == "colon":
+                if ch != ":":
+                    self._fail("期望冒号")
+                self._expect = "value"
+                return
+            if self._expect == "value":
+                if ch not in self.field_starts[self._field]:
+                    self._fail(f"字段 {self._field} 的类型不符")
+                self._expect = "after_value"
+            elif self._expect == "after_value":
+                if ch == ",":
+                    self._expect = "key"
+                elif ch == "}":
+                    self._close(ch)
+                elif not (ch.isalnum() or ch in ".+-"):
+                    self._fail("字段值之后期望逗号或右括号")
+                return
+        
+        if ch == '"':
+            self._in_string = True
+        elif ch in "{[":
+            self._stack.append(ch)
+        elif ch in "}]":
+            self._close(ch)
     
-    if AI_TYPE == "qwen":
-        processed = call_qwen_api(prompt)
-    elif AI_TYPE == "gemini":
-        processed = call_gemini_api(prompt)
-    else:
-        raise RuntimeError("AI API未配置")
+    def _close(self, ch: str):
+        if not self._stack or self._stack.pop() != {"}": "{", "]": "["}[ch]:
+            self._fail("括号不匹配")
+        if not self._stack:
+            self._done = True
+
+def parse_sse_data(line: str) -> Optional[Dict[str, Any]]:
+    """解析一行SSE：data 行返回其中的JSON，其他行（id/event/注释/空行）返回 None"""
+    if not line.startswith("data:"):
+        return None
+    return json.loads(line[5:])
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+class QwenStreaming:
+    """Qwen流式输出的开关与统计：首token时间、完整响应时间、提前中止次数"""
     
-    # 验证必需字段
-    required_fields = ["title", "processedContent", "company", "role", "difficulty", "tags", "tagDimensions"]
-    missing = [f for f in required_fields if f not in processed]
-    if missing:
-        raise ValueError(f"AI返回缺少必需字段: {missing}")
+    def __init__(self, enabled: bool = QWEN_STREAM):
+        self._lock = Lock()
+        self.configure(enabled)
     
-    # 初始化标签验证器（必需）
-    validator = TagValidator()
+    def configure(self, enabled: bool):
+        with self._lock:
+            self.enabled = enabled
+            self.first_token_seconds: List[float] = []
+            self.total_seconds: List[float] = []
+            self.aborted = 0
     
-    # 初始化 TagExtractor（如果可用）用于公司名称和地点规范化
-    tag_extractor = None
-    if TAG_EXTRACTOR_AVAILABLE:
-        try:
-            tag_extractor = TagExtractor()
-        except Exception as e:
-            print(f"⚠️  TagExtractor初始化失败，将跳过标签规范化: {e}")
+    def record(self, first_token: Optional[float], total: float):
+        with self._lock:
+            if first_token is not None:
+                self.first_token_seconds.append(first_token)
+            self.total_seconds.append(total)
     
-    # 验证 tagDimensions 结构
-    tag_dims = processed.get("tagDimensions", {})
-    required_dims = ["technologies", "recruitType", "location", "category", "experience", "salary", "custom"]
-    missing_dims = [d for d in required_dims if d not in tag_dims]
-    if missing_dims:
-        raise ValueError(f"tagDimensions 缺少必需字段: {missing_dims}")
+    def record_abort(self):
+        with self._lock:
+            self.aborted += 1
     
-    # 提取并规范化 tagDimensions
-    tag_dimensions = {
-        "technologies": list(tag_dims.get("technologies", [])) if isinstance(tag_dims.get("technologies"), list) else [],
-        "recruitType": str(tag_dims.get("recruitType", "")).strip() or "",
-        "location": str(tag_dims.get("location", "")).strip() or "",
-        "category": str(tag_dims.get("category", "")).strip() or "Other",
-        "experience": str(tag_dims.get("experience", "")).strip() or "",
-        "salary": str(tag_dims.get("salary", "")).strip() or "",
-        "custom": list(tag_dims.get("custom", [])) if isinstance(tag_dims.get("custom"), list) else []
-    }
+    def summary(self) -> str:
+        with self._lock:
+            return (f"首token p50 {_percentile(self.first_token_seconds, 0.5):.2f}s / "
+                    f"p95 {_percentile(self.first_token_seconds, 0.95):.2f}s，"
+                    f"完整响应 p50 {_percentile(self.total_seconds, 0.5):.2f}s，"
+                    f"{len(self.total_seconds)} 次完成，提前中止 {self.aborted} 次")
+
+qwen_streaming = QwenStreaming()
+
+class QwenStreamReader:
+    """逐行消费DashScope的SSE响应（线程引擎与async引擎共用）"""
     
-    # 使用验证器规范化标签值（关键：将中文转换为英文标准值）
-    tag_dimensions["category"] = validator.normalize_value("category", tag_dimensions["category"]) or "Other"
-    if tag_dimensions["recruitType"]:
-        tag_dimensions["recruitType"] = validator.normalize_value("recruitType", tag_dimensions["recruitType"]) or ""
-    if tag_dimensions["experience"]:
-        tag_dimensions["experience"] = validator.normalize_value("experience", tag_dimensions["experience"]) or ""
-    if tag_dimensions["salary"]:
-        tag_dimensions["salary"] = validator.normalize_value("salary", tag_dimensions["salary"]) or ""
+    def __init__(self, started: float):
+        self.started = started
+        self.first_token: Optional[float] = None
+        self.usage: Optional[int] = None
+        self.usage_detail: Optional[Dict[str, Any]] = None
+        self.guard = StreamingJSONGuard()
     
-    # 使用 TagExtractor 规范化公司名称和地点（如果可用）
-    if tag_extractor:
+    def feed_line(self, line: str):
+        chunk = parse_sse_data(line.strip())
+        if chunk is None:
+            return
+        if "output" not in chunk:
+            code = str(chunk.get("code", ""))
+            if "Throttling" in code or "429" in code:
+                raise RateLimitedError(f"Stream error {code}")
+            raise Exception(f"Stream error {code}: {chunk.get('message', '')[:200]}")
+        self.usage = _qwen_usage_tokens(chunk) or self.usage
+        self.usage_detail = chunk.get("usage") or self.usage_detail
+        delta = chunk["output"]["choices"][0]["message"].get("content") or ""
+        if delta and self.first_token is None:
+            self.first_token = time.monotonic() - self.started
         try:
-            # 规范化公司名称
-            if processed.get("company"):
-                normalized_company = tag_extractor._normalize_value(processed["company"], "company")
-                if normalized_company:
-                    processed["company"] = normalized_company
-            
-            # 规范化地点
-            if tag_dimensions["location"]:
-                normalized_location = tag_extractor._normalize_value(tag_dimensions["location"], "location")
-                if normalized_location:
-                    tag_dimensions["location"] = normalized_location
-        except Exception as e:
-            print(f"⚠️  标签规范化过程中出错: {e}")
+            self.guard.feed(delta)
+        except MalformedStreamError:
+            qwen_streaming.record_abort()
+            raise
     
-    # 使用验证器验证 tagDimensions（确保符合规范）
-    is_valid, errors, warnings = validator.validate_tag_dimensions(tag_dimensions)
-    if not is_valid:
-        error_msg = f"tagDimensions 验证失败: {', '.join(errors)}"
-        print(f"❌ {error_msg}")
-        raise ValueError(error_msg)
+    def finish(self) -> Dict[str, Any]:
+        """流结束：解析完整JSON并记录耗时；输出不完整或无法解析时按格式错误处理（会重试）"""
+        try:
+            processed = json.loads(_strip_json_fence(self.guard.finish()))
+        except (MalformedStreamError, json.JSONDecodeError) as e:
+            qwen_streaming.record_abort()
+            raise MalformedStreamError(str(e)) from e
+        qwen_streaming.record(self.first_token, time.monotonic() - self.started)
+        return processed
+
+def call_qwen_api(prompt: str, retries: int = MAX_RETRIES, url: Optional[str] = None) -> Dict[str, Any]:
+    """调用Qwen API（qwen_streaming.enabled 时使用流式输出；url 默认为 QWEN_API_URL）"""
+    url = url or QWEN_API_URL
+    ai_call = AICall("qwen", QWEN_MODEL)
+    if qwen_streaming.enabled:
+        with ai_call_log.track(ai_call):
+            return call_with_retries(lambda: _send_qwen_stream(prompt, url, ai_call), retries, ai_call)
+    headers, data = _qwen_request(prompt)
     
-    # 输出警告（如果有）
-    if warnings:
-        for warning in warnings:
-            print(f"⚠️  {warning}")
+    def send() -> Dict[str, Any]:
+        reserved = ai_rate_limiter.acquire(estimate_request_tokens(prompt))
+        ai_call.http_status = None
+        with ai_concurrency.call() as call:
+            response = get_http_session().post(url, headers=headers, json=data, timeout=API_TIMEOUT)
+            ai_call.http_status = response.status_code
+            if response.status_code == 429:
+                call.overloaded()
+            elif response.status_code in SERVER_RETRY_STATUSES:
+                call.unavailable()
+        
+        if response.status_code == 200:
+            try:
+                result = response.json()
+                ai_rate_limiter.settle(reserved, _qwen_usage_tokens(result))
+                ai_call.qwen_usage(result.get("usage"))
+                return _parse_qwen_result(result)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Failed to parse JSON: {e}")
+        elif response.status_code == 429:
+            raise RateLimitedError("API returned 429", parse_retry_after(response.headers.get("Retry-After")))
+        elif response.status_code in SERVER_RETRY_STATUSES:
+            raise ServerUnavailableError(f"API returned {response.status_code}: {response.text[:200]}",
+                                         parse_retry_after(response.headers.get("Retry-After")))
+        else:
+            raise Exception(f"API returned {response.status_code}: {response.text[:200]}")
     
-    # 构建final payload
-    return {
-        "title": processed["title"],
-        "originalContent": raw_data.get("originalContentHtml", ""),
-        "processedContent": processed["processedContent"],
-        "company": processed["company"],
-        "role": processed["role"],
-        "difficulty": int(processed["difficulty"]),
-        "tags": list(processed["tags"]),  # 保留向后兼容
-        "tagDimensions": tag_dimensions,  # 新增结构化标签
-        "comments": [],
-        "usefulVotes": 0,
-        "uselessVotes": 0,
-        "shareCount": 0,
-        "isAnonymous": True
-    }
-
-# ==================== HTML解析 ====================
+    with ai_call_log.track(ai_call):
+        return call_with_retries(send, retries, ai_call)
 
-def parse_html(html_path: Path) -> Dict[str, Any]:
-    """解析单个HTML文件为raw JSON"""
-    raw_html = html_path.read_text(encoding="utf-8", errors="ignore")
-    soup = BeautifulSoup(raw_html, "lxml")
+async def call_qwen_api_async(session: "aiohttp.ClientSession", prompt: str, retries: int = MAX_RETRIES) -> Dict[str, Any]:
+    """调用Qwen API（asyncio版本，复用 session 的keep-alive连接池；重试规则与 call_qwen_api 相同）"""
+    ai_call = AICall("qwen", QWEN_MODEL)
+    if qwen_streaming.enabled:
+        with ai_call_log.track(ai_call):
+            return await call_with_retries_async(lambda: _send_qwen_stream_async(session, prompt, ai_call), retries, ai_call)
+    headers, data = _qwen_request(prompt)
     
-    # 移除anti-crawling元素
+    async def send() -> Dict[str, Any]:
+        reserved = await ai_rate_limiter.acquire_async(estimate_request_tokens(prompt))
+        ai_call.http_status = None
+        try:
+            async with ai_concurrency.call_async() as call:
+                async with session.post(QWEN_API_URL, headers=headers, json=data) as response:
+                    status = ai_call.http_status = response.status
+                    retry_after = response.headers.get("Retry-After")
+                    body = await response.text()
+                if status == 429:
+                    call.overloaded()
+                elif status in SERVER_RETRY_STATUSES:
+                    call.unavailable()
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Request timeout after {API_TIMEOUT}s")
+        
+        if status == 200:
+            try:
+                result = json.loads(body)
+                ai_rate_limiter.settle(reserved, _qwen_usage_tokens(result))
+                ai_call.qwen_usage(result.get("usage"))
+                return _parse_qwen_result(result)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Failed to parse JSON: {e}")
+        elif status == 429:
+            raise RateLimitedError("API returned 429", parse_retry_after(retry_after))
+        elif status in SERVER_RETRY_STATUSES:
+            raise ServerUnavailableError(f"API returned {status}: {body[:200]}", parse_retry_after(retry_after))
+        else:
+            raise Exception(f"API returned {status}: {body[:200]}")
+    
+    with ai_call_log.track(ai_call):
+        return await call_with_retries_async(send, retries, ai_call)
+
+def _send_qwen_stream(prompt: str, url: str, ai_call: AICall) -> Dict[str, Any]:
+    """发送一次流式请求：边接收边检查JSON，格式明显错误时立即断开连接"""
+    headers, data = _qwen_request(prompt, stream=True)
+    reserved = ai_rate_limiter.acquire(estimate_request_tokens(prompt))
+    ai_call.http_status = None
+    with ai_concurrency.call() as call:
+        reader = QwenStreamReader(time.monotonic())
+        with get_http_session().post(url, headers=headers, json=data, timeout=API_TIMEOUT, stream=True) as response:
+            ai_call.http_status = response.status_code
+            if response.status_code == 429:
+                call.overloaded()
+                raise RateLimitedError("API returned 429", parse_retry_after(response.headers.get("Retry-After")))
+            if response.status_code in SERVER_RETRY_STATUSES:
+                raise ServerUnavailableError(f"API returned {response.status_code}: {response.text[:200]}",
+                                             parse_retry_after(response.headers.get("Retry-After")))
+            if response.status_code != 200:
+                raise Exception(f"API returned {response.status_code}: {response.text[:200]}")
+            response.encoding = "utf-8"  # text/event-stream 不带charset时 requests 默认按 latin-1 解码
+            for line in response.iter_lines(decode_unicode=True):
+                reader.feed_line(line)
+        processed = reader.finish()
+    ai_rate_limiter.settle(reserved, reader.usage)
+    ai_call.qwen_usage(reader.usage_detail)
+    return processed
+
+async def _send_qwen_stream_async(session: "aiohttp.ClientSession", prompt: str, ai_call: AICall) -> Dict[str, Any]:
+    """_send_qwen_stream 的 asyncio 版本"""
+    headers, data = _qwen_request(prompt, stream=True)
+    reserved = await ai_rate_limiter.acquire_async(estimate_request_tokens(prompt))
+    ai_call.http_status = None
+    try:
+        async with ai_concurrency.call_async() as call:
+            reader = QwenStreamReader(time.monotonic())
+            async with session.post(QWEN_API_URL, headers=headers, json=data) as response:
+                ai_call.http_status = response.status
+                if response.status == 429:
+                    call.overloaded()
+                    raise RateLimitedError("API returned 429", parse_retry_after(response.headers.get("Retry-After")))
+                if response.status in SERVER_RETRY_STATUSES:
+                    raise ServerUnavailableError(f"API returned {response.status}: {(await response.text())[:200]}",
+                                                 parse_retry_after(response.headers.get("Retry-After")))
+                if response.status != 200:
+                    raise Exception(f"API returned {response.status}: {(await response.text())[:200]}")
+                async for line in response.content:
+                    reader.feed_line(line.decode("utf-8"))
+            processed = reader.finish()
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Request timeout after {API_TIMEOUT}s")
+    ai_rate_limiter.settle(reserved, reader.usage)
+    ai_call.qwen_usage(reader.usage_detail)
+    return processed
+
+# ==================== Gemini客户端（懒加载缓存）====================
+
+_gemini_genai = None
+_gemini_lock = Lock()
+_gemini_local = threading.local()
+
+def _gemini_module():
+    """
+    导入并配置 google.generativeai（每个进程一次）
+
+    genai.configure 修改的是模块级全局状态，多线程同时调用会互相覆盖，所以只在首次使用时加锁执行一次。
+    """
+    global _gemini_genai
+    if _gemini_genai is None:
+        with _gemini_lock:
+            if _gemini_genai is None:
+                try:
+                    import google.generativeai as genai
+                except ImportError:
+                    raise ImportError("需要安装 google-generativeai: pip install google-generativeai")
+                genai.configure(api_key=GEMINI_API_KEY)
+                _gemini_genai = genai
+    return _gemini_genai
+
+def get_gemini_model():
+    """当前线程的 GenerativeModel（懒加载；每个AI线程一个实例，避免并发共享同一个模型对象）"""
+    model = getattr(_gemini_local, "model", None)
+    if model is None:
+        model = _gemini_module().GenerativeModel(GEMINI_MODEL)
+        _gemini_local.model = model
+    return model
+
+def warm_up_gemini():
+    """Pipeline启动时预先导入并配置 genai，首批AI请求不再承担导入与配置的开销"""
+    get_gemini_model()
+
+def call_gemini_api(prompt: str, retries: int = MAX_RETRIES) -> Dict[str, Any]:
+    """调用Gemini API（需要google-generativeai库；模型客户端按线程缓存）"""
+    model = get_gemini_model()
+    ai_call = AICall("gemini", GEMINI_MODEL)
+    
+    def send() -> Dict[str, Any]:
+        reserved = ai_rate_limiter.acquire(estimate_request_tokens(prompt))
+        ai_call.http_status = None
+        with ai_concurrency.call():
+            try:
+                response = model.generate_content(
+                    prompt,
+                    generation_config={
+                        "response_mime_type": "application/json",
+                    }
+                )
+            except Exception as e:
+                code = getattr(e, "code", None)  # google.api_core 异常的 code 是HTTP状态码
+                ai_call.http_status = code if isinstance(code, int) else None
+                raise
+        ai_call.http_status = 200
+        usage = getattr(response, "usage_metadata", None)
+        ai_rate_limiter.settle(reserved, getattr(usage, "total_token_count", None))
+        ai_call.input_tokens = getattr(usage, "prompt_token_count", None)
+        ai_call.output_tokens = getattr(usage, "candidates_token_count", None)
+        return json.loads(_strip_json_fence(response.text))
+    
+    with ai_call_log.track(ai_call):
+        return call_with_retries(send, retries, ai_call)
+
+# ==================== AI响应缓存 ====================
+
+class AIResponseCache:
+    """
+    AI原始响应缓存（SQLite），键为 hash(模型 + 提示词)
+    
+    写入的是校验之前的模型输出；调用方校验或保存失败时用 discard 删除该条，下次运行重新调用API，而不是反复命中同一个坏响应。
+    超过 max_age_days 的记录与超出 max_mb 的最旧记录在打开时及每写入 EVICT_EVERY 条后清理。
+    未调用 open() 时缓存关闭，get 总是未命中。
+    """
+    
+    EVICT_EVERY = 500
+    
+    def __init__(self, max_mb: float = AI_CACHE_MAX_MB, max_age_days: float = AI_CACHE_MAX_AGE_DAYS):
+        self.max_mb = max_mb
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+        self._puts = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self._conn is not None
+    
+    def open(self, cache_path: Path):
+        self.close()
+        conn = connect_state_db(cache_path, check_same_thread=False)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ai_responses (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_responses_created ON ai_responses(created_at)")
+        conn.commit()
+        with self._lock:
+            self._conn = conn
+            self.hits = self.misses = self._puts = 0
+        self.evict()
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+    
+    def get(self, model: str, prompt: str) -> Optional[Dict[str, Any]]:
+        found = self.lookup([model], prompt)
+        return found[1] if found else None
+    
+    def lookup(self, models: List[str], prompt: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """按顺序查找任一模型对该提示词的缓存响应，返回 (模型, 响应)；只计一次命中或未命中"""
+        if self._conn is None:
+            return None
+        min_created = time.time() - self.max_age_days * 86400
+        with self._lock:
+            if self._conn is None:
+                return None
+            for model in models:
+                row = self._conn.execute(
+                    "SELECT response FROM ai_responses WHERE cache_key = ? AND created_at >= ?",
+                    (self.key(model, prompt), min_created)
+                ).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    return model, json.loads(row[0])
+            self.misses += 1
+        return None
+    
+    def put(self, model: str, prompt: str, response: Dict[str, Any]):
+        if self._conn is None:
+            return
+        payload = json.dumps(response, ensure_ascii=False)
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ai_responses (cache_key, model, response, created_at) VALUES (?, ?, ?, ?)",
+                (self.key(model, prompt), model, payload, time.time())
+            )
+            self._conn.commit()
+            self._puts += 1
+            evict = self._puts % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+    
+    def discard(self, model: str, prompt: str) -> bool:
+        """删除该模型对该提示词的缓存响应（未被接受的响应不再命中）；返回是否删除了记录"""
+        with self._lock:
+            if self._conn is None:
+                return False
+            removed = self._conn.execute("DELETE FROM ai_responses WHERE cache_key = ?",
+                                         (self.key(model, prompt),)).rowcount
+            self._conn.commit()
+            return removed > 0
+    
+    def evict(self) -> int:
+        """删除过期记录，并从最旧的开始删除直到总大小不超过 max_mb；返回删除条数"""
+        with self._lock:
+            if self._conn is None:
+                return 0
+            conn = self._conn
+            removed = conn.execute("DELETE FROM ai_responses WHERE created_at < ?",
+                                   (time.time() - self.max_age_days * 86400,)).rowcount
+            max_bytes = int(self.max_mb * 1024 * 1024)
+            total = conn.execute("SELECT COALESCE(SUM(LENGTH(CAST(response AS BLOB))), 0) FROM ai_responses").fetchone()[0]
+            if total > max_bytes:
+                excess = total - max_bytes
+                keys = []
+                for cache_key, size in conn.execute(
+                    "SELECT cache_key, LENGTH(CAST(response AS BLOB)) FROM ai_responses ORDER BY created_at"
+                ):
+                    keys.append((cache_key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                conn.executemany("DELETE FROM ai_responses WHERE cache_key = ?", keys)
+                removed += len(keys)
+            conn.commit()
+            return removed
+
+ai_response_cache = AIResponseCache()
+
+# ==================== AI调用录制与回放 ====================
+
+class CassetteMissError(Exception):
+    """回放模式下，录制文件中没有该提示词的响应"""
+
+class AICassette:
+    """
+    AI调用的录制/回放文件（JSON Lines，每行一次调用）
+
+    录制（--record）：每次实际调用AI后追加一行 {"key": 提示词sha256, "model", "response", "latency"}，
+    latency 为该次调用的耗时（含重试）；每行写完即 flush，中断的运行也能保留已录制的部分。
+    回放（--replay）：按提示词hash返回录制的模型与响应，按原始耗时等待（zero_latency=True 时不等待），
+    不需要API Key，也不访问网络，用于在真实数据上测量AI之后各阶段（校验、写文件、导入）的耗时。
+    同一提示词录制多次时以最后一次为准。
+    """
+    
+    def __init__(self):
+        self.mode: Optional[str] = None  # None / "record" / "replay"
+        self.path: Optional[Path] = None
+        self.zero_latency = False
+        self.recorded = 0
+        self.replayed = 0
+        self.missed = 0
+        self._entries: Dict[str, Tuple[str, Dict[str, Any], float]] = {}
+        self._file = None
+        self._lock = Lock()
+    
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+    
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+    
+    @staticmethod
+    def key(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    
+    def open_record(self, path: Path):
+        self.close()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._file = path.open("a", encoding="utf-8")
+            self.mode, self.path = "record", path
+    
+    def open_replay(self, path: Path, zero_latency: bool = False):
+        """加载录制文件；无法解析的行（例如录制中断时写了一半的最后一行）被跳过"""
+        self.close()
+        entries = {}
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entries[entry["key"]] = (entry["model"], entry["response"], float(entry.get("latency") or 0.0))
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    continue
+        with self._lock:
+            self._entries = entries
+            self.mode, self.path, self.zero_latency = "replay", path, zero_latency
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.mode = None
+            self._entries = {}
+            self.recorded = self.replayed = self.missed = 0
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def record(self, prompt: str, model: str, response: Dict[str, Any], latency: float):
+        if not self.recording:
+            return
+        line = json.dumps({"key": self.key(prompt), "model": model, "response": response,
+                           "latency": round(latency, 4)}, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.recorded += 1
+    
+    def replay(self, prompt: str) -> Tuple[str, Dict[str, Any], float]:
+        """返回 (模型, 响应, 应等待的秒数)；响应是副本，调用方可以修改；没有录制时抛出 CassetteMissError"""
+        key = self.key(prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.missed += 1
+            else:
+                self.replayed += 1
+        if entry is None:
+            raise CassetteMissError(f"录制文件中没有该提示词的响应（prompt sha256: {key[:12]}...）")
+        model, response, latency = entry
+        return model, json.loads(json.dumps(response)), 0.0 if self.zero_latency else latency
+    
+    def summary(self) -> str:
+        if self.recording:
+            return f"录制 {self.recorded} 次调用 → {self.path}"
+        latency = "不等待" if self.zero_latency else "按原始耗时"
+        return f"回放 {self.replayed} 次（{latency}），未录制 {self.missed} 次（{self.path}）"
+
+ai_cassette = AICassette()
+
+# ==================== 多服务商路由 ====================
+
+class ProviderStats:
+    """单个服务商的观测数据：延迟与错误率的指数滑动平均，以及最近的成功延迟样本（用于对冲截止时间）"""
+    
+    ALPHA = 0.2
+    
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples: "deque[float]" = deque(maxlen=200)
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0  # 作为对冲请求被发出的次数
+        self.wins = 0    # 对冲请求先于主请求返回的次数
+    
+    def record(self, latency: float, ok: bool):
+        self.calls += 1
+        self.error_rate += self.ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.samples.append(latency)
+            self.latency = latency if self.latency is None else self.latency + self.ALPHA * (latency - self.latency)
+        else:
+            self.errors += 1
+    
+    def weight(self, default_latency: float) -> float:
+        """流量权重：成功率 / 延迟（错误率再高也保留少量流量，以便恢复后重新被观测到）"""
+        latency = self.latency if self.latency is not None else default_latency
+        return max(0.05, 1.0 - self.error_rate) / max(latency, 0.01)
+    
+    def deadline(self, quantile: float, min_samples: int) -> Optional[float]:
+        if len(self.samples) < min_samples:
+            return None
+        return _percentile(list(self.samples), quantile)
+
+class AIRouter:
+    """
+    多服务商路由：按观测到的延迟与错误率加权选择服务商
+    
+    请求超过所选服务商的 p95 延迟（AI_HEDGE_QUANTILE）仍未返回时，向另一个服务商发送对冲请求，取先成功的结果；
+    请求出错时立即改用另一个服务商。落后的请求在后台继续完成，只用于更新统计。
+    providers 为 {名称: (模型名, call(prompt) -> 响应)}，少于两个服务商时不启用。
+    """
+    
+    def __init__(self, quantile: float = AI_HEDGE_QUANTILE, min_samples: int = AI_HEDGE_MIN_SAMPLES):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.providers: Dict[str, Tuple[str, Any]] = {}
+        self.stats: Dict[str, ProviderStats] = {}
+        self._lock = Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+    
+    def configure(self, providers: Dict[str, Tuple[str, Any]], max_workers: int = AI_MAX_CONCURRENCY * 2):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self.providers = dict(providers)
+            self.stats = {name: ProviderStats() for name in providers}
+            self._executor = ThreadPoolExecutor(max_workers=max(2, max_workers), thread_name_prefix="ai-router") \
+                if len(providers) > 1 else None
+    
+    @property
+    def enabled(self) -> bool:
+        return len(self.providers) > 1
+    
+    def models(self) -> List[str]:
+        return [model for model, _ in self.providers.values()]
+    
+    def choose(self, exclude: Tuple[str, ...] = ()) -> Optional[str]:
+        """按权重随机选择一个服务商；没有可选的服务商时返回 None"""
+        with self._lock:
+            names = [name for name in self.providers if name not in exclude]
+            if not names:
+                return None
+            # 优先选择未熔断的服务商（都熔断时仍按权重选择，由熔断器决定等待或快速失败）
+            names = [name for name in names if not ai_circuits.is_open(name)] or names
+            observed = [self.stats[name].latency for name in names if self.stats[name].latency is not None]
+            default_latency = sum(observed) / len(observed) if observed else 1.0
+            weights = [self.stats[name].weight(default_latency) for name in names]
+        return random.choices(names, weights=weights)[0]
+    
+    def _submit(self, name: str, prompt: str):
+        started = time.monotonic()
+        # 在调用方的上下文中执行，AI调用记录能对应到当前文件
+        future = self._executor.submit(contextvars.copy_context().run, self.providers[name][1], prompt)
+        
+        def record(done):
+            with self._lock:
+                self.stats[name].record(time.monotonic() - started, done.exception() is None)
+        future.add_done_callback(record)
+        return future
+    
+    def call(self, prompt: str) -> Tuple[str, Dict[str, Any]]:
+        """调用AI，返回 (实际给出结果的模型名, 响应)；所有尝试都失败时抛出第一个错误"""
+        primary = self.choose()
+        used = [primary]
+        futures = {self._submit(primary, prompt): primary}
+        with self._lock:
+            hedge_at = self.stats[primary].deadline(self.quantile, self.min_samples)
+        errors: List[BaseException] = []
+        while True:
+            done, _ = wait(list(futures), timeout=hedge_at, return_when=FIRST_COMPLETED)
+            hedge_at = None  # 每次调用最多再发一个请求（对冲或失败转移）
+            for future in done:
+                name = futures.pop(future)
+                if future.exception() is None:
+                    if name != primary:
+                        with self._lock:
+                            self.stats[name].wins += 1
+                    return self.providers[name][0], future.result()
+                errors.append(future.exception())
+            if not done or not futures:
+                alternative = self.choose(exclude=tuple(used))
+                if alternative is not None and len(used) == 1:
+                    used.append(alternative)
+                    if not done:
+                        with self._lock:
+                            self.stats[alternative].hedges += 1
+                    futures[self._submit(alternative, prompt)] = alternative
+            if not futures:
+                raise errors[0]
+    
+    def summary(self) -> List[str]:
+        with self._lock:
+            return [f"{name}: {st.calls} 次请求, 失败 {st.errors} 次, 延迟 p50 {_percentile(list(st.samples), 0.5):.2f}s, "
+                    f"对冲 {st.hedges} 次（先返回 {st.wins} 次）"
+                    for name, st in self.stats.items()]
+
+ai_router = AIRouter()
+
+def configured_providers(names: List[str]) -> Dict[str, Tuple[str, Any]]:
+    """把服务商名称（qwen / gemini）解析为路由使用的 (模型名, 调用函数)，跳过未配置Key的服务商"""
+    providers = {}
+    for name in names:
+        if name == "qwen" and QWEN_API_KEY:
+            providers[name] = (QWEN_MODEL, call_qwen_api)
+        elif name == "gemini" and GEMINI_API_KEY:
+            providers[name] = (GEMINI_MODEL, call_gemini_api)
+        else:
+            print(f"⚠️  服务商 {name} 未配置API Key或不受支持，已忽略")
+    return providers
+
+# ==================== AI调用入口 ====================
+
+def ai_model_name() -> str:
+    return QWEN_MODEL if AI_TYPE == "qwen" else GEMINI_MODEL
+
+def call_ai(prompt: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    调用当前配置的AI（先查响应缓存；启用多服务商路由时由 ai_router 选择服务商）
+    
+    返回 (实际给出结果的模型名, 响应)：多服务商路由、缓存与回放时模型因请求而异，由调用方显式传给保存结果的步骤。
+    回放模式下直接返回录制的响应（不查缓存、不访问网络）；录制模式下记录每次实际调用的响应与耗时。
+    """
+    if ai_cassette.replaying:
+        model, processed, delay = ai_cassette.replay(prompt)
+        time.sleep(delay)
+        return model, processed
+    
+    models = ai_router.models() if ai_router.enabled else [ai_model_name()]
+    cached = ai_response_cache.lookup(models, prompt)
+    if cached is not None:
+        return cached
+    
+    started = time.monotonic()
+    if ai_router.enabled:
+        model, processed = ai_router.call(prompt)
+    elif AI_TYPE == "qwen":
+        model, processed = QWEN_MODEL, call_qwen_api(prompt)
+    elif AI_TYPE == "gemini":
+        model, processed = GEMINI_MODEL, call_gemini_api(prompt)
+    else:
+        raise RuntimeError("AI API未配置")
+    
+    ai_cassette.record(prompt, model, processed, time.monotonic() - started)
+    ai_response_cache.put(model, prompt, processed)
+    return model, processed
+
+async def call_ai_async(session: "aiohttp.ClientSession", prompt: str) -> Tuple[str, Dict[str, Any]]:
+    """call_ai 的 asyncio 版本（仅Qwen），同样返回 (模型名, 响应)：同一线程上的并发任务不共享任何“最近一次”的状态"""
+    if ai_cassette.replaying:
+        model, processed, delay = ai_cassette.replay(prompt)
+        await asyncio.sleep(delay)
+        return model, processed
+    
+    cached = ai_response_cache.get(QWEN_MODEL, prompt)
+    if cached is not None:
+        return QWEN_MODEL, cached
+    started = time.monotonic()
+    processed = await call_qwen_api_async(session, prompt)
+    ai_cassette.record(prompt, QWEN_MODEL, processed, time.monotonic() - started)
+    ai_response_cache.put(QWEN_MODEL, prompt, processed)
+    return QWEN_MODEL, processed
+
+def process_with_ai(raw_data: Dict[str, Any], prompt: Optional[str] = None) -> Dict[str, Any]:
+    """使用AI清洗raw数据为final格式（prompt 可由CPU阶段预先构建）"""
+    if prompt is None:
+        prompt = build_prompt(raw_data.get("title", ""), raw_data.get("originalContentText", ""))
+    
+    model, processed = call_ai(prompt)
+    try:
+        return build_final_data(raw_data, processed)
+    except Exception:
+        ai_response_cache.discard(model, prompt)  # 校验失败的响应不留在缓存中，重试时重新调用API
+        raise
+
+_tag_tools: Optional[Tuple["TagValidator", Optional["TagExtractor"]]] = None
+_tag_tools_lock = Lock()
+
+def tag_tools() -> Tuple["TagValidator", Optional["TagExtractor"]]:
+    """进程内共用的 TagValidator 与 TagExtractor（只加载一次配置；TagExtractor 不可用时为 None）"""
+    global _tag_tools
+    if _tag_tools is None:
+        with _tag_tools_lock:
+            if _tag_tools is None:
+                tag_extractor = None
+                if TAG_EXTRACTOR_AVAILABLE:
+                    try:
+                        tag_extractor = TagExtractor()
+                    except Exception as e:
+                        print(f"⚠️  TagExtractor初始化失败，将跳过标签规范化: {e}")
+                _tag_tools = (TagValidator(), tag_extractor)
+    return _tag_tools
+
+def build_final_data(raw_data: Dict[str, Any], processed: Dict[str, Any]) -> Dict[str, Any]:
+    """校验并规范化AI返回结果，构建final payload"""
+    # 验证必需字段
+    required_fields = ["title", "processedContent", "company", "role", "difficulty", "tags", "tagDimensions"]
+    missing = [f for f in required_fields if f not in processed]
+    if missing:
+        raise ValueError(f"AI返回缺少必需字段: {missing}")
+    
+    # 标签验证器（必需）与 TagExtractor（如果可用，用于公司名称和地点规范化），每个进程只初始化一次
+    validator, tag_extractor = tag_tools()
+    
+    # 验证 tagDimensions 结构
+    tag_dims = processed.get("tagDimensions", {})
+    required_dims = ["technologies", "recruitType", "location", "category", "experience", "salary", "custom"]
+    missing_dims = [d for d in required_dims if d not in tag_dims]
+    if missing_dims:
+        raise ValueError(f"tagDimensions 缺少必需字段: {missing_dims}")
+    
+    # 提取并规范化 tagDimensions
+    tag_dimensions = {
+        "technologies": list(tag_dims.get("technologies", [])) if isinstance(tag_dims.get("technologies"), list) else [],
+        "recruitType": str(tag_dims.get("recruitType", "")).strip() or "",
+        "location": str(tag_dims.get("location", "")).strip() or "",
+        "category": str(tag_dims.get("category", "")).strip() or "Other",
+        "experience": str(tag_dims.get("experience", "")).strip() or "",
+        "salary": str(tag_dims.get("salary", "")).strip() or "",
+        "custom": list(tag_dims.get("custom", [])) if isinstance(tag_dims.get("custom"), list) else []
+    }
+    
+    # 使用验证器规范化标签值（关键：将中文转换为英文标准值）
+    tag_dimensions["category"] = validator.normalize_value("category", tag_dimensions["category"]) or "Other"
+    if tag_dimensions["recruitType"]:
+        tag_dimensions["recruitType"] = validator.normalize_value("recruitType", tag_dimensions["recruitType"]) or ""
+    if tag_dimensions["experience"]:
+        tag_dimensions["experience"] = validator.normalize_value("experience", tag_dimensions["experience"]) or ""
+    if tag_dimensions["salary"]:
+        tag_dimensions["salary"] = validator.normalize_value("salary", tag_dimensions["salary"]) or ""
+    
+    # 使用 TagExtractor 规范化公司名称和地点（如果可用）
+    if tag_extractor:
+        try:
+            # 规范化公司名称
+            if processed.get("company"):
+                normalized_company = tag_extractor._normalize_value(processed["company"], "company")
+                if normalized_company:
+                    processed["company"] = normalized_company
+            
+            # 规范化地点
+            if tag_dimensions["location"]:
+                normalized_location = tag_extractor._normalize_value(tag_dimensions["location"], "location")
+                if normalized_location:
+                    tag_dimensions["location"] = normalized_location
+        except Exception as e:
+            print(f"⚠️  标签规范化过程中出错: {e}")
+    
+    # 使用验证器验证 tagDimensions（确保符合规范）
+    is_valid, errors, warnings = validator.validate_tag_dimensions(tag_dimensions)
+    if not is_valid:
+        error_msg = f"tagDimensions 验证失败: {', '.join(errors)}"
+        print(f"❌ {error_msg}")
+        raise ValueError(error_msg)
+    
+    # 输出警告（如果有）
+    if warnings:
+        for warning in warnings:
+            print(f"⚠️  {warning}")
+    
+    # 构建final payload
+    return {
+        "title": processed["title"],
+        "originalContent": raw_data.get("originalContentHtml", ""),
+        "processedContent": processed["processedContent"],
+        "company": processed["company"],
+        "role": processed["role"],
+        "difficulty": int(processed["difficulty"]),
+        "tags": list(processed["tags"]),  # 保留向后兼容
+        "tagDimensions": tag_dimensions,  # 新增结构化标签
+        "comments": [],
+        "usefulVotes": 0,
+        "uselessVotes": 0,
+        "shareCount": 0,
+        "isAnonymous": True
+    }
+
+# ==================== HTML解析 ====================
+
+def _parse_html_bs4(raw_html: str) -> Dict[str, str]:
+    """BeautifulSoup 解析路径（快速通道不适用时的回退）"""
+    soup = BeautifulSoup(raw_html, "lxml")
+    
+    # 移除anti-crawling元素
     for node in soup.select(".jammer"):
         node.decompose()
     
@@ -350,24 +1993,188 @@ def parse_html(html_path: Path) -> Dict[str, Any]:
     
     body_text = BeautifulSoup(body_html, "lxml").get_text("\n", strip=True)
     
-    # 提取ID
-    m = re.search(r"(\d+)", html_path.name)
-    post_id = m.group(1) if m else html_path.stem
-    
     return {
-        "id": post_id,
-        "sourceFile": html_path.name,
         "title": title,
         "publishTimeRaw": publish_time_raw,
         "originalContentHtml": body_html,
         "originalContentText": body_text,
     }
 
+def _parse_html_fields(raw_html: str, engine: str = HTML_PARSER) -> Dict[str, str]:
+    """从HTML文本中提取与文件名无关的字段（可按content_hash缓存）"""
+    fields = parse_html_fast(raw_html) if engine == "lxml" else None
+    if fields is None:
+        fields = _parse_html_bs4(raw_html)
+    return fields
+
+def file_id_for(html_path: Path) -> str:
+    """从文件名提取帖子ID（也是final JSON的文件名）"""
+    m = re.search(r"(\d+)", html_path.name)
+    return m.group(1) if m else html_path.stem
+
+def _build_raw_data(html_path: Path, fields: Dict[str, str]) -> Dict[str, Any]:
+    """组合文件名相关字段（id、sourceFile）与解析字段"""
+    return {
+        "id": file_id_for(html_path),
+        "sourceFile": html_path.name,
+        "title": fields["title"],
+        "publishTimeRaw": fields["publishTimeRaw"],
+        "originalContentHtml": fields["originalContentHtml"],
+        "originalContentText": fields["originalContentText"],
+    }
+
+def parse_html(html_path: Path, engine: str = HTML_PARSER) -> Dict[str, Any]:
+    """解析单个HTML文件为raw JSON（engine: lxml 单次解析快速通道 / bs4）"""
+    raw_html = html_path.read_text(encoding="utf-8", errors="ignore")
+    return _build_raw_data(html_path, _parse_html_fields(raw_html, engine))
+
+# ==================== 输入读取（单次读取）====================
+
+MMAP_THRESHOLD = 1 << 20  # 大于1MB的文件使用mmap，小文件直接读取更快
+
+def new_hasher(algo: str = HASH_ALGO):
+    """创建内容hash对象（blake2b 取32字节摘要，与sha256长度一致）"""
+    if algo == "sha256":
+        return hashlib.sha256()
+    if algo == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    raise ValueError(f"不支持的hash算法: {algo}（可选: sha256, blake2b）")
+
+class HtmlInput:
+    """
+    单次读取的HTML输入：同一份缓冲区同时用于计算hash和解析
+    
+    用法：
+        with HtmlInput(path) as source:
+            content_hash = source.hash()
+            raw_html = source.text()
+    """
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.buffer = b""
+        self._file = None
+        self._mmap = None
+    
+    def __enter__(self) -> "HtmlInput":
+        f = open(self.path, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._file = f
+                self.buffer = self._mmap
+            else:
+                self.buffer = f.read()
+                f.close()
+        except Exception:
+            f.close()
+            raise
+        return self
+    
+    def __exit__(self, *exc):
+        self.buffer = b""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def hash(self, algo: str = HASH_ALGO) -> str:
+        hasher = new_hasher(algo)
+        hasher.update(self.buffer)
+        return hasher.hexdigest()
+    
+    def text(self) -> str:
+        """解码为文本，与 Path.read_text(encoding="utf-8", errors="ignore") 一致（含换行符转换）"""
+        text = str(self.buffer, "utf-8", "ignore")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
+
+# ==================== Raw JSON 存储 ====================
+
+RAW_FORMAT_VERSION = 1  # 解析逻辑变化导致字段不同时递增，旧记录会被重新解析
+
+def raw_store_path(raw_dir: Path, content_hash: str) -> Path:
+    """raw记录路径：按hash前两位分目录，避免单目录文件过多"""
+    return raw_dir / content_hash[:2] / f"{content_hash}.json.gz"
+
+def load_raw_fields(raw_dir: Path, content_hash: str) -> Optional[Dict[str, str]]:
+    """读取已保存的解析结果；不存在、损坏或版本不符时返回None"""
+    try:
+        with gzip.open(raw_store_path(raw_dir, content_hash), "rt", encoding="utf-8") as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError):
+        return None  # 文件损坏，重新解析
+    if record.get("v") != RAW_FORMAT_VERSION:
+        return None
+    return record.get("fields")
+
+def save_raw_fields(raw_dir: Path, content_hash: str, fields: Dict[str, str]):
+    """保存解析结果（紧凑JSON + gzip，先写临时文件再原子替换）"""
+    path = raw_store_path(raw_dir, content_hash)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    payload = json.dumps({"v": RAW_FORMAT_VERSION, "fields": fields}, ensure_ascii=False, separators=(",", ":"))
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+def parse_html_cached(html_path: Path, raw_dir: Path, content_hash: Optional[str] = None,
+                      source: Optional["HtmlInput"] = None) -> Dict[str, Any]:
+    """
+    优先从raw存储读取解析结果，未命中时解析HTML并写入存储
+    
+    已知 content_hash 且命中时完全不读取HTML文件；
+    传入已打开的 source 时复用其缓冲区，不再重复读取文件。
+    """
+    fields = load_raw_fields(raw_dir, content_hash) if content_hash else None
+    if fields is not None:
+        return _build_raw_data(html_path, fields)
+    if source is None:
+        with HtmlInput(html_path) as source:
+            return parse_html_cached(html_path, raw_dir, content_hash or source.hash(), source)
+    if content_hash is None:
+        content_hash = source.hash()
+        fields = load_raw_fields(raw_dir, content_hash)
+    if fields is None:
+        fields = _parse_html_fields(source.text())
+        try:
+            save_raw_fields(raw_dir, content_hash, fields)
+        except OSError as e:
+            print(f"⚠️  raw JSON 保存失败（不影响本次处理）: {e}")
+    return _build_raw_data(html_path, fields)
+
 # ==================== 状态管理（幂等去重）====================
 
+def connect_state_db(state_db_path: Path, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    打开状态数据库连接
+    
+    使用 WAL 模式：读者不阻塞写者，提交只追加WAL，无需每次重写回滚日志；
+    synchronous=NORMAL 在 WAL 下只在检查点时 fsync，断电最多丢失最近的提交（final文件仍在，下次运行会补记）。
+    """
+    conn = sqlite3.connect(str(state_db_path), timeout=30, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+# final 文件指纹：大小、修改时间、内容校验和，以及 processedContent 是否通过质量检查
+FINGERPRINT_COLUMNS = [
+    ("final_size", "INTEGER"),
+    ("final_mtime_ns", "INTEGER"),
+    ("final_checksum", "TEXT"),
+    ("quality_ok", "INTEGER"),
+]
+FINAL_CHECKSUM_ALGO = "blake2b"  # 只用于判断final文件是否被改动，与内容hash算法无关
+
 def init_state_db(state_db_path: Path) -> sqlite3.Connection:
     """初始化状态数据库"""
-    conn = sqlite3.connect(str(state_db_path))
+    conn = connect_state_db(state_db_path)
     conn.execute("""
         CREATE TABLE IF NOT EXISTS processing_state (
             content_hash TEXT PRIMARY KEY,
@@ -378,14 +2185,237 @@ def init_state_db(state_db_path: Path) -> sqlite3.Connection:
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    # 旧库补齐 final 文件指纹列（ALTER TABLE 只追加列，已有记录的指纹为 NULL，下次运行时全量校验一次后补记）
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(processing_state)")}
+    for column, column_type in FINGERPRINT_COLUMNS:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE processing_state ADD COLUMN {column} {column_type}")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON processing_state(status)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS input_manifest (
+            path TEXT PRIMARY KEY,
+            inode INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            content_hash TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS content_simhash (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT,
+            simhash INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS near_duplicates (
+            content_hash TEXT PRIMARY KEY,
+            canonical_hash TEXT NOT NULL,
+            distance INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS prompt_metrics (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT,
+            model TEXT,
+            content_tokens INTEGER,
+            compact_tokens INTEGER,
+            prompt_tokens INTEGER,
+            truncated INTEGER,
+            ai_seconds REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at REAL NOT NULL,
+            content_hash TEXT,
+            posts INTEGER NOT NULL DEFAULT 1,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            latency REAL NOT NULL,
+            input_tokens INTEGER,
+            output_tokens INTEGER,
+            http_status INTEGER,
+            ok INTEGER NOT NULL,
+            error TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_calls_started ON ai_calls(started_at)")
     conn.commit()
     return conn
 
-def compute_content_hash(html_path: Path) -> str:
+def compute_content_hash(html_path: Path, algo: str = HASH_ALGO) -> str:
     """计算HTML文件内容hash（用于去重）"""
-    content = html_path.read_bytes()
-    return hashlib.sha256(content).hexdigest()
+    with HtmlInput(html_path) as source:
+        return source.hash(algo)
+
+def get_meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM pipeline_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(conn: sqlite3.Connection, key: str, value: str):
+    conn.execute("INSERT OR REPLACE INTO pipeline_meta (key, value) VALUES (?, ?)", (key, value))
+    conn.commit()
+
+def check_hash_algo(conn: sqlite3.Connection, algo: str = HASH_ALGO) -> Tuple[bool, str]:
+    """确认状态库中的hash算法与当前配置一致（旧库没有记录时视为sha256）"""
+    new_hasher(algo)  # 校验算法名
+    stored = get_meta(conn, "hash_algo")
+    if stored is None:
+        has_rows = conn.execute("SELECT 1 FROM processing_state LIMIT 1").fetchone() is not None
+        stored = "sha256" if has_rows else algo
+        set_meta(conn, "hash_algo", stored)
+    if stored != algo:
+        return False, (f"状态数据库使用 {stored} 计算hash，当前配置为 {algo}。"
+                       f"请先运行: python pipeline.py migrate-hash --html-dir <HTML目录> --out-dir <输出目录> --to {algo}")
+    return True, stored
+
+# ==================== 输入manifest（按stat跳过重新hash）====================
+
+MANIFEST_RACY_WINDOW_NS = 2 * 10**9  # 修改时间距今不足2秒的文件不写入manifest（同一时间粒度内可能再次被修改）
+
+def manifest_row(html_path: Path, st: os.stat_result, content_hash: str) -> Tuple[str, int, int, int, str]:
+    return (os.path.abspath(html_path), st.st_ino, st.st_size, st.st_mtime_ns, content_hash)
+
+def save_manifest(conn: sqlite3.Connection, rows: List[Tuple[str, int, int, int, str]], commit: bool = True):
+    conn.executemany("""
+        INSERT OR REPLACE INTO input_manifest (path, inode, size, mtime_ns, content_hash)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+    if commit:
+        conn.commit()
+
+def lookup_manifest(conn: sqlite3.Connection, paths: List[str]) -> Dict[str, Tuple[int, int, int, str]]:
+    """批量查询manifest：path → (inode, size, mtime_ns, content_hash)"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS plan_paths (path TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM plan_paths")
+    conn.executemany("INSERT OR IGNORE INTO plan_paths (path) VALUES (?)", ((p,) for p in paths))
+    rows = conn.execute("""
+        SELECT m.path, m.inode, m.size, m.mtime_ns, m.content_hash
+        FROM input_manifest m JOIN plan_paths p ON p.path = m.path
+    """).fetchall()
+    conn.execute("DROP TABLE plan_paths")
+    conn.commit()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+def hash_inputs(html_files: List[Path], conn: sqlite3.Connection, pool: ProcessPoolExecutor,
+                hash_algo: str = HASH_ALGO, paranoid: bool = False) -> Tuple[List[str], int]:
+    """
+    计算所有输入文件的内容hash
+    
+    与 make/rsync 的 quick-check 相同：(inode, size, mtime_ns) 与manifest记录一致时直接使用记录的hash，
+    只有stat签名变化的文件才在进程池中重新读取计算。paranoid=True 时全部重新计算。
+    
+    Returns:
+        (与 html_files 一一对应的hash列表, 重新计算hash的文件数)
+    """
+    stats = [os.stat(p) for p in html_files]
+    known = {} if paranoid else lookup_manifest(conn, [os.path.abspath(p) for p in html_files])
+    
+    hashes: List[Optional[str]] = [None] * len(html_files)
+    todo: List[int] = []
+    for i, (html_path, st) in enumerate(zip(html_files, stats)):
+        row = known.get(os.path.abspath(html_path))
+        if row is not None and row[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+            hashes[i] = row[3]
+        else:
+            todo.append(i)
+    
+    if todo:
+        chunksize = max(1, min(256, len(todo) // (PARSE_WORKERS * 8)))
+        paths = [html_files[i] for i in todo]
+        for i, content_hash in zip(todo, pool.map(compute_content_hash, paths, [hash_algo] * len(todo), chunksize=chunksize)):
+            hashes[i] = content_hash
+        now_ns = time.time_ns()
+        save_manifest(conn, [manifest_row(html_files[i], stats[i], hashes[i]) for i in todo
+                             if now_ns - stats[i].st_mtime_ns > MANIFEST_RACY_WINDOW_NS])
+    return hashes, len(todo)
+
+# 以 content_hash 关联输入文件的列：切换hash算法时在同一事务中全部更新
+HASH_KEYED_COLUMNS = [
+    ("processing_state", "content_hash"),
+    ("content_simhash", "content_hash"),
+    ("near_duplicates", "content_hash"),
+    ("near_duplicates", "canonical_hash"),
+    ("prompt_metrics", "content_hash"),
+    ("ai_calls", "content_hash"),
+]
+
+def migrate_hash_algo(html_dir: Path, out_dir: Path, to_algo: str):
+    """
+    迁移状态库与raw存储到新的hash算法
+    
+    对 html_dir 中的每个文件同时计算旧/新hash（单次读取），
+    然后在一个事务中更新所有以 content_hash 为键的表（HASH_KEYED_COLUMNS）并重命名 raw 记录。
+    """
+    new_hasher(to_algo)
+    state_db_path = out_dir / "state.sqlite"
+    if not state_db_path.exists():
+        print(f"❌ 状态数据库不存在: {state_db_path}")
+        return
+    conn = init_state_db(state_db_path)
+    raw_dir = out_dir / "raw"
+    from_algo = get_meta(conn, "hash_algo") or "sha256"
+    if from_algo == to_algo:
+        print(f"✅ 状态数据库已使用 {to_algo}，无需迁移")
+        conn.close()
+        return
+    
+    print(f"🔄 迁移hash算法: {from_algo} → {to_algo}")
+    mapping: Dict[str, str] = {}
+    manifest_rows = []
+    now_ns = time.time_ns()
+    for html_path in sorted(html_dir.glob("*.html")):
+        st = os.stat(html_path)
+        with HtmlInput(html_path) as source:
+            new_hash = mapping[source.hash(from_algo)] = source.hash(to_algo)
+        if now_ns - st.st_mtime_ns > MANIFEST_RACY_WINDOW_NS:
+            manifest_rows.append(manifest_row(html_path, st, new_hash))
+    
+    with conn:
+        updated = 0
+        for old_hash, new_hash in mapping.items():
+            for table, column in HASH_KEYED_COLUMNS:
+                rowcount = conn.execute(f"UPDATE {table} SET {column} = ? WHERE {column} = ?",
+                                        (new_hash, old_hash)).rowcount
+                if table == "processing_state":
+                    updated += rowcount
+        # manifest 按本次扫描重建，不在 html_dir 中的文件下次运行时重新计算
+        conn.execute("DELETE FROM input_manifest")
+        save_manifest(conn, manifest_rows, commit=False)
+        conn.execute("INSERT OR REPLACE INTO pipeline_meta (key, value) VALUES ('hash_algo', ?)", (to_algo,))
+    total = conn.execute("SELECT COUNT(*) FROM processing_state").fetchone()[0]
+    conn.close()
+    
+    renamed = 0
+    for old_hash, new_hash in mapping.items():
+        old_path = raw_store_path(raw_dir, old_hash)
+        if old_path.exists():
+            new_path = raw_store_path(raw_dir, new_hash)
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(old_path, new_path)
+            renamed += 1
+            try:
+                old_path.parent.rmdir()  # 只删除已空的分片目录
+            except OSError:
+                pass
+    
+    print(f"   扫描HTML文件: {len(mapping)} 个（去重后）")
+    print(f"   ✅ 已迁移状态记录: {updated} 条")
+    print(f"   ✅ 已迁移raw记录: {renamed} 个")
+    if total - updated:
+        print(f"   ⚠️  {total - updated} 条状态记录的输入文件不在 {html_dir} 中，未迁移（不会再被命中）")
 
 def is_content_already_processed(processed_content: str) -> bool:
     """AI检测processedContent是否已被清洗过"""
@@ -405,209 +2435,1219 @@ def is_content_already_processed(processed_content: str) -> bool:
     return has_markdown and not has_html and not has_encrypted and has_structure
 
 
-def update_state(conn: sqlite3.Connection, content_hash: str, status: str, file_id: Optional[str] = None, error_reason: Optional[str] = None):
-    """更新处理状态"""
-    conn.execute("""
+Fingerprint = Tuple[int, int, str, bool]  # (final_size, final_mtime_ns, final_checksum, quality_ok)
+StateRow = Tuple[str, str, Optional[str], Optional[str], Optional[int], Optional[int], Optional[str], Optional[int]]
+
+def final_checksum(data: bytes) -> str:
+    hasher = new_hasher(FINAL_CHECKSUM_ALGO)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+def write_final(final_path: Path, final_data: Dict[str, Any]) -> Fingerprint:
+    """保存final JSON，返回写入后文件的指纹（质量检查在内存中完成，之后跳过判定无需重新读取）"""
+    data = json.dumps(final_data, ensure_ascii=False, indent=2).encode("utf-8")
+    final_path.write_bytes(data)
+    st = final_path.stat()
+    quality_ok = is_content_already_processed(final_data.get("processedContent", ""))
+    return (st.st_size, st.st_mtime_ns, final_checksum(data), quality_ok)
+
+def state_row(content_hash: str, status: str, file_id: Optional[str] = None, error_reason: Optional[str] = None,
+              fingerprint: Optional[Fingerprint] = None) -> StateRow:
+    if fingerprint is None:
+        return (content_hash, status, file_id, error_reason, None, None, None, None)
+    size, mtime_ns, checksum, quality_ok = fingerprint
+    return (content_hash, status, file_id, error_reason, size, mtime_ns, checksum, int(quality_ok))
+
+def update_state_many(conn: sqlite3.Connection, rows: List[StateRow], commit: bool = True):
+    """批量更新处理状态（单个事务）：rows 由 state_row() 构造"""
+    if not rows:
+        return
+    conn.executemany("""
         INSERT OR REPLACE INTO processing_state 
-        (content_hash, status, file_id, error_reason, updated_at)
-        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-    """, (content_hash, status, file_id, error_reason))
+        (content_hash, status, file_id, error_reason,
+         final_size, final_mtime_ns, final_checksum, quality_ok, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    """, rows)
+    if commit:
+        conn.commit()
+
+def update_state(conn: sqlite3.Connection, content_hash: str, status: str, file_id: Optional[str] = None, error_reason: Optional[str] = None,
+                 fingerprint: Optional[Fingerprint] = None):
+    """更新处理状态"""
+    update_state_many(conn, [state_row(content_hash, status, file_id, error_reason, fingerprint)])
+
+PromptMetricsRow = Tuple[str, Optional[str], str, int, int, int, int, Optional[float]]
+
+def prompt_metrics_row(content_hash: str, file_id: Optional[str], metrics: Dict[str, Any],
+                       ai_seconds: Optional[float] = None, model: Optional[str] = None) -> PromptMetricsRow:
+    return (content_hash, file_id, model or ai_model_name(), metrics["content_tokens"], metrics["compact_tokens"],
+            metrics["prompt_tokens"], int(metrics["truncated"]), ai_seconds)
+
+def save_prompt_metrics(conn: sqlite3.Connection, rows: List[PromptMetricsRow], commit: bool = True):
+    """记录每个文件的提示词大小（原始正文/压缩后正文/完整提示词的估算token数）与AI阶段耗时"""
+    if not rows:
+        return
+    conn.executemany("""
+        INSERT OR REPLACE INTO prompt_metrics
+        (content_hash, file_id, model, content_tokens, compact_tokens, prompt_tokens, truncated, ai_seconds, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    """, rows)
+    if commit:
+        conn.commit()
+
+def save_simhash(conn: sqlite3.Connection, rows: List[Tuple[str, Optional[str], int]], commit: bool = True):
+    """记录规范结果的正文SimHash：rows 为 (content_hash, file_id, simhash)"""
+    if not rows:
+        return
+    conn.executemany("INSERT OR REPLACE INTO content_simhash (content_hash, file_id, simhash) VALUES (?, ?, ?)",
+                     [(content_hash, file_id, _signed64(simhash)) for content_hash, file_id, simhash in rows])
+    if commit:
+        conn.commit()
+
+def save_ai_calls(conn: sqlite3.Connection, rows: List[AICallRow], commit: bool = True):
+    """记录每次AI调用（含重试）的服务商、模型、尝试次数、耗时、token用量与最后一次的HTTP状态码"""
+    if not rows:
+        return
+    conn.executemany("""
+        INSERT INTO ai_calls
+        (started_at, content_hash, posts, provider, model, attempts, latency, input_tokens, output_tokens, http_status, ok, error)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    if commit:
+        conn.commit()
+
+def save_near_duplicates(conn: sqlite3.Connection, rows: List[Tuple[str, str, int]], commit: bool = True):
+    """记录近似重复关系：rows 为 (content_hash, canonical_hash, 汉明距离)"""
+    if not rows:
+        return
+    conn.executemany("""
+        INSERT OR REPLACE INTO near_duplicates (content_hash, canonical_hash, distance, created_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    """, rows)
+    if commit:
+        conn.commit()
+
+class StateWriter:
+    """
+    状态库写入线程（write-behind）
+    
+    所有线程的状态更新（以及提示词指标、SimHash、近似重复关系、AI调用记录）先进入队列，由单个写线程合并成批量事务提交：
+    达到 STATE_BATCH_SIZE 条或距上次提交超过 STATE_FLUSH_INTERVAL 秒时提交一次。
+    close() 会提交剩余的全部更新。
+    
+    数据库被锁时整批重试；其他SQLite错误（如某一行违反约束）时回滚并逐行重写，只丢弃出错的行，写线程继续运行。
+    写线程意外退出时，flush()/close() 抛出其异常，而不是静默丢弃之后的更新或永远阻塞。
+    """
+    
+    _STOP = object()
+    _WRITERS = {
+        "state": update_state_many,
+        "prompt_metrics": save_prompt_metrics,
+        "simhash": save_simhash,
+        "near_duplicate": save_near_duplicates,
+        "ai_call": save_ai_calls,
+    }
+    
+    def __init__(self, state_db_path: Path, batch_size: int = STATE_BATCH_SIZE,
+                 flush_interval: float = STATE_FLUSH_INTERVAL):
+        self.state_db_path = state_db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._error: Optional[BaseException] = None
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+        self._thread.start()
+    
+    def update(self, content_hash: str, status: str, file_id: Optional[str] = None, error_reason: Optional[str] = None,
+               fingerprint: Optional[Fingerprint] = None):
+        """提交一条状态更新（不阻塞）"""
+        self._queue.put(("state", state_row(content_hash, status, file_id, error_reason, fingerprint)))
+    
+    def record_prompt_metrics(self, row: PromptMetricsRow):
+        """提交一条提示词指标（不阻塞），与状态更新在同一事务中写入"""
+        self._queue.put(("prompt_metrics", row))
+    
+    def record_simhash(self, content_hash: str, file_id: str, simhash: int):
+        """提交规范结果的正文SimHash（不阻塞）"""
+        self._queue.put(("simhash", (content_hash, file_id, simhash)))
+    
+    def record_near_duplicate(self, content_hash: str, canonical_hash: str, distance: int):
+        """提交一条近似重复关系（不阻塞）"""
+        self._queue.put(("near_duplicate", (content_hash, canonical_hash, distance)))
+    
+    def record_ai_call(self, row: AICallRow):
+        """提交一条AI调用记录（不阻塞）"""
+        self._queue.put(("ai_call", row))
+    
+    def flush(self):
+        """阻塞直到此前提交的所有更新都已写入"""
+        done = threading.Event()
+        self._queue.put(done)
+        while not done.wait(0.5):
+            if not self._thread.is_alive():
+                break
+        self._raise_error()
+    
+    def close(self):
+        """写入剩余更新并结束写线程"""
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._raise_error()
+    
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"状态写入线程异常退出: {self._error}") from self._error
+    
+    def _commit(self, conn: sqlite3.Connection, pending: Dict[str, List[Tuple]]):
+        for attempt in range(5):
+            try:
+                for kind, rows in pending.items():
+                    self._WRITERS[kind](conn, rows, commit=False)
+                conn.commit()
+                self.written += len(pending.get("state", []))
+                return
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                if attempt == 4:
+                    total = sum(len(rows) for rows in pending.values())
+                    print(f"⚠️  状态写入失败，丢弃 {total} 条更新（final文件不受影响，下次运行会补记）: {e}")
+                    return
+                time.sleep(0.2 * (attempt + 1))
+            except sqlite3.Error:
+                conn.rollback()
+                self._commit_rows(conn, pending)
+                return
+    
+    def _commit_rows(self, conn: sqlite3.Connection, pending: Dict[str, List[Tuple]]):
+        """整批写入出错（非锁冲突）：逐行写入，跳过出错的行，其余更新照常提交"""
+        dropped = 0
+        last_error: Optional[sqlite3.Error] = None
+        for kind, rows in pending.items():
+            for row in rows:
+                try:
+                    self._WRITERS[kind](conn, [row], commit=False)
+                except sqlite3.Error as e:
+                    dropped += 1
+                    last_error = e
+                    continue
+                if kind == "state":
+                    self.written += 1
+        conn.commit()
+        if dropped:
+            print(f"⚠️  状态写入出错，丢弃 {dropped} 条无法写入的记录（其余已写入）: {last_error}")
+    
+    def _run(self):
+        conn = connect_state_db(self.state_db_path)
+        pending: Dict[str, List[Tuple]] = {}
+        count = 0
+        waiters: List[threading.Event] = []
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+        try:
+            while not stopping:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    item = None
+                if item is self._STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                elif item is not None:
+                    kind, row = item
+                    pending.setdefault(kind, []).append(row)
+                    count += 1
+                
+                if stopping or waiters or count >= self.batch_size or time.monotonic() >= deadline:
+                    if pending:
+                        self._commit(conn, pending)
+                        pending, count = {}, 0
+                    for waiter in waiters:
+                        waiter.set()
+                    waiters = []
+                    deadline = time.monotonic() + self.flush_interval
+        except BaseException as e:
+            self._error = e
+            print(f"❌ 状态写入线程异常退出，之后的状态更新不会写入: {e}")
+        finally:
+            for waiter in waiters:
+                waiter.set()
+            conn.close()
+
+# ==================== 预扫描（批量判定跳过）====================
+
+def lookup_states(conn: sqlite3.Connection, content_hashes: List[str]) -> Dict[str, Tuple]:
+    """
+    批量查询处理状态：写入临时表后与 processing_state 做一次 JOIN
+    
+    Returns:
+        content_hash → (status, file_id, final_size, final_mtime_ns, final_checksum, quality_ok)
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS plan_hashes (content_hash TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM plan_hashes")
+    conn.executemany("INSERT OR IGNORE INTO plan_hashes (content_hash) VALUES (?)", ((h,) for h in content_hashes))
+    rows = conn.execute("""
+        SELECT s.content_hash, s.status, s.file_id,
+               s.final_size, s.final_mtime_ns, s.final_checksum, s.quality_ok
+        FROM processing_state s JOIN plan_hashes p ON p.content_hash = s.content_hash
+    """).fetchall()
+    conn.execute("DROP TABLE plan_hashes")
     conn.commit()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+def verify_final(final_path: Path, checksum: Optional[str] = None, quality_ok: Optional[int] = None) -> Optional[Fingerprint]:
+    """
+    全量校验final文件（指纹不匹配时才调用，在进程池中运行）
+    
+    内容校验和与记录一致（只是mtime变了，例如被复制或touch）时沿用记录的质量标记，
+    否则解析JSON重新检查processedContent。
+    
+    Returns:
+        文件当前的指纹；文件不存在或已损坏时返回 None
+    """
+    try:
+        st = final_path.stat()
+        data = final_path.read_bytes()
+    except OSError:
+        return None
+    current = final_checksum(data)
+    if checksum == current and quality_ok is not None:
+        return (st.st_size, st.st_mtime_ns, current, bool(quality_ok))
+    try:
+        final_data = json.loads(data.decode("utf-8"))
+        passed = is_content_already_processed(final_data.get("processedContent", ""))
+    except Exception:
+        return None  # 文件损坏，重新处理
+    return (st.st_size, st.st_mtime_ns, current, passed)
+
+def plan_work(html_files: List[Path], conn: sqlite3.Connection, final_dir: Path,
+              pool: ProcessPoolExecutor, hash_algo: str = HASH_ALGO,
+              paranoid: bool = False) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    预扫描：按manifest取得hash（stat变化的文件在进程池中重新计算），一次性查询状态库，只把需要处理的文件交给后续阶段
+    
+    判定顺序与逐文件检查一致：
+    1. hash 对应状态为 ok，final 文件的 stat 与记录的指纹一致 → 按记录的质量标记决定是否跳过（不读取final文件）
+    2. 指纹不一致或没有记录 → 全量校验 final 文件（按记录的 file_id，其次按文件名），有效则跳过并更新指纹
+    3. 同一批次中内容相同的文件只处理第一个
+    
+    Returns:
+        (需要处理的文件列表, 跳过的文件列表)，元素包含 html_path、index、content_hash、file_id；
+        需要更新状态的跳过项 record_ok=True，并附带 fingerprint
+    """
+    hashes, rehashed = hash_inputs(html_files, conn, pool, hash_algo, paranoid)
+    print(f"🔍 重新计算hash: {rehashed}/{len(html_files)} 个文件" + ("（--paranoid）" if paranoid else "（其余按stat命中manifest）"))
+    states = lookup_states(conn, hashes)
+    
+    # 指纹匹配的直接判定；其余存在final文件的交给进程池全量校验
+    decided: Dict[int, bool] = {}
+    candidates: Dict[int, Tuple[Path, Optional[str], Optional[int]]] = {}
+    for i, (html_path, content_hash) in enumerate(zip(html_files, hashes)):
+        status, saved_file_id, size, mtime_ns, checksum, quality_ok = states.get(content_hash, (None,) * 6)
+        if status == "ok" and saved_file_id:
+            final_path = final_dir / f"{saved_file_id}.json"
+            try:
+                st = final_path.stat()
+            except OSError:
+                st = None
+            if st is not None:
+                if quality_ok is not None and (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+                    decided[i] = bool(quality_ok)
+                else:
+                    candidates[i] = (final_path, checksum, quality_ok)
+                continue
+        final_path = final_dir / f"{file_id_for(html_path)}.json"
+        if final_path.exists():
+            candidates[i] = (final_path, None, None)
+    paths, checksums, qualities = (list(c) for c in zip(*candidates.values())) if candidates else ([], [], [])
+    chunksize = max(1, min(256, len(candidates) // (PARSE_WORKERS * 8)))
+    verified = dict(zip(candidates, pool.map(verify_final, paths, checksums, qualities, chunksize=chunksize)))
+    
+    work: List[Dict[str, Any]] = []
+    skipped: List[Dict[str, Any]] = []
+    first_seen: Dict[str, Path] = {}
+    for i, (html_path, content_hash) in enumerate(zip(html_files, hashes)):
+        item = {"html_path": html_path, "index": i + 1, "content_hash": content_hash,
+                "file_id": file_id_for(html_path), "record_ok": False}
+        status, saved_file_id = states.get(content_hash, (None, None))[:2]
+        fingerprint = verified.get(i)
+        if decided.get(i):
+            item["message"] = f"⏭️  已处理过，跳过（content_hash: {content_hash[:8]}...）"
+            skipped.append(item)
+        elif fingerprint is not None and fingerprint[3]:
+            final_path = candidates[i][0]
+            if status == "ok" and saved_file_id and final_path.stem == saved_file_id:
+                item.update(file_id=saved_file_id,
+                            message=f"⏭️  已处理过，跳过（content_hash: {content_hash[:8]}...）")
+            else:
+                item["message"] = "⏭️  已处理过，跳过（final文件已存在且有效）"
+            item.update(record_ok=True, fingerprint=fingerprint)
+            skipped.append(item)
+        elif content_hash in first_seen:
+            item["message"] = f"⏭️  内容与 {first_seen[content_hash].name} 相同，跳过"
+            skipped.append(item)
+        else:
+            first_seen[content_hash] = html_path
+            work.append(item)
+    return work, skipped
+
+# ==================== 近似重复检测 ====================
+
+_SIMHASH_DROP_RE = re.compile(r"[\W_]+")
+SIMHASH_SHINGLE = 4  # 按字符4-gram取特征（中文没有空格分词）
+
+def _signed64(value: int) -> int:
+    """SQLite INTEGER 是有符号64位"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def simhash64(text: str) -> Optional[int]:
+    """
+    正文的64位SimHash：去模板后只保留文字与数字（忽略大小写、空白和标点），按字符4-gram加权
+
+    页面框架、广告或干扰字符不同的转载帖得到的指纹只差几位；规范化后短于 NEAR_DUP_MIN_CHARS 时返回 None。
+    """
+    normalized = _SIMHASH_DROP_RE.sub("", strip_boilerplate(text).lower())
+    if len(normalized) < max(NEAR_DUP_MIN_CHARS, SIMHASH_SHINGLE):
+        return None
+    counts: Dict[str, int] = {}
+    for i in range(len(normalized) - SIMHASH_SHINGLE + 1):
+        shingle = normalized[i:i + SIMHASH_SHINGLE]
+        counts[shingle] = counts.get(shingle, 0) + 1
+    weights = [0] * 64
+    for shingle, count in counts.items():
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += count if h >> bit & 1 else -count
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+class NearDuplicateIndex:
+    """
+    SimHash 近似重复索引（内存），按 LSH 分段查找候选
+
+    64位指纹切成 max_distance+1 段：汉明距离不超过 max_distance 的两个指纹至少有一段完全相同，
+    所以只需比较同段相同的候选。持久化的只有每个规范结果的指纹（state.sqlite 的 content_simhash 表），
+    分段在加载时计算，调整阈值无需重建。
+    """
+    
+    def __init__(self, max_distance: int = NEAR_DUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        width = 64 // bands
+        self._bands = [(i * width, 64 if i == bands - 1 else (i + 1) * width) for i in range(bands)]
+        self._buckets: Dict[Tuple[int, int], List[str]] = {}
+        self._entries: Dict[str, Tuple[int, str]] = {}  # content_hash → (simhash, file_id)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _keys(self, simhash: int):
+        for i, (start, end) in enumerate(self._bands):
+            yield (i, simhash >> start & ((1 << (end - start)) - 1))
+    
+    def add(self, content_hash: str, file_id: str, simhash: int):
+        self._entries[content_hash] = (simhash, file_id)
+        for key in self._keys(simhash):
+            self._buckets.setdefault(key, []).append(content_hash)
+    
+    def remove(self, content_hash: str):
+        entry = self._entries.pop(content_hash, None)
+        if entry is not None:
+            for key in self._keys(entry[0]):
+                self._buckets[key].remove(content_hash)
+    
+    def find(self, simhash: int) -> Optional[Tuple[str, str, int]]:
+        """返回最接近的规范结果 (content_hash, file_id, 汉明距离)，没有不超过阈值的候选时返回 None"""
+        best = None
+        for key in self._keys(simhash):
+            for content_hash in self._buckets.get(key, ()):
+                candidate, file_id = self._entries[content_hash]
+                distance = bin(candidate ^ simhash).count("1")
+                if distance <= self.max_distance and (best is None or (distance, content_hash) < (best[2], best[0])):
+                    best = (content_hash, file_id, distance)
+        return best
+    
+    @classmethod
+    def load(cls, conn: sqlite3.Connection, max_distance: int = NEAR_DUP_MAX_DISTANCE) -> "NearDuplicateIndex":
+        """从状态库加载处理成功的规范结果的指纹"""
+        index = cls(max_distance)
+        rows = conn.execute("""
+            SELECT c.content_hash, c.file_id, c.simhash
+            FROM content_simhash c JOIN processing_state s ON s.content_hash = c.content_hash
+            WHERE s.status = 'ok'
+        """)
+        for content_hash, file_id, simhash in rows:
+            index.add(content_hash, file_id, simhash & ((1 << 64) - 1))
+        return index
+
+def read_ai_response(ai_path: Path) -> Tuple[Optional[str], Dict[str, Any]]:
+    """读取 write_ai_response 保存的AI原始响应，返回 (模型名, 响应)"""
+    payload = json.loads(ai_path.read_text(encoding="utf-8"))
+    return payload.get("model"), payload["response"]
+
+# ==================== CPU阶段（进程池）====================
+
+def prepare_file(html_path: Path, content_hash: str, raw_dir: Path) -> Dict[str, Any]:
+    """
+    CPU阶段（在进程池中运行）：解析HTML、压缩正文并构建提示词
+    
+    content_hash 由预扫描阶段给出；解析结果按hash保存在 raw_dir，
+    命中时完全不读取HTML文件，重试或重新规范化时不再解析。
+    未命中时只读取一次文件：同一份缓冲区重新计算hash并解析，文件在预扫描之后被修改时以实际解析的内容的hash为准。
+    
+    Returns:
+        {"status": "ready"|"bad", "content_hash", "file_id", "message", ...}
+        status=ready 时附带 raw_data、prompt、prompt_metrics（提示词大小指标）
+        与 prompt_post（标题, 压缩后的正文），后者供批量模式构建合并提示词；
+        simhash 为压缩后正文的SimHash（过短时为 None），供近似去重使用
+    """
+    result = {"content_hash": content_hash, "file_id": html_path.stem}
+    try:
+        fields = load_raw_fields(raw_dir, content_hash)
+        if fields is not None:
+            raw_data = _build_raw_data(html_path, fields)
+        else:
+            with HtmlInput(html_path) as source:
+                content_hash = result["content_hash"] = source.hash()
+                raw_data = parse_html_cached(html_path, raw_dir, content_hash, source)
+        if not raw_data.get("title") or not raw_data.get("originalContentText"):
+            raise ValueError("解析失败：缺少title或content")
+    except Exception as e:
+        result.update(status="bad", error_type=type(e).__name__, error=str(e),
+                      message=f"❌ HTML解析失败: {str(e)[:100]}")
+        return result
+    
+    content_text, metrics = compact_content(raw_data.get("originalContentText", ""))
+    prompt = build_prompt(raw_data.get("title", ""), content_text, compact=False)
+    metrics["prompt_tokens"] = estimate_tokens(prompt)
+    result.update(status="ready", file_id=raw_data["id"], raw_data=raw_data, prompt=prompt, prompt_metrics=metrics,
+                  prompt_post=(raw_data.get("title", ""), content_text), simhash=simhash64(content_text))
+    return result
+
+# ==================== 离线重新规范化 ====================
+
+# 由AI响应经 build_final_data 推导出的字段；renormalize 只替换这些字段，其余字段（评论、投票等）保持不变
+AI_DERIVED_FIELDS = ["title", "processedContent", "company", "role", "difficulty", "tags", "tagDimensions"]
+
+def write_ai_response(ai_path: Path, processed: Dict[str, Any], model: Optional[str] = None):
+    """保存AI原始响应（校验和规范化之前）"""
+    payload = {"model": model or ai_model_name(), "response": processed}
+    ai_path.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+
+def renormalize_file(final_path: Path, ai_path: Path) -> Dict[str, Any]:
+    """
+    用保存的AI原始响应重新生成final文件中的推导字段（在进程池中运行，不访问网络）
+    
+    Returns:
+        {"file_id", "status": "changed"|"unchanged"|"failed", "fingerprint", "error"}
+    """
+    result = {"file_id": final_path.stem, "fingerprint": None, "error": None}
+    try:
+        old = json.loads(final_path.read_text(encoding="utf-8"))
+        _, processed = read_ai_response(ai_path)
+        rebuilt = build_final_data({"originalContentHtml": old.get("originalContent", "")}, processed)
+    except Exception as e:
+        result.update(status="failed", error=f"{type(e).__name__}: {e}")
+        return result
+    
+    new = dict(old)
+    new.update({field: rebuilt[field] for field in AI_DERIVED_FIELDS})
+    if new == old:
+        result["status"] = "unchanged"
+        return result
+    result.update(status="changed", fingerprint=write_final(final_path, new))
+    return result
+
+def renormalize(out_dir: Path, workers: int = PARSE_WORKERS):
+    """
+    对所有已保存AI原始响应的final文件重新执行校验与规范化（TagValidator / TagExtractor）
+    
+    修改 config/tags.json 或别名映射后运行即可，无需重新调用AI。
+    改写过的final文件在状态库中同步更新指纹。
+    """
+    final_dir = out_dir / "final"
+    ai_dir = out_dir / "ai"
+    pairs = [(final_dir / ai_path.name, ai_path) for ai_path in sorted(ai_dir.glob("*.json"))
+             if (final_dir / ai_path.name).exists()]
+    if not pairs:
+        print(f"⚠️  没有可重新规范化的文件（需要 {ai_dir} 中的AI原始响应及对应的final文件）")
+        return
+    
+    print(f"🔁 重新规范化 {len(pairs)} 个文件（{workers} 个进程）")
+    counts = {"changed": 0, "unchanged": 0, "failed": 0}
+    fingerprints: List[Tuple[str, Fingerprint]] = []
+    chunksize = max(1, min(64, len(pairs) // (workers * 8)))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for result in pool.map(renormalize_file, *zip(*pairs), chunksize=chunksize):
+            counts[result["status"]] += 1
+            if result["status"] == "changed":
+                fingerprints.append((result["file_id"], result["fingerprint"]))
+            elif result["status"] == "failed":
+                print(f"   ❌ {result['file_id']}: {result['error'][:100]}")
+    
+    state_db_path = out_dir / "state.sqlite"
+    if fingerprints and state_db_path.exists():
+        conn = init_state_db(state_db_path)
+        with conn:
+            conn.executemany("""
+                UPDATE processing_state
+                SET final_size = ?, final_mtime_ns = ?, final_checksum = ?, quality_ok = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE file_id = ? AND status = 'ok'
+            """, [(size, mtime_ns, checksum, int(quality_ok), file_id)
+                  for file_id, (size, mtime_ns, checksum, quality_ok) in fingerprints])
+        conn.close()
+    
+    print(f"   ✅ 已更新: {counts['changed']} 个")
+    print(f"   ⏸️  无变化: {counts['unchanged']} 个")
+    print(f"   ❌ 失败: {counts['failed']} 个（final文件保持不变）")
+
+# ==================== AI调用统计 ====================
+
+def ai_call_stats(conn: sqlite3.Connection, bucket_seconds: int = 60) -> Optional[Dict[str, Any]]:
+    """
+    汇总 ai_calls 表：整体与按服务商/模型的延迟分位数、token用量、状态码分布，以及按完成时间分桶的吞吐
+
+    延迟是一次调用从开始到结束的时间，包含本地排队（并发上限、限流）与重试等待。
+    文件数按调用覆盖的文件计算（单篇请求按 content_hash 去重，批量请求按篇数）；
+    平均在途请求数按 Little 定律（总耗时 / 时间跨度）估算，可与 CONCURRENCY 对照。没有记录时返回 None。
+    """
+    rows = conn.execute("""
+        SELECT started_at, content_hash, posts, provider, model, attempts, latency,
+               COALESCE(input_tokens, 0), COALESCE(output_tokens, 0), http_status, ok
+        FROM ai_calls ORDER BY started_at
+    """).fetchall()
+    if not rows:
+        return None
+    
+    def latency_summary(selected: List[Tuple]) -> Dict[str, Any]:
+        latencies = [row[6] for row in selected if row[10]]
+        return {
+            "calls": len(selected),
+            "failed": sum(1 for row in selected if not row[10]),
+            "retried": sum(1 for row in selected if row[5] > 1),
+            "p50": _percentile(latencies, 0.5), "p95": _percentile(latencies, 0.95), "p99": _percentile(latencies, 0.99),
+        }
+    
+    overall = latency_summary(rows)
+    by_model: Dict[Tuple[str, str], List[Tuple]] = {}
+    statuses: Dict[str, int] = {}
+    for row in rows:
+        by_model.setdefault((row[3], row[4]), []).append(row)
+        status = str(row[9]) if row[9] is not None else "无响应"
+        statuses[status] = statuses.get(status, 0) + 1
+    
+    files = len({row[1] for row in rows if row[1] is not None}) + sum(row[2] for row in rows if row[1] is None)
+    input_tokens = sum(row[7] for row in rows)
+    output_tokens = sum(row[8] for row in rows)
+    single_tokens = [row[7] + row[8] for row in rows if row[10] and row[2] == 1 and row[7] + row[8]]
+    
+    start = rows[0][0]
+    span = max(max(row[0] + row[6] for row in rows) - start, 1e-9)
+    buckets: Dict[int, List[Tuple]] = {}
+    for row in rows:
+        buckets.setdefault(int((row[0] + row[6] - start) // bucket_seconds), []).append(row)
+    timeline = []
+    for index in sorted(buckets):
+        selected = buckets[index]
+        latencies = [row[6] for row in selected if row[10]]
+        timeline.append({
+            "start": start + index * bucket_seconds,
+            "calls": len(selected),
+            "failed": sum(1 for row in selected if not row[10]),
+            "files": sum(row[2] for row in selected if row[10]),
+            "tokens": sum(row[7] + row[8] for row in selected),
+            "p95": _percentile(latencies, 0.95),
+        })
+    
+    return {
+        **overall,
+        "attempts": sum(row[5] for row in rows),
+        "by_model": {key: latency_summary(selected) for key, selected in sorted(by_model.items())},
+        "statuses": dict(sorted(statuses.items())),
+        "files": files,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "tokens_per_file": (input_tokens + output_tokens) / files if files else 0.0,
+        "tokens_p50": _percentile(single_tokens, 0.5),
+        "tokens_p95": _percentile(single_tokens, 0.95),
+        "span": span,
+        "files_per_minute": sum(row[2] for row in rows if row[10]) / span * 60,
+        "mean_in_flight": sum(row[6] for row in rows) / span,
+        "bucket_seconds": bucket_seconds,
+        "peak_rpm": max(b["calls"] for b in timeline) * 60 / bucket_seconds,
+        "peak_tpm": max(b["tokens"] for b in timeline) * 60 / bucket_seconds,
+        "timeline": timeline,
+    }
+
+def show_stats(out_dir: Path, bucket_seconds: int = 60):
+    """打印 state.sqlite 中AI调用记录的统计报告（pipeline.py stats）"""
+    state_db_path = out_dir / "state.sqlite"
+    if not state_db_path.exists():
+        print(f"❌ 状态数据库不存在: {state_db_path}")
+        return
+    conn = init_state_db(state_db_path)
+    stats = ai_call_stats(conn, bucket_seconds)
+    conn.close()
+    if stats is None:
+        print("⚠️  没有AI调用记录（只记录实际发出的请求；缓存命中、近似去重与回放不计入）")
+        return
+    
+    print(f"📊 AI调用统计（{state_db_path}）")
+    print(f"   调用: {stats['calls']} 次，失败 {stats['failed']} 次，需要重试 {stats['retried']} 次（共 {stats['attempts']} 次请求）")
+    print(f"   延迟（成功调用，含重试）: p50 {stats['p50']:.2f}s / p95 {stats['p95']:.2f}s / p99 {stats['p99']:.2f}s")
+    print(f"   HTTP状态（最后一次请求）: " + "，".join(f"{status}×{count}" for status, count in stats["statuses"].items()))
+    print(f"   Token: 输入 {stats['input_tokens']}，输出 {stats['output_tokens']}，"
+          f"覆盖 {stats['files']} 个文件，平均每个文件 {stats['tokens_per_file']:.0f}")
+    print(f"   单篇请求token: p50 {stats['tokens_p50']:.0f} / p95 {stats['tokens_p95']:.0f}")
+    print(f"   吞吐: {stats['files_per_minute']:.1f} 文件/分钟（时间跨度 {stats['span']:.0f}s），"
+          f"平均在途请求 {stats['mean_in_flight']:.1f} 个")
+    print(f"   峰值（{stats['bucket_seconds']}s 分桶）: {stats['peak_rpm']:.0f} 请求/分钟，{stats['peak_tpm']:.0f} tokens/分钟"
+          f"（当前限额 AI_RPM={AI_RPM or '不限'}，AI_TPM={AI_TPM or '不限'}）")
+    
+    print(f"\n{'服务商/模型':<28} {'调用':>6} {'失败':>6} {'重试':>6} {'p50(s)':>8} {'p95(s)':>8} {'p99(s)':>8}")
+    for (provider, model), summary in stats["by_model"].items():
+        print(f"{provider + '/' + model:<28} {summary['calls']:>6} {summary['failed']:>6} {summary['retried']:>6} "
+              f"{summary['p50']:>8.2f} {summary['p95']:>8.2f} {summary['p99']:>8.2f}")
+    
+    print(f"\n{'时间':<20} {'调用':>6} {'失败':>6} {'文件':>6} {'tokens':>9} {'p95(s)':>8}")
+    for bucket in stats["timeline"]:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(bucket["start"]))
+        print(f"{started:<20} {bucket['calls']:>6} {bucket['failed']:>6} {bucket['files']:>6} {bucket['tokens']:>9} {bucket['p95']:>8.2f}")
+
+# ==================== AI阶段（asyncio引擎）====================
+
+async def drain_prepared_async(prepared_queue: "queue.Queue[Optional[Dict[str, Any]]]",
+                               save_result, record_failure, concurrency: int = ASYNC_CONCURRENCY,
+                               save_batch=None):
+    """
+    asyncio AI阶段：单个线程从有界队列取任务，通过一个共享的 aiohttp 连接池（keep-alive）并发调用Qwen
+    
+    最多 concurrency 个请求同时在途；save_result(item, ai_response, model) / record_failure(item, error)
+    与线程引擎共用，读到 None 时等待在途请求完成后返回。
+    队列中的 {"batch": [...]} 合并为一个请求，save_batch(batch, ai_response, model) 返回需要单独重试的条目。
+    """
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=API_TIMEOUT)
+    semaphore = asyncio.Semaphore(concurrency)
+    in_flight = set()
+    
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def run_single(item: Dict[str, Any]):
+            try:
+                item["ai_started"] = time.monotonic()
+                with ai_call_log.file(item["content_hash"]):
+                    model, processed = await call_ai_async(session, item["prompt"])
+                try:
+                    save_result(item, processed, model)
+                except Exception:
+                    ai_response_cache.discard(model, item["prompt"])
+                    raise
+            except Exception as e:
+                record_failure(item, e)
+        
+        async def run_one(item: Dict[str, Any]):
+            try:
+                if "batch" not in item:
+                    await run_single(item)
+                    return
+                batch = item["batch"]
+                try:
+                    for single in batch:
+                        single["ai_started"] = time.monotonic()
+                    prompt = build_batch_prompt([single["prompt_post"] for single in batch])
+                    with ai_call_log.file(None, len(batch)):
+                        model, processed = await call_ai_async(session, prompt)
+                    retry = save_batch(batch, processed, model)
+                    if retry:
+                        ai_response_cache.discard(model, prompt)
+                except Exception:
+                    retry = batch
+                for single in retry:
+                    await run_single(single)
+            finally:
+                semaphore.release()
+        
+        while True:
+            await semaphore.acquire()
+            item = await asyncio.to_thread(prepared_queue.get)
+            if item is None:
+                semaphore.release()
+                break
+            task = asyncio.create_task(run_one(item))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        
+        if in_flight:
+            await asyncio.gather(*in_flight)
 
 # ==================== 主流程 ====================
 
-def run_pipeline(html_dir: Path, out_dir: Path):
-    """运行pipeline主流程"""
-    
-    # 1. AI-gate：检查AI API
-    ai_available, ai_msg = check_ai_api()
-    if not ai_available:
-        print(f"❌ {ai_msg}")
-        print("\n⚠️  Pipeline要求必须配置AI API才能运行。")
-        print("   请设置环境变量：")
-        print("   export QWEN_API_KEY='sk-...'  # 或")
-        print("   export API_KEY='your-gemini-key'")
+def run_pipeline(html_dir: Path, out_dir: Path, paranoid: bool = False, engine: str = AI_ENGINE,
+                 use_ai_cache: bool = True, batch_size: int = AI_BATCH_SIZE,
+                 near_dup_distance: Optional[int] = None, stream: bool = QWEN_STREAM,
+                 providers: Optional[List[str]] = None, record: Optional[Path] = None,
+                 replay: Optional[Path] = None, replay_zero_latency: bool = False):
+    """
+    运行pipeline主流程
+    
+    预扫描：stat未变的文件直接使用manifest中的hash，其余在进程池中计算；一次JOIN查询状态库，已处理的文件不进入流水线
+    （paranoid=True 时忽略manifest，全部重新计算hash）
+    
+    两级流水线：
+    - CPU阶段：进程池（PARSE_WORKERS）负责hash、解析、构建提示词，结果写入有界队列
+    - AI阶段：从队列取任务调用AI，并发度与解析并行度互不影响
+      engine="thread"：线程池（AI_MAX_CONCURRENCY个线程）
+      engine="async"：单线程 asyncio + 共享keep-alive连接池（最多 ASYNC_CONCURRENCY 个并发请求，仅Qwen）
+      两种引擎的在途请求数都由 ai_concurrency（AIMD）控制：从 CONCURRENCY 开始，按429/超时与延迟自适应调整
+    
+    AI响应缓存（out/ai_cache.sqlite）在调用API前检查，校验或保存失败的响应从缓存删除；use_ai_cache=False 时不读也不写
+    
+    batch_size>1 时，正文不超过 AI_BATCH_MAX_TOKENS 的短面经每 batch_size 篇合并为一个请求，
+    结果逐篇校验，缺失或校验失败的条目单独重试
+    
+    providers（默认 AI_PROVIDERS）列出两个及以上服务商时启用多服务商路由（仅线程引擎）：按延迟与错误率分配请求，
+    超过 p95 延迟时向另一服务商发送对冲请求
+    
+    stream=True 时Qwen使用流式输出（SSE）：边接收边检查JSON，格式明显错误时提前中止并重试，并统计首token时间
+    
+    近似去重（默认关闭，near_dup_distance 给出阈值时开启）：进入AI阶段前按正文SimHash查找已处理或处理中的规范结果，
+    汉明距离不超过阈值的文件直接复用规范结果的AI响应（规范结果处理中时等待其完成，失败时再单独调用AI），
+    其 final JSON 的 canonicalOf 字段记录规范结果的 file_id
+    
+    record 指定录制文件时，每次实际调用AI的响应与耗时追加到该文件；replay 指定录制文件时不调用AI，
+    按提示词返回录制的响应（按原始耗时等待，replay_zero_latency=True 时不等待），不需要配置API Key
+    """
+    
+    if record is not None and replay is not None:
+        print("❌ --record 与 --replay 不能同时使用")
         sys.exit(1)
     
-    print(f"✅ {ai_msg} (使用 {AI_TYPE.upper()} API)")
+    # 1. AI-gate：检查AI API（回放模式不访问AI，无需检查）
+    if replay is not None:
+        if not replay.exists():
+            print(f"❌ 录制文件不存在: {replay}")
+            sys.exit(1)
+        ai_cassette.open_replay(replay, zero_latency=replay_zero_latency)
+        ai_router.configure({})
+        print(f"▶️  回放录制的AI响应: {replay}（{len(ai_cassette)} 条，不调用AI API）")
+    else:
+        ai_available, ai_msg = check_ai_api()
+        if not ai_available:
+            print(f"❌ {ai_msg}")
+            print("\n⚠️  Pipeline要求必须配置AI API才能运行。")
+            print("   请设置环境变量：")
+            print("   export QWEN_API_KEY='sk-...'  # 或")
+            print("   export API_KEY='your-gemini-key'")
+            sys.exit(1)
+        
+        print(f"✅ {ai_msg} (使用 {AI_TYPE.upper()} API)")
+        
+        ai_router.configure(configured_providers(AI_PROVIDERS if providers is None else providers))
+        if ai_router.enabled and engine == "async":
+            print("❌ 多服务商路由目前仅支持 --engine thread")
+            sys.exit(1)
+        if AI_TYPE == "gemini" or "gemini" in ai_router.providers:
+            try:
+                warm_up_gemini()
+            except ImportError as e:
+                print(f"❌ {e}")
+                sys.exit(1)
+    
+    if engine == "async":
+        if not AIOHTTP_AVAILABLE:
+            print("❌ async 引擎需要安装 aiohttp: pip install aiohttp")
+            sys.exit(1)
+        if AI_TYPE != "qwen" and replay is None:
+            print("❌ async 引擎目前仅支持 Qwen API，请使用 --engine thread")
+            sys.exit(1)
     
     # 2. 创建输出目录
     final_dir = out_dir / "final"
     bad_dir = out_dir / "bad"
+    raw_dir = out_dir / "raw"
+    ai_dir = out_dir / "ai"
     final_dir.mkdir(parents=True, exist_ok=True)
     bad_dir.mkdir(parents=True, exist_ok=True)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    ai_dir.mkdir(parents=True, exist_ok=True)
     
     # 3. 初始化状态数据库
     state_db_path = out_dir / "state.sqlite"
     state_conn = init_state_db(state_db_path)
+    algo_ok, algo_msg = check_hash_algo(state_conn)
+    if not algo_ok:
+        print(f"❌ {algo_msg}")
+        sys.exit(1)
     
     # 4. 查找HTML文件
     html_files = sorted(html_dir.glob("*.html"))
     if not html_files:
         print(f"⚠️  未找到HTML文件: {html_dir}")
+        ai_cassette.close()
         return
     
+    ai_cache_path = out_dir / "ai_cache.sqlite"
+    if use_ai_cache:
+        ai_response_cache.open(ai_cache_path)
+    else:
+        ai_response_cache.close()
+    if record is not None:
+        ai_cassette.open_record(record)
+        print(f"⏺️  录制AI调用到: {record}")
+    
     print(f"\n📁 找到 {len(html_files)} 个HTML文件")
-    print(f"⚡ 使用并发数: {CONCURRENCY} (可通过环境变量 CONCURRENCY 调整)")
+    max_concurrency = ASYNC_CONCURRENCY if engine == "async" else AI_MAX_CONCURRENCY
+    ai_concurrency.configure(CONCURRENCY, AI_MIN_CONCURRENCY, max_concurrency)
+    ai_circuits.configure(CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW, CIRCUIT_COOLDOWN, CIRCUIT_MAX_WAIT)
+    if engine == "async":
+        print(f"⚡ AI引擎: async，最大并发请求数: {ASYNC_CONCURRENCY} (可通过环境变量 ASYNC_CONCURRENCY 调整)")
+    print(f"⚡ 使用并发数: {CONCURRENCY}，按429/超时自适应调整（范围 {ai_concurrency.min_limit}-{ai_concurrency.max_limit}，"
+          f"可通过环境变量 CONCURRENCY / AI_MAX_CONCURRENCY 调整）")
+    if ai_router.enabled:
+        print(f"🔀 多服务商路由: {', '.join(ai_router.providers)}（按延迟/错误率分配，超过 p{AI_HEDGE_QUANTILE * 100:.0f} 延迟时发送对冲请求）")
+    qwen_streaming.configure(stream and "qwen" in (ai_router.providers if ai_router.enabled else [AI_TYPE]))
+    if qwen_streaming.enabled:
+        print("🌊 Qwen流式输出: 边接收边检查JSON，格式错误时提前中止重试")
+    if batch_size > 1:
+        print(f"📦 批量模式: 正文不超过 {AI_BATCH_MAX_TOKENS} tokens 的面经每 {batch_size} 篇合并为一个请求")
+    if AI_RPM or AI_TPM:
+        print(f"🚦 限流: {AI_RPM or '不限'} 请求/分钟, {AI_TPM or '不限'} tokens/分钟 (可通过环境变量 AI_RPM / AI_TPM 调整)")
+    print(f"🧮 解析进程数: {PARSE_WORKERS} (可通过环境变量 PARSE_WORKERS 调整)，内容hash: {HASH_ALGO}")
     
-    # 5. 处理每个文件（并发处理）
-    stats = {"total": len(html_files), "ok": 0, "bad": 0, "skipped": 0}
+    # 使用 spawn 启动解析进程：AI线程运行期间，fork 多线程进程并不安全
+    parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    
+    # 5. 预扫描：批量计算hash、查询状态，只分发需要处理的文件
+    plan_start = time.time()
+    try:
+        work_items, skipped_items = plan_work(html_files, state_conn, final_dir, parse_pool, paranoid=paranoid)
+    except BaseException:
+        parse_pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    state_writer = StateWriter(state_db_path)
+    ai_call_log.configure(state_writer.record_ai_call)
+    for item in skipped_items:
+        if item["record_ok"]:
+            state_writer.update(item["content_hash"], "ok", item["file_id"], fingerprint=item["fingerprint"])
+    print(f"📋 预扫描完成（{time.time() - plan_start:.1f}s）: {len(work_items)} 个待处理, {len(skipped_items)} 个跳过")
+    near_dup_index = None
+    if near_dup_distance is not None:
+        near_dup_index = NearDuplicateIndex.load(state_conn, near_dup_distance)
+        print(f"🔗 近似去重: SimHash 汉明距离 ≤ {near_dup_distance}，已索引 {len(near_dup_index)} 个规范结果"
+              f"（可通过 --near-dup-distance / NEAR_DUP_MAX_DISTANCE 调整）")
+    
+    # 6. 处理需要处理的文件（CPU阶段 → 有界队列 → AI阶段）
+    stats = {"total": len(html_files), "ok": 0, "bad": 0, "skipped": len(skipped_items), "deferred": 0}
+    prompt_totals = {"content_tokens": 0, "prompt_tokens": 0, "sent_tokens": 0, "truncated": 0}
+    batch_totals = {"requests": 0, "posts": 0, "retried": 0}
+    dedup_lock = Lock()
+    in_flight_canonicals: Dict[str, List[Dict[str, Any]]] = {}  # 处理中的规范结果 → 等待复用它的近似重复文件
+    released_duplicates: List[Dict[str, Any]] = []  # 规范结果失败或无法复用，需要单独调用AI的文件
+    linked = [0]
+    pending_batch: List[Dict[str, Any]] = []
     stats_lock = Lock()  # 用于线程安全的统计更新
+    completed = [len(skipped_items)]
+    prepared_queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=PREPARED_QUEUE_SIZE)
     
-    def get_state_conn():
-        """获取当前线程的 SQLite 连接（每个线程使用独立连接）"""
-        import threading
-        thread_local = getattr(get_state_conn, '_thread_local', None)
-        if thread_local is None:
-            thread_local = threading.local()
-            get_state_conn._thread_local = thread_local
-        if not hasattr(thread_local, 'conn'):
-            thread_local.conn = sqlite3.connect(str(state_db_path), check_same_thread=False)
-        return thread_local.conn
-    
-    def process_single_file(html_path: Path, index: int) -> Tuple[str, str, Optional[str]]:
-        """处理单个HTML文件（用于并发）"""
-        result_type = None
-        result_msg = ""
-        file_id = None
+    def report(result_type: str, result_msg: str, index: int):
+        """记录单个文件的处理结果并输出进度"""
+        with stats_lock:
+            stats[result_type] += 1
+            completed[0] += 1
+            if result_type != "skipped":  # 跳过的不打印（太多）
+                print(f"[{index}/{stats['total']}] {result_msg}")
+            
+            # 每10个文件显示一次进度
+            if completed[0] % 10 == 0:
+                print(f"\n📊 进度: {completed[0]}/{stats['total']} (成功: {stats['ok']}, 失败: {stats['bad']}, 跳过: {stats['skipped']}, "
+                      f"AI并发上限: {ai_concurrency.limit})")
+    
+    def record_bad(html_path: Path, content_hash: Optional[str], file_id: str, error_type: str, error_msg: str):
+        """写入错误记录并把状态标记为bad"""
+        error_path = bad_dir / f"{html_path.stem}.error.txt"
+        error_path.write_text(f"{html_path}\n{error_type}: {error_msg}\n", encoding="utf-8")
+        if content_hash:
+            state_writer.update(content_hash, "bad", file_id, error_msg[:500])
+    
+    def save_result(item: Dict[str, Any], processed: Dict[str, Any], model: Optional[str]):
+        """校验并规范化AI结果，保存AI原始响应（连同给出该结果的模型）与final JSON，更新状态（两种引擎共用）"""
+        content_hash, file_id = item["content_hash"], item["file_id"]
+        final_data = build_final_data(item["raw_data"], processed)
+        canonical = item.get("canonical")
+        if canonical:
+            final_data["canonicalOf"] = canonical[1]  # AI结果复用自该文件（近似重复），供下游区分
         
-        # 获取当前线程的 SQLite 连接
-        thread_conn = get_state_conn()
+        # 步骤5: 验证必需字段
+        required = ["title", "processedContent", "company", "role", "difficulty", "tags"]
+        missing = [f for f in required if not final_data.get(f)]
+        if missing:
+            raise ValueError(f"最终数据缺少必需字段: {missing}")
         
+        # 步骤6: 保存AI原始响应（供 renormalize 离线重新规范化）与final JSON
+        write_ai_response(ai_dir / f"{file_id}.json", processed, model)
+        final_path = final_dir / f"{file_id}.json"
+        fingerprint = write_final(final_path, final_data)
+        
+        # 步骤7: 更新状态（连同final文件指纹）与提示词指标/近似重复关系
+        state_writer.update(content_hash, "ok", file_id, fingerprint=fingerprint)
+        if canonical:
+            canonical_hash, canonical_file_id, distance = canonical
+            state_writer.record_near_duplicate(content_hash, canonical_hash, distance)
+            with stats_lock:
+                linked[0] += 1
+            report("ok", f"🔗 近似重复，复用 {canonical_file_id} 的AI结果（距离 {distance}，保存到: {final_path.name}）", item["index"])
+            return
+        state_writer.record_prompt_metrics(
+            prompt_metrics_row(content_hash, file_id, item["prompt_metrics"], time.monotonic() - item["ai_started"], model))
+        report("ok", f"✅ 处理成功（保存到: {final_path.name}）", item["index"])
+        if near_dup_index is not None and item.get("simhash") is not None:
+            state_writer.record_simhash(content_hash, file_id, item["simhash"])
+            link_waiting_duplicates(item, processed, model)
+    
+    def link_duplicate(item: Dict[str, Any], processed: Dict[str, Any], model: Optional[str]) -> bool:
+        """用规范结果的AI响应保存近似重复文件；校验失败时返回 False（改为单独调用AI）"""
+        item["ai_started"] = time.monotonic()
         try:
-            # 计算内容hash（用于去重）
-            content_hash = compute_content_hash(html_path)
-            
-            # 步骤1: 检查hash是否已处理（快速检查状态数据库）
-            cursor = thread_conn.execute(
-                "SELECT status, error_reason, file_id FROM processing_state WHERE content_hash = ?",
-                (content_hash,)
-            )
-            state_row = cursor.fetchone()
-            
-            prev_error = None
-            if state_row:
-                status, error_reason, saved_file_id = state_row
-                if status == "ok" and saved_file_id:
-                    # 验证final文件是否真的存在且有效
-                    final_path = final_dir / f"{saved_file_id}.json"
-                    if final_path.exists():
-                        try:
-                            final_data = json.loads(final_path.read_text(encoding="utf-8"))
-                            processed = final_data.get("processedContent", "")
-                            # AI检测是否真的已清洗
-                            if is_content_already_processed(processed):
-                                with stats_lock:
-                                    stats["skipped"] += 1
-                                return ("skipped", f"⏭️  已处理过，跳过（content_hash: {content_hash[:8]}...）", None)
-                        except:
-                            pass  # 文件损坏，重新处理
-                elif status == "bad":
-                    prev_error = error_reason
-            
-            # 步骤2: 解析HTML
+            save_result(item, processed, model)
+            return True
+        except Exception:
+            item.pop("canonical", None)
+            return False
+    
+    def link_waiting_duplicates(item: Dict[str, Any], processed: Dict[str, Any], model: Optional[str]):
+        """规范结果处理成功：等待它的近似重复文件直接复用AI响应"""
+        with dedup_lock:
+            waiting = in_flight_canonicals.pop(item["content_hash"], [])
+        failed = [duplicate for duplicate in waiting if not link_duplicate(duplicate, processed, model)]
+        if failed:
+            with dedup_lock:
+                released_duplicates.extend(failed)
+    
+    def claim_near_duplicate(item: Dict[str, Any]) -> bool:
+        """
+        AI阶段之前的近似去重：返回 True 表示该文件已复用规范结果或正在等待规范结果，不需要调用AI
+        
+        没有近似的规范结果时，该文件自己成为规范结果（加入索引，标记为处理中）
+        """
+        with dedup_lock:
+            match = near_dup_index.find(item["simhash"])
+            if match is None:
+                near_dup_index.add(item["content_hash"], item["file_id"], item["simhash"])
+                in_flight_canonicals[item["content_hash"]] = []
+                return False
+            item["canonical"] = match
+            if match[0] in in_flight_canonicals:
+                in_flight_canonicals[match[0]].append(item)
+                return True
+        try:
+            model, processed = read_ai_response(ai_dir / f"{match[1]}.json")
+        except (OSError, ValueError, KeyError):
+            item.pop("canonical")
+            return False
+        return link_duplicate(item, processed, model)
+    
+    def record_failure(item: Dict[str, Any], e: Exception):
+        if near_dup_index is not None:
+            # 规范结果失败：从索引移除，等待它的近似重复文件改为单独调用AI
+            with dedup_lock:
+                released_duplicates.extend(in_flight_canonicals.pop(item["content_hash"], []))
+                near_dup_index.remove(item["content_hash"])
+        if isinstance(e, CircuitOpenError):
+            # 服务商熔断：不写入bad也不更新状态，下次运行会重新处理
+            report("deferred", f"⏸️  AI服务熔断中，未处理（下次运行重试）: {e}", item["index"])
+            return
+        html_path = item["html_path"]
+        try:
+            record_bad(html_path, item["content_hash"], html_path.stem, type(e).__name__, str(e))
+        except Exception:
+            pass
+        report("bad", f"❌ 处理失败: {str(e)[:100]}", item["index"])
+    
+    def save_batch(batch: List[Dict[str, Any]], processed: Dict[str, Any], model: Optional[str]) -> List[Dict[str, Any]]:
+        """逐篇保存批量请求的结果，返回缺失或校验失败、需要单独重试的条目（两种引擎共用）"""
+        results = split_batch_response(processed, len(batch))
+        retry = []
+        for index, item in enumerate(batch, 1):
             try:
-                raw_data = parse_html(html_path)
-                if not raw_data.get("title") or not raw_data.get("originalContentText"):
-                    raise ValueError("解析失败：缺少title或content")
-                file_id = raw_data["id"]
-            except Exception as e:
-                error_msg = str(e)
-                error_path = bad_dir / f"{html_path.stem}.error.txt"
-                error_path.write_text(f"{html_path}\n{type(e).__name__}: {error_msg}\n", encoding="utf-8")
-                update_state(thread_conn, content_hash, "bad", html_path.stem, error_msg[:500])
-                with stats_lock:
-                    stats["bad"] += 1
-                return ("bad", f"❌ HTML解析失败: {error_msg[:100]}", None)
-            
-            # 步骤3: 再次检查（基于file_id检查final文件）
-            final_path = final_dir / f"{file_id}.json"
-            if final_path.exists():
-                try:
-                    final_data = json.loads(final_path.read_text(encoding="utf-8"))
-                    processed = final_data.get("processedContent", "")
-                    if is_content_already_processed(processed):
-                        update_state(thread_conn, content_hash, "ok", file_id)
-                        with stats_lock:
-                            stats["skipped"] += 1
-                        return ("skipped", f"⏭️  已处理过，跳过（final文件已存在且有效）", None)
-                except:
-                    pass  # 文件损坏，重新处理
-            
-            if prev_error:
-                pass  # 之前失败，重试
-            
+                if index not in results:
+                    raise ValueError("批量响应中缺少该篇结果")
+                save_result(item, results[index], model)
+            except Exception:
+                retry.append(item)
+        with stats_lock:
+            batch_totals["requests"] += 1
+            batch_totals["posts"] += len(batch)
+            batch_totals["retried"] += len(retry)
+        return retry
+    
+    def process_single(item: Dict[str, Any]):
+        try:
             # 步骤4: AI清洗
-            final_data = process_with_ai(raw_data)
-            
-            # 步骤5: 验证必需字段
-            required = ["title", "processedContent", "company", "role", "difficulty", "tags"]
-            missing = [f for f in required if not final_data.get(f)]
-            if missing:
-                raise ValueError(f"最终数据缺少必需字段: {missing}")
-            
-            # 步骤6: 保存final JSON
-            final_path.write_text(json.dumps(final_data, ensure_ascii=False, indent=2), encoding="utf-8")
-            
-            # 步骤7: 更新状态
-            update_state(thread_conn, content_hash, "ok", file_id)
-            with stats_lock:
-                stats["ok"] += 1
-            
-            return ("ok", f"✅ 处理成功（保存到: {final_path.name}）", file_id)
-            
+            item["ai_started"] = time.monotonic()
+            with ai_call_log.file(item["content_hash"]):
+                model, processed = call_ai(item["prompt"])
+            try:
+                save_result(item, processed, model)
+            except Exception:
+                ai_response_cache.discard(model, item["prompt"])  # 被拒绝的响应不再缓存，下次运行重新调用API
+                raise
         except Exception as e:
-            error_msg = str(e)
-            file_id = html_path.stem
-            error_path = bad_dir / f"{file_id}.error.txt"
-            error_path.write_text(f"{html_path}\n{type(e).__name__}: {error_msg}\n", encoding="utf-8")
-            
-            # 注意：这里 content_hash 可能未定义，需要处理
+            record_failure(item, e)
+    
+    def ai_worker():
+        """AI阶段（线程引擎）：从有界队列中取出已解析的文件（或一批短面经），调用AI并保存结果"""
+        while True:
+            item = prepared_queue.get()
+            if item is None:
+                return
+            if "batch" not in item:
+                process_single(item)
+                continue
+            batch = item["batch"]
             try:
-                content_hash = compute_content_hash(html_path)
-                update_state(thread_conn, content_hash, "bad", file_id, error_msg[:500])
-            except:
-                pass  # 如果 content_hash 计算失败，跳过状态更新
+                for single in batch:
+                    single["ai_started"] = time.monotonic()
+                prompt = build_batch_prompt([single["prompt_post"] for single in batch])
+                with ai_call_log.file(None, len(batch)):
+                    model, processed = call_ai(prompt)
+                retry = save_batch(batch, processed, model)
+                if retry:
+                    ai_response_cache.discard(model, prompt)  # 有条目缺失或被拒绝：同一批次重跑时重新调用API
+            except Exception:
+                retry = batch  # 整个批量请求失败：每篇单独重试
+            for single in retry:
+                process_single(single)
+    
+    def flush_batch():
+        """把攒下的短面经放入AI队列（只有一篇时按单篇处理）"""
+        if len(pending_batch) > 1:
+            prepared_queue.put({"batch": list(pending_batch)})
+        elif pending_batch:
+            prepared_queue.put(pending_batch[0])
+        pending_batch.clear()
+    
+    def handle_prepared(html_path: Path, index: int, result: Dict[str, Any]):
+        """处理CPU阶段的结果：跳过/失败直接记录，可处理的放入AI队列（队列满时阻塞，形成背压）"""
+        status = result["status"]
+        if status == "ready":
+            result.update(html_path=html_path, index=index)
+            if near_dup_index is not None and result["simhash"] is not None and claim_near_duplicate(result):
+                return
+            metrics = result["prompt_metrics"]
             with stats_lock:
-                stats["bad"] += 1
-            
-            return ("bad", f"❌ 处理失败: {error_msg[:100]}", None)
+                prompt_totals["content_tokens"] += metrics["content_tokens"]
+                prompt_totals["sent_tokens"] += metrics["compact_tokens"]
+                prompt_totals["prompt_tokens"] += metrics["prompt_tokens"]
+                prompt_totals["truncated"] += int(metrics["truncated"])
+            if batch_size > 1 and metrics["compact_tokens"] <= AI_BATCH_MAX_TOKENS:
+                pending_batch.append(result)
+                if len(pending_batch) >= batch_size:
+                    flush_batch()
+                return
+            prepared_queue.put(result)
+        else:
+            record_bad(html_path, result["content_hash"], result["file_id"], result["error_type"], result["error"])
+            report("bad", result["message"], index)
     
-    # 并发处理文件
-    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
-        futures = {executor.submit(process_single_file, html_path, i+1): (html_path, i+1) 
-                   for i, html_path in enumerate(html_files)}
+    # async引擎只有一个消费者线程（事件循环），线程引擎每个线程一个消费者
+    ai_consumers = 1 if engine == "async" else ai_concurrency.max_limit
+    ai_pool = ThreadPoolExecutor(max_workers=ai_consumers)
+    finished = False
+    try:
+        if engine == "async":
+            ai_futures = [ai_pool.submit(asyncio.run, drain_prepared_async(prepared_queue, save_result, record_failure,
+                                                                           save_batch=save_batch))]
+        else:
+            ai_futures = [ai_pool.submit(ai_worker) for _ in range(ai_consumers)]
         
-        completed = 0
-        for future in as_completed(futures):
-            completed += 1
-            html_path, index = futures[future]
-            try:
-                result_type, result_msg, file_id = future.result()
-                if result_type != "skipped":  # 跳过的不打印（太多）
-                    print(f"[{index}/{stats['total']}] {result_msg}")
-                
-                # 每10个文件显示一次进度
-                if completed % 10 == 0:
-                    with stats_lock:
-                        print(f"\n📊 进度: {completed}/{stats['total']} (成功: {stats['ok']}, 失败: {stats['bad']}, 跳过: {stats['skipped']})")
-            except Exception as e:
-                print(f"[{index}/{stats['total']}] ❌ 处理异常: {e}")
+        # 滑动窗口提交解析任务，避免一次性把所有文件压进进程池
+        pending = {}
+        work_iter = iter(work_items)
+        window = PARSE_WORKERS * 2
+        while True:
+            for item in work_iter:
+                future = parse_pool.submit(prepare_file, item["html_path"], item["content_hash"], raw_dir)
+                pending[future] = item
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                html_path, index = item["html_path"], item["index"]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"status": "bad", "content_hash": item["content_hash"], "file_id": html_path.stem,
+                              "error_type": type(e).__name__, "error": str(e), "message": f"❌ 处理异常: {e}"}
+                handle_prepared(html_path, index, result)
+        flush_batch()
+        finished = True
+    finally:
+        parse_pool.shutdown(wait=True, cancel_futures=True)
+        # 通知AI线程退出
+        for _ in range(ai_consumers):
+            prepared_queue.put(None)
+        ai_pool.shutdown(wait=True)
+        # 规范结果失败或无法复用的近似重复文件，单独调用AI
+        leftovers = released_duplicates + [item for waiting in in_flight_canonicals.values() for item in waiting]
+        if finished and leftovers:
+            for item in leftovers:
+                item.pop("canonical", None)
+            with ThreadPoolExecutor(max_workers=ai_concurrency.limit) as retry_pool:
+                list(retry_pool.map(process_single, leftovers))
+        # 提交剩余的状态更新
+        ai_call_log.configure(None)
+        cache_hits, cache_misses = ai_response_cache.hits, ai_response_cache.misses
+        ai_response_cache.close()
+        cassette_summary = ai_cassette.summary() if ai_cassette.mode else None
+        ai_cassette.close()
+        state_writer.close()  # 最后关闭：写线程异常退出时在这里抛出，其他资源已经释放
     
+    for future in ai_futures:
+        future.result()
     
-    # 6. 输出统计
+    # 7. 输出统计
     print(f"\n{'='*50}")
     print(f"📊 处理完成统计：")
     print(f"   总计: {stats['total']} 个文件")
     print(f"   ✅ 成功: {stats['ok']} 个")
     print(f"   ❌ 失败: {stats['bad']} 个")
     print(f"   ⏭️  跳过: {stats['skipped']} 个（已处理过）")
+    if stats["deferred"]:
+        print(f"   ⏸️  熔断未处理: {stats['deferred']} 个（未标记失败，下次运行重试）")
+    print(f"   ⚡ AI并发上限: 最终 {ai_concurrency.limit}（429/超时 {ai_concurrency.overloads} 次）")
+    if use_ai_cache:
+        print(f"   💾 AI响应缓存: 命中 {cache_hits} 次, 未命中 {cache_misses} 次")
+    for line in ai_circuits.summary():
+        print(f"   🔌 熔断: {line}")
+    if ai_router.enabled:
+        print(f"   🔀 多服务商路由:")
+        for line in ai_router.summary():
+            print(f"      {line}")
+    if qwen_streaming.enabled:
+        print(f"   🌊 流式输出: {qwen_streaming.summary()}")
+    if cassette_summary:
+        print(f"   📼 {cassette_summary}")
+    if near_dup_index is not None:
+        print(f"   🔗 近似重复: {linked[0]} 个文件复用已有AI结果（节省 {linked[0]} 次AI调用）")
+    if batch_totals["requests"]:
+        print(f"   📦 批量请求: {batch_totals['requests']} 次，共 {batch_totals['posts']} 篇，单独重试 {batch_totals['retried']} 篇")
+    if prompt_totals["content_tokens"]:
+        saved = 1 - prompt_totals["sent_tokens"] / prompt_totals["content_tokens"]
+        print(f"   📉 提示词正文: 原始约 {prompt_totals['content_tokens']} tokens → 发送约 {prompt_totals['sent_tokens']} tokens"
+              f"（减少 {saved:.0%}，截断 {prompt_totals['truncated']} 个；完整提示词约 {prompt_totals['prompt_tokens']} tokens）")
     print(f"\n输出目录：")
     print(f"   Final JSON: {final_dir}")
+    print(f"   Raw JSON: {raw_dir}")
+    print(f"   AI原始响应: {ai_dir}")
     print(f"   失败记录: {bad_dir}")
     print(f"   状态数据库: {state_db_path}")
+    if use_ai_cache:
+        print(f"   AI响应缓存: {ai_cache_path}")
     
-    # 关闭主线程的 SQLite 连接（线程本地连接会自动关闭）
+    # 关闭主线程的 SQLite 连接
     try:
         state_conn.close()
     except:
@@ -623,6 +3663,40 @@ def main():
     run_parser = subparsers.add_parser("run", help="运行pipeline")
     run_parser.add_argument("--html-dir", required=True, help="HTML文件目录")
     run_parser.add_argument("--out-dir", default="./out", help="输出目录（默认: ./out）")
+    run_parser.add_argument("--paranoid", action="store_true", help="忽略manifest，重新计算所有输入文件的hash")
+    run_parser.add_argument("--no-ai-cache", action="store_true", help="不使用AI响应缓存（不读也不写）")
+    run_parser.add_argument("--engine", choices=["thread", "async"], default=AI_ENGINE,
+                            help=f"AI阶段引擎：thread（线程池）或 async（asyncio + keep-alive连接池，仅Qwen）（默认: {AI_ENGINE}）")
+    run_parser.add_argument("--providers", default=",".join(AI_PROVIDERS),
+                            help="同时使用的服务商，逗号分隔，如 qwen,gemini（默认: AI_PROVIDERS，空表示只用已配置的一个）")
+    run_parser.add_argument("--stream", action="store_true", default=QWEN_STREAM,
+                            help="Qwen使用流式输出（SSE），边接收边检查JSON，格式错误时提前中止重试（也可设置 QWEN_STREAM=1）")
+    run_parser.add_argument("--near-dup-distance", type=int, nargs="?", const=NEAR_DUP_MAX_DISTANCE, metavar="N",
+                            help=f"开启近似去重：SimHash汉明距离不超过 N 的文件复用已有AI结果，final JSON 标记 canonicalOf"
+                                 f"（默认关闭；不写 N 时为 {NEAR_DUP_MAX_DISTANCE}）")
+    run_parser.add_argument("--batch-size", type=int, default=AI_BATCH_SIZE,
+                            help=f"每个AI请求最多合并的短面经篇数，1 表示不合并（默认: {AI_BATCH_SIZE}）")
+    cassette_group = run_parser.add_mutually_exclusive_group()
+    cassette_group.add_argument("--record", metavar="CASSETTE", help="把每次实际AI调用的响应与耗时追加到录制文件（JSON Lines）")
+    cassette_group.add_argument("--replay", metavar="CASSETTE", help="不调用AI，按提示词回放录制文件中的响应（无需API Key）")
+    run_parser.add_argument("--replay-latency", choices=["original", "zero"], default="original",
+                            help="回放时按录制的原始耗时等待（original，默认）或立即返回（zero）")
+    
+    # renormalize命令
+    renormalize_parser = subparsers.add_parser("renormalize", help="用保存的AI原始响应重新规范化final文件（不调用AI）")
+    renormalize_parser.add_argument("--out-dir", default="./out", help="输出目录（默认: ./out）")
+    renormalize_parser.add_argument("--workers", type=int, default=PARSE_WORKERS, help=f"进程数（默认: {PARSE_WORKERS}）")
+    
+    # stats命令
+    stats_parser = subparsers.add_parser("stats", help="AI调用统计：延迟分位数、token用量与吞吐")
+    stats_parser.add_argument("--out-dir", default="./out", help="输出目录（默认: ./out）")
+    stats_parser.add_argument("--bucket", type=int, default=60, help="吞吐时间分桶秒数（默认: 60）")
+    
+    # migrate-hash命令
+    migrate_parser = subparsers.add_parser("migrate-hash", help="将状态数据库和raw存储迁移到新的hash算法")
+    migrate_parser.add_argument("--html-dir", required=True, help="HTML文件目录（用于重新计算hash）")
+    migrate_parser.add_argument("--out-dir", default="./out", help="输出目录（默认: ./out）")
+    migrate_parser.add_argument("--to", required=True, choices=["sha256", "blake2b"], help="目标hash算法")
     
     args = parser.parse_args()
     
@@ -634,7 +3708,27 @@ def main():
         
         out_dir = Path(args.out_dir)
         
-        run_pipeline(html_dir, out_dir)
+        run_pipeline(html_dir, out_dir, paranoid=args.paranoid, engine=args.engine,
+                     use_ai_cache=not args.no_ai_cache, batch_size=args.batch_size,
+                     near_dup_distance=args.near_dup_distance, stream=args.stream,
+                     providers=[p.strip() for p in args.providers.split(",") if p.strip()],
+                     record=Path(args.record) if args.record else None,
+                     replay=Path(args.replay) if args.replay else None,
+                     replay_zero_latency=args.replay_latency == "zero")
+    elif args.command == "renormalize":
+        out_dir = Path(args.out_dir)
+        if not out_dir.exists():
+            print(f"❌ 输出目录不存在: {out_dir}")
+            sys.exit(1)
+        renormalize(out_dir, args.workers)
+    elif args.command == "stats":
+        show_stats(Path(args.out_dir), max(1, args.bucket))
+    elif args.command == "migrate-hash":
+        html_dir = Path(args.html_dir)
+        if not html_dir.exists():
+            print(f"❌ HTML目录不存在: {html_dir}")
+            sys.exit(1)
+        migrate_hash_algo(html_dir, Path(args.out_dir), args.to)
     else:
         parser.print_help()
 
@@ -22,10 +22,14 @@ from threading import Lock
 
 # 导入pipeline的核心功能
 from pipeline import (
-    parse_html, 
+    parse_html_cached, 
     process_with_ai, 
     check_ai_api,
+    ai_concurrency,
+    ai_response_cache,
     AI_TYPE,
+    AI_MAX_CONCURRENCY,
+    AI_MIN_CONCURRENCY,
     CONCURRENCY
 )
 
@@ -34,8 +38,12 @@ from mongodb_utils import import_to_mongodb
 from csv_utils import load_csv_times, parse_publish_time
 
 
-def process_batch(html_dir: Path, csv_path: Optional[Path] = None):
-    """批量处理HTML文件"""
+DEFAULT_RAW_DIR = Path("./out/raw")
+
+
+def process_batch(html_dir: Path, csv_path: Optional[Path] = None, raw_dir: Path = DEFAULT_RAW_DIR,
+                  use_ai_cache: bool = True):
+    """批量处理HTML文件（解析结果与AI响应缓存均与 pipeline.py 共用，位于 raw_dir 的上级目录）"""
     
     # 1. 检查AI API
     ai_available, ai_msg = check_ai_api()
@@ -57,7 +65,11 @@ def process_batch(html_dir: Path, csv_path: Optional[Path] = None):
         return
     
     print(f"📁 找到 {len(html_files)} 个HTML文件")
-    print(f"⚡ 使用并发数: {CONCURRENCY} (可通过环境变量 CONCURRENCY 调整)\n")
+    if use_ai_cache:
+        raw_dir.parent.mkdir(parents=True, exist_ok=True)
+        ai_response_cache.open(raw_dir.parent / "ai_cache.sqlite")
+    ai_concurrency.configure(CONCURRENCY, AI_MIN_CONCURRENCY, AI_MAX_CONCURRENCY)
+    print(f"⚡ 使用并发数: {CONCURRENCY}，按429/超时自适应调整（上限 {AI_MAX_CONCURRENCY}，可通过环境变量 CONCURRENCY / AI_MAX_CONCURRENCY 调整）\n")
     print(f"{'='*60}\n")
     
     # 4. 并发处理文件
@@ -71,8 +83,8 @@ def process_batch(html_dir: Path, csv_path: Optional[Path] = None):
         publish_time = parse_publish_time(publish_time_str) if publish_time_str else None
         
         try:
-            # 解析HTML
-            raw_data = parse_html(html_path)
+            # 解析HTML（raw存储命中时直接读取）
+            raw_data = parse_html_cached(html_path, raw_dir)
             if not raw_data.get("title") or not raw_data.get("originalContentText"):
                 raise ValueError("解析失败：缺少title或content")
             
@@ -97,8 +109,8 @@ def process_batch(html_dir: Path, csv_path: Optional[Path] = None):
                 stats["failed"] += 1
             return ("failed", f"❌ [{index}/{stats['total']}] {html_path.name} - {str(e)[:80]}", None)
     
-    # 使用线程池并发处理
-    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+    # 使用线程池并发处理（实际在途的AI请求数由 pipeline 的自适应并发控制器决定）
+    with ThreadPoolExecutor(max_workers=AI_MAX_CONCURRENCY) as executor:
         futures = {executor.submit(process_single_file, html_path, i+1): (html_path, i+1) 
                    for i, html_path in enumerate(html_files)}
         
@@ -113,10 +125,12 @@ def process_batch(html_dir: Path, csv_path: Optional[Path] = None):
                 # 每10个文件显示一次进度
                 if completed % 10 == 0:
                     with stats_lock:
-                        print(f"\n📊 进度: {completed}/{stats['total']} (成功: {stats['ok']}, 失败: {stats['failed']}, 跳过: {stats['skipped']})\n")
+                        print(f"\n📊 进度: {completed}/{stats['total']} (成功: {stats['ok']}, 失败: {stats['failed']}, 跳过: {stats['skipped']}, AI并发上限: {ai_concurrency.limit})\n")
             except Exception as e:
                 print(f"❌ [{index}/{stats['total']}] {html_path.name} - 处理异常: {e}")
     
+    ai_response_cache.close()
+    
     # 5. 输出统计
     print(f"{'='*60}")
     print(f"📊 处理完成统计：")
@@ -124,6 +138,8 @@ def process_batch(html_dir: Path, csv_path: Optional[Path] = None):
     print(f"   ✅ 成功: {stats['ok']} 个")
     print(f"   ❌ 失败: {stats['failed']} 个")
     print(f"   ⏭️  跳过: {stats['skipped']} 个（已存在）")
+    if use_ai_cache:
+        print(f"   💾 AI响应缓存: 命中 {ai_response_cache.hits} 次, 未命中 {ai_response_cache.misses} 次")
     print(f"\n✅ 所有数据已导入数据库，前端可以立即使用标签筛选！")
     print(f"{'='*60}\n")
 
@@ -132,6 +148,8 @@ def main():
     parser = argparse.ArgumentParser(description="批量处理HTML文件并同步CSV发布时间")
     parser.add_argument("--html-dir", required=True, help="HTML文件目录")
     parser.add_argument("--csv", help="CSV文件路径（包含发布时间，可选）")
+    parser.add_argument("--raw-dir", default=str(DEFAULT_RAW_DIR), help="raw JSON存储目录（默认: ./out/raw）")
+    parser.add_argument("--no-ai-cache", action="store_true", help="不使用AI响应缓存（不读也不写）")
     
     args = parser.parse_args()
     
@@ -142,7 +160,7 @@ def main():
     
     csv_path = Path(args.csv) if args.csv else None
     
-    process_batch(html_dir, csv_path)
+    process_batch(html_dir, csv_path, Path(args.raw_dir), use_ai_cache=not args.no_ai_cache)
 
 
 if __name__ == "__main__":
@@ -12,7 +12,75 @@
 import json
 import re
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
+
+
+_WORD_BOUNDARY = re.compile(r'\b')
+
+
+def _trie_pattern(words: List[str]) -> str:
+    """把关键词编译成前缀树形式的正则分支：同一位置优先尝试更长的关键词，匹配代价不随关键词数量增长"""
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}  # 关键词在此结束
+    
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if '' in node:
+            branches.append('')  # 放在最后：先尝试更长的关键词
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+    
+    return build(trie)
+
+
+class KeywordMatcher:
+    """
+    预编译的关键词匹配器：一次扫描文本，返回优先级最高的命中关键词对应的值
+    
+    keywords 为 (关键词, 值) 列表，列表顺序即优先级（不区分大小写）。
+    word_boundary=True 时结果与按顺序逐个 re.search(r'\b关键词\b') 相同，否则与逐个子串判断（in）相同。
+    """
+    
+    def __init__(self, keywords: List[Tuple[str, Any]], word_boundary: bool = True):
+        self.word_boundary = word_boundary
+        self._ranked: Dict[str, Tuple[int, Any]] = {}  # 关键词 → (优先级, 值)，重复的关键词以第一次出现为准
+        for rank, (keyword, value) in enumerate(keywords):
+            keyword = keyword.lower()
+            if keyword and keyword not in self._ranked:
+                self._ranked[keyword] = (rank, value)
+        # 同一位置可能同时命中的更短关键词（是该关键词前缀的其他关键词）
+        self._prefixes = {keyword: [keyword[:i] for i in range(len(keyword) - 1, 0, -1) if keyword[:i] in self._ranked]
+                          for keyword in self._ranked}
+        self._pattern = None
+        if self._ranked:
+            boundary = r'\b' if word_boundary else ''
+            # 零宽前瞻：每个位置都尝试匹配，重叠的命中也不会漏掉
+            self._pattern = re.compile(f'(?=({boundary}{_trie_pattern(list(self._ranked))}{boundary}))')
+    
+    def search(self, text: str) -> Optional[Any]:
+        """返回文本中优先级最高的命中关键词对应的值，没有命中时返回 None"""
+        if self._pattern is None:
+            return None
+        text = text.lower()
+        best: Optional[Tuple[int, Any]] = None
+        for match in self._pattern.finditer(text):
+            keyword = match.group(1)
+            for candidate in [keyword] + self._prefixes[keyword]:
+                ranked = self._ranked[candidate]
+                if best is not None and ranked[0] >= best[0]:
+                    continue
+                if candidate is not keyword and self.word_boundary \
+                        and not _WORD_BOUNDARY.match(text, match.start() + len(candidate)):
+                    continue
+                best = ranked
+            if best[0] == 0:
+                break
+        return best[1] if best is not None else None
 
 
 class TagExtractor:
@@ -38,6 +106,34 @@ class TagExtractor:
         with open(config_path, 'r', encoding='utf-8') as f:
             self.config = json.load(f)
         self.dimensions = self.config['dimensions']
+        # 公司别名按长度从长到短（_normalize_value 与别名匹配共用）
+        self._company_aliases = sorted(self.dimensions['company']['aliases'].items(), key=lambda x: len(x[0]), reverse=True)
+        self._matchers: Optional[Dict[str, KeywordMatcher]] = None
+    
+    def matchers(self) -> Dict[str, KeywordMatcher]:
+        """
+        各维度的单次扫描匹配器，第一次提取标签时才编译（只做规范化时不需要）
+        
+        优先级与逐个关键词搜索相同：公司别名按长度从长到短，其余按配置顺序
+        """
+        if self._matchers is None:
+            company = self.dimensions['company']
+            location = self.dimensions['location']
+            predefined = location['predefined']
+            if isinstance(predefined, dict):
+                predefined = [loc for locations in predefined.values() for loc in locations]
+            # 先在局部变量中编译完整，再一次性赋值（多线程共用同一个实例时不会看到一半的结果）
+            self._matchers = {
+                'company_alias': KeywordMatcher(self._company_aliases),
+                'company_predefined': KeywordMatcher([(c, c) for c in company['predefined']]),
+                'location_alias': KeywordMatcher(list(location['aliases'].items()), word_boundary=False),
+                'location_predefined': KeywordMatcher([(loc, loc) for loc in predefined], word_boundary=False),
+                'category': KeywordMatcher([(keyword, cat['value']) for cat in self.dimensions['category']['values']
+                                            for keyword in cat['keywords']]),
+                'recruitType': KeywordMatcher([(keyword, rt['value']) for rt in self.dimensions['recruitType']['values']
+                                               for keyword in rt['keywords']]),
+            }
+        return self._matchers
     
     def extract_all(self, title: str, content: str = "", role: str = "") -> Dict[str, Any]:
         """从标题、内容、角色中提取所有标签"""
@@ -70,8 +166,7 @@ class TagExtractor:
         # 对于公司名称，也检查是否包含别名（部分匹配）
         if dimension == 'company':
             # 按长度排序，优先匹配较长的别名
-            sorted_aliases = sorted(aliases.items(), key=lambda x: len(x[0]), reverse=True)
-            for alias, standard in sorted_aliases:
+            for alias, standard in self._company_aliases:
                 if alias.lower() in cleaned_lower or cleaned_lower in alias.lower():
                     return standard
         
@@ -79,27 +174,18 @@ class TagExtractor:
     
     def _extract_company(self, title: str, text: str) -> str:
         """提取公司名称（支持谐音和别名识别）"""
-        dim = self.dimensions['company']
-        text_lower = text.lower()
-        title_lower = title.lower()
-        combined_text = f"{title_lower} {text_lower}"
+        combined_text = f"{title.lower()} {text.lower()}"
         
         # 1. 先检查别名（使用单词边界匹配，避免部分匹配错误）
-        # 按长度排序，优先匹配较长的别名（避免"买"匹配到"买它"）
-        sorted_aliases = sorted(dim['aliases'].items(), key=lambda x: len(x[0]), reverse=True)
-        for alias, standard in sorted_aliases:
-            alias_lower = alias.lower()
-            # 使用单词边界或独立出现来匹配
-            pattern = r'\b' + re.escape(alias_lower) + r'\b'
-            if re.search(pattern, combined_text, re.IGNORECASE):
-                return standard
+        # 优先匹配较长的别名（避免"买"匹配到"买它"）
+        standard = self.matchers()['company_alias'].search(combined_text)
+        if standard is not None:
+            return standard
         
         # 2. 检查预定义公司（使用单词边界匹配）
-        for company in dim['predefined']:
-            company_lower = company.lower()
-            pattern = r'\b' + re.escape(company_lower) + r'\b'
-            if re.search(pattern, combined_text, re.IGNORECASE):
-                return company
+        company = self.matchers()['company_predefined'].search(combined_text)
+        if company is not None:
+            return company
         
         # 3. 从标题提取（常见格式：公司名 - 岗位名）
         title_parts = re.split(r'[\-\|·]', title)
@@ -113,52 +199,24 @@ class TagExtractor:
     
     def _extract_location(self, text: str) -> str:
         """提取地点"""
-        dim = self.dimensions['location']
-        
-        # 1. 检查别名
-        for alias, standard in dim['aliases'].items():
-            if alias.lower() in text:
-                return standard
-        
-        # 2. 检查预定义地点（扁平化处理）
-        predefined_flat = []
-        if isinstance(dim['predefined'], dict):
-            for region, locations in dim['predefined'].items():
-                predefined_flat.extend(locations)
-        else:
-            predefined_flat = dim['predefined']
-        
-        for loc in predefined_flat:
-            if loc.lower() in text:
-                return loc
-        
+        # 1. 检查别名，2. 检查预定义地点（已扁平化）
+        matchers = self.matchers()
+        for matcher in (matchers['location_alias'], matchers['location_predefined']):
+            location = matcher.search(text)
+            if location is not None:
+                return location
         return ""
     
     def _extract_category(self, text: str) -> str:
         """提取岗位类别"""
-        dim = self.dimensions['category']
-        
-        # 按优先级匹配（SWE 优先级最高）
-        for cat in dim['values']:
-            for keyword in cat['keywords']:
-                # 使用单词边界匹配，避免部分匹配
-                pattern = r'\b' + re.escape(keyword.lower()) + r'\b'
-                if re.search(pattern, text, re.IGNORECASE):
-                    return cat['value']
-        
-        return "Other"
+        # 按优先级匹配（SWE 优先级最高），使用单词边界匹配，避免部分匹配
+        category = self.matchers()['category'].search(text)
+        return "Other" if category is None else category
     
     def _extract_recruit_type(self, text: str) -> str:
         """提取招聘类型"""
-        dim = self.dimensions['recruitType']
-        
-        for rt in dim['values']:
-            for keyword in rt['keywords']:
-                pattern = r'\b' + re.escape(keyword.lower()) + r'\b'
-                if re.search(pattern, text, re.IGNORECASE):
-                    return rt['value']
-        
-        return ""
+        recruit_type = self.matchers()['recruitType'].search(text)
+        return "" if recruit_type is None else recruit_type
     
     def _extract_experience(self, text: str) -> str:
         """提取经验要求"""
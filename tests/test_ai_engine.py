@@ -0,0 +1,858 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI引擎测试
+使用本地替身服务器模拟 Qwen API，验证 thread / async 两种引擎的行为一致
+"""
+
+import asyncio
+import json
+import queue
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+import pipeline
+
+
+AI_RESULT = {
+    "title": "Google SDE 面经",
+    "processedContent": "## 基本信息\n\n公司：Google\n\n## 面试过程\n\n" + "一轮电面，两轮现场。\n" * 10,
+    "company": "Google",
+    "role": "Software Engineer",
+    "difficulty": 3,
+    "tags": ["算法"],
+    "tagDimensions": {
+        "technologies": ["Python"], "recruitType": "intern", "location": "",
+        "category": "SWE", "experience": "", "salary": "", "custom": [],
+    },
+}
+
+
+class StandInServer:
+    """Qwen API 替身：按顺序返回预设的状态码，并记录每个请求使用的客户端连接
+
+    respond(prompt) 决定200响应中的模型输出（对象按```json代码块输出，字符串原样输出），默认总是返回 AI_RESULT；
+    请求带 X-DashScope-SSE 头时按SSE分块返回增量输出
+    """
+
+    def __init__(self, statuses=None, respond=None):
+        self.statuses = list(statuses or [])
+        self.respond = respond or (lambda prompt: AI_RESULT)
+        self.delay = 0.0  # 每个请求响应前等待的秒数
+        self.prompts = []
+        self.requests = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 支持keep-alive
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                prompt = request.get("input", {}).get("messages", [{}])[0].get("content", "")
+                with server.lock:
+                    server.requests += 1
+                    server.prompts.append(prompt)
+                    server.connections.add(self.client_address)
+                    status = server.statuses.pop(0) if server.statuses else 200
+                threading.Event().wait(server.delay)  # time.sleep 在测试中被替换为空操作
+                content_type = "application/json"
+                if status == 200:
+                    content = server.respond(prompt)
+                    if not isinstance(content, str):
+                        content = "```json\n" + json.dumps(content, ensure_ascii=False) + "\n```"
+                    body = {"output": {"choices": [{"message": {"content": content}}]}}
+                    if self.headers.get("X-DashScope-SSE") == "enable":
+                        content_type = "text/event-stream"
+                        events = []
+                        for n, start in enumerate(range(0, len(content), 16), 1):
+                            chunk = {"output": {"choices": [{"message": {"content": content[start:start + 16]}}]}}
+                            events.append(f"id:{n}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(chunk, ensure_ascii=False)}\n\n")
+                        payload = "".join(events).encode("utf-8")
+                else:
+                    body = {"code": str(status), "message": "stand-in error"}
+                if content_type == "application/json":
+                    payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/generation"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    def start(statuses=None, respond=None):
+        server = StandInServer(statuses, respond)
+        monkeypatch.setattr(pipeline, "QWEN_API_URL", server.url)
+        monkeypatch.setattr(pipeline, "QWEN_API_KEY", "sk-test")
+        monkeypatch.setattr(pipeline, "AI_API_KEY", "sk-test")
+        monkeypatch.setattr(pipeline, "AI_TYPE", "qwen")
+        monkeypatch.setattr(pipeline.time, "sleep", lambda s: None)
+        monkeypatch.setattr(pipeline, "ai_circuits", pipeline.CircuitBreakers())  # 熔断状态不跨测试保留
+        return server
+    return start
+
+
+def test_thread_client_parses_fenced_json_and_retries_429(stand_in):
+    """同步客户端：去掉代码块标记解析JSON，429 后重试"""
+    with stand_in([429, 200]) as server:
+        assert pipeline.call_qwen_api("prompt") == AI_RESULT
+        assert server.requests == 2
+
+
+def test_thread_client_reuses_session_connection(stand_in):
+    """同步客户端共用一个 Session：连续请求复用同一条连接（503 重试也复用）"""
+    with stand_in([503]) as server:
+        for _ in range(5):
+            assert pipeline.call_qwen_api("prompt") == AI_RESULT
+        assert pipeline.check_ai_api()[0]
+    assert server.requests == 7
+    assert len(server.connections) == 1
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_server_errors_retried_by_caller_and_counted(stand_in, monkeypatch, engine):
+    """502/503 由 call_with_retries 退避重试：每次请求都计入尝试次数与熔断统计，不改变自适应并发上限"""
+    if engine == "async":
+        aiohttp = pytest.importorskip("aiohttp")
+    calls = []
+    ai_call = pipeline.AICall
+    monkeypatch.setattr(pipeline, "AICall", lambda *args: calls.append(ai_call(*args)) or calls[-1])
+    controller = pipeline.AdaptiveConcurrency(4, max_limit=4, latency_target=60)
+    monkeypatch.setattr(pipeline, "ai_concurrency", controller)
+    monkeypatch.setattr(pipeline, "RETRY_MAX_DELAY", 0.01)  # async引擎用 asyncio.sleep 退避
+
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            return await pipeline.call_qwen_api_async(session, "prompt")
+
+    with stand_in([503, 502]) as server:
+        result = pipeline.call_qwen_api("prompt") if engine == "thread" else asyncio.run(run())
+        assert result == AI_RESULT
+        assert server.requests == 3
+    assert (calls[0].attempts, calls[0].http_status) == (3, 200)
+    assert list(pipeline.ai_circuits.get("qwen")._outcomes) == [False, False, True]
+    assert controller.limit == 4 and controller.overloads == 0
+
+
+def test_async_client_reuses_pooled_connections(stand_in):
+    """async客户端：并发请求共享连接池，连接数不超过池大小"""
+    aiohttp = pytest.importorskip("aiohttp")
+
+    async def run():
+        connector = aiohttp.TCPConnector(limit=4)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(*(pipeline.call_qwen_api_async(session, f"p{i}") for i in range(40)))
+
+    with stand_in() as server:
+        results = asyncio.run(run())
+    assert results == [AI_RESULT] * 40
+    assert server.requests == 40
+    assert len(server.connections) <= 4
+
+
+def test_async_client_raises_on_server_error(stand_in):
+    """非 200/429 的响应直接失败，不重试"""
+    aiohttp = pytest.importorskip("aiohttp")
+
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            await pipeline.call_qwen_api_async(session, "prompt")
+
+    with stand_in([500]) as server:
+        with pytest.raises(Exception, match="API returned 500"):
+            asyncio.run(run())
+        assert server.requests == 1
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_run_pipeline_engines_produce_same_output(stand_in, tmp_path, engine):
+    """两种引擎对样例输入产生相同的final文件与状态"""
+    if engine == "async":
+        pytest.importorskip("aiohttp")
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    out_dir = tmp_path / "out"
+    with stand_in():
+        pipeline.run_pipeline(html_dir, out_dir, engine=engine)
+
+    final_files = sorted((out_dir / "final").glob("*.json"))
+    assert len(final_files) == len(list(html_dir.glob("*.html")))
+    for final_path in final_files:
+        final_data = json.loads(final_path.read_text(encoding="utf-8"))
+        assert final_data["processedContent"] == AI_RESULT["processedContent"]
+        assert final_data["tagDimensions"]["category"] == "SWE"
+
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    statuses = [row[0] for row in conn.execute("SELECT status FROM processing_state")]
+    assert statuses == ["ok"] * len(final_files)
+
+
+def test_split_batch_response_maps_ids_and_drops_invalid():
+    """批量响应按 id 对应回编号，缺少 id 时按位置；越界、重复与非对象条目被丢弃"""
+    processed = {"results": [{"id": "2", "title": "b"}, {"id": 2, "title": "dup"}, {"title": "pos3"},
+                             {"id": "9", "title": "x"}, "junk"]}
+    assert pipeline.split_batch_response(processed, 3) == {2: {"title": "b"}, 3: {"title": "pos3"}}
+    assert pipeline.split_batch_response([{"id": "1", "title": "a"}], 1) == {1: {"title": "a"}}
+    assert pipeline.split_batch_response({"title": "not a batch"}, 2) == {}
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_run_pipeline_batches_short_posts_and_retries_missing_item(stand_in, tmp_path, engine):
+    """批量模式：两篇短面经合并为一个请求，批量响应中缺失的那篇单独重试"""
+    if engine == "async":
+        pytest.importorskip("aiohttp")
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    out_dir = tmp_path / "out"
+
+    def respond(prompt):
+        if "=== 面经 2 ===" in prompt:
+            return {"results": [dict(AI_RESULT, id="1")]}  # 只返回第1篇
+        return AI_RESULT
+
+    with stand_in(respond=respond) as server:
+        pipeline.run_pipeline(html_dir, out_dir, engine=engine, batch_size=2)
+
+    batch_prompt, retry_prompt = server.prompts[-2:]  # 之前是启动时的API检查
+    assert server.requests == 3
+    assert "=== 面经 2 ===" in batch_prompt and "=== 面经" not in retry_prompt
+    assert len(list((out_dir / "final").glob("*.json"))) == 2
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    assert [row[0] for row in conn.execute("SELECT status FROM processing_state")] == ["ok", "ok"]
+
+
+def test_run_pipeline_records_parse_worker_exception_as_bad(stand_in, tmp_path, monkeypatch):
+    """解析进程中 prepare_file 之外的异常（future.result() 抛出）记为该文件 bad，其余文件照常处理"""
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    out_dir = tmp_path / "out"
+    prepare_file = pipeline.prepare_file
+
+    def crash(html_path, content_hash, raw_dir):
+        if html_path.name == "test2.html":
+            raise MemoryError("worker died")
+        return prepare_file(html_path, content_hash, raw_dir)
+
+    # 用线程池代替进程池，让替换后的 prepare_file 生效
+    monkeypatch.setattr(pipeline, "ProcessPoolExecutor",
+                        lambda max_workers, mp_context=None: ThreadPoolExecutor(max_workers=max_workers))
+    monkeypatch.setattr(pipeline, "prepare_file", crash)
+    with stand_in():
+        pipeline.run_pipeline(html_dir, out_dir)
+
+    assert "MemoryError: worker died" in (out_dir / "bad" / "test2.error.txt").read_text(encoding="utf-8")
+    assert len(list((out_dir / "final").glob("*.json"))) == 1
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    statuses = conn.execute("SELECT status, error_reason FROM processing_state ORDER BY status").fetchall()
+    assert statuses == [("bad", "worker died"), ("ok", None)]
+
+
+def test_run_pipeline_applies_backpressure_and_shuts_down_cleanly(stand_in, tmp_path, monkeypatch):
+    """AI阶段慢于解析时，有界队列写满后解析阶段阻塞等待；运行结束后所有文件处理完毕，没有遗留的工作线程"""
+    source = (project_root / "hh_pipeline" / "test_input" / "test1.html").read_text(encoding="utf-8")
+    html_dir = tmp_path / "html"
+    html_dir.mkdir()
+    for n in range(6):
+        (html_dir / f"{n}.html").write_text(source.replace("</body>", f"<p>第{n}篇</p></body>"), encoding="utf-8")
+
+    blocked = []
+
+    class WatchedQueue(queue.Queue):
+        def put(self, item, block=True, timeout=None):
+            if self.maxsize and item is not None and self.full():
+                blocked.append(item)
+            super().put(item, block, timeout)
+
+    monkeypatch.setattr(pipeline.queue, "Queue", WatchedQueue)
+    monkeypatch.setattr(pipeline, "PREPARED_QUEUE_SIZE", 1)
+    monkeypatch.setattr(pipeline, "CONCURRENCY", 1)
+    monkeypatch.setattr(pipeline, "AI_MAX_CONCURRENCY", 1)
+    with stand_in() as server:
+        server.delay = 0.05
+        workers_before = {t for t in threading.enumerate() if not t.daemon}
+        pipeline.run_pipeline(html_dir, tmp_path / "out", use_ai_cache=False)
+        workers_after = {t for t in threading.enumerate() if not t.daemon}
+
+    assert blocked  # 队列满时解析阶段等待AI阶段
+    assert server.requests == 7  # API检查 + 每个文件一次
+    assert len(list((tmp_path / "out" / "final").glob("*.json"))) == 6
+    assert workers_after <= workers_before
+
+
+def test_run_pipeline_links_near_duplicates_to_canonical_result(stand_in, tmp_path):
+    """开启近似去重后页面框架不同的转载帖不再调用AI：同一批次等待规范结果，之后的批次从已保存的AI响应复用"""
+    source = project_root / "hh_pipeline" / "test_input" / "test1.html"
+    html_dir = tmp_path / "html"
+    html_dir.mkdir()
+    original = source.read_text(encoding="utf-8")
+    (html_dir / "a.html").write_text(original, encoding="utf-8")
+    (html_dir / "b.html").write_text(original + "\n<!-- 广告位 -->", encoding="utf-8")
+    out_dir = tmp_path / "out"
+
+    with stand_in() as server:
+        pipeline.run_pipeline(html_dir, out_dir, near_dup_distance=pipeline.NEAR_DUP_MAX_DISTANCE)
+        assert server.requests == 2  # API检查 + 规范结果一次
+
+        (html_dir / "c.html").write_text(original + "\n<!-- 另一个广告位 -->", encoding="utf-8")
+        pipeline.run_pipeline(html_dir, out_dir, near_dup_distance=pipeline.NEAR_DUP_MAX_DISTANCE)
+        assert server.requests == 3  # 只有API检查
+
+        (html_dir / "d.html").write_text(original + "\n<!-- 第三个广告位 -->", encoding="utf-8")
+        pipeline.run_pipeline(html_dir, out_dir, use_ai_cache=False)
+        assert server.requests == 5  # 默认不做近似去重（关闭响应缓存）时照常调用AI
+
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    assert [row[0] for row in conn.execute("SELECT status FROM processing_state")] == ["ok"] * 4
+    canonical = conn.execute("SELECT content_hash FROM content_simhash").fetchall()
+    links = conn.execute("SELECT canonical_hash, distance FROM near_duplicates").fetchall()
+    assert len(canonical) == 1 and links == [(canonical[0][0], 0)] * 2
+    marks = {path.stem: json.loads(path.read_text(encoding="utf-8")).get("canonicalOf")
+             for path in (out_dir / "final").glob("*.json")}
+    canonical_ids = [stem for stem, mark in marks.items() if mark is None and stem != "d"]
+    assert len(canonical_ids) == 1 and marks["d"] is None
+    assert sorted(mark for mark in marks.values() if mark) == canonical_ids * 2
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_streaming_aborts_malformed_generation_and_retries(stand_in, engine):
+    """流式模式：不是JSON的输出提前中止并重试，第二次的增量输出拼接后解析，记录首token时间"""
+    if engine == "async":
+        pytest.importorskip("aiohttp")
+    outputs = ["抱歉，我无法处理这篇内容。" * 20, AI_RESULT]
+    pipeline.qwen_streaming.configure(True)
+    try:
+        with stand_in(respond=lambda prompt: outputs.pop(0)) as server:
+            if engine == "thread":
+                result = pipeline.call_qwen_api("prompt")
+            else:
+                async def run():
+                    async with pipeline.aiohttp.ClientSession() as session:
+                        return await pipeline.call_qwen_api_async(session, "prompt")
+                result = asyncio.run(run())
+        assert result == AI_RESULT
+        assert server.requests == 2
+        assert pipeline.qwen_streaming.aborted == 1
+        assert len(pipeline.qwen_streaming.first_token_seconds) == 1
+    finally:
+        pipeline.qwen_streaming.configure(False)
+
+
+def _router_for(servers, **kwargs):
+    """两个Qwen兼容的替身服务器作为两个服务商"""
+    router = pipeline.AIRouter(**kwargs)
+    router.configure({name: ("model-" + name, lambda prompt, url=server.url: pipeline.call_qwen_api(prompt, url=url))
+                      for name, server in servers.items()})
+    return router
+
+
+def test_router_weights_traffic_by_latency_and_errors():
+    """延迟低、错误少的服务商获得更多流量；出错的服务商仍保留少量流量"""
+    router = pipeline.AIRouter()
+    router.configure({"fast": ("m1", None), "slow": ("m2", None), "broken": ("m3", None)})
+    for _ in range(10):
+        router.stats["fast"].record(0.2, True)
+        router.stats["slow"].record(2.0, True)
+        router.stats["broken"].record(0.2, False)
+    picks = [router.choose() for _ in range(2000)]
+    assert picks.count("fast") > 5 * picks.count("slow") > 0
+    assert 0 < picks.count("broken") < picks.count("fast")
+    assert router.choose(exclude=("fast", "slow", "broken")) is None
+
+
+def test_router_hedges_slow_provider_and_fails_over_errors(stand_in, monkeypatch):
+    """主请求超过p95仍未返回时向另一服务商对冲，取先返回的结果；主请求出错时立即改用另一服务商"""
+    with stand_in() as slow, stand_in() as fast:
+        router = _router_for({"slow": slow, "fast": fast}, min_samples=3)
+        monkeypatch.setattr(router, "choose", lambda exclude=(): "fast" if "slow" in exclude else "slow")
+        for _ in range(3):  # 积累延迟样本，启用对冲
+            assert router.call("prompt") == ("model-slow", AI_RESULT)
+
+        slow.delay = 2.0
+        started = time.monotonic()
+        assert router.call("prompt") == ("model-fast", AI_RESULT)
+        assert time.monotonic() - started < 1.5
+        assert router.stats["fast"].hedges == 1 and router.stats["fast"].wins == 1
+
+        slow.delay = 0.0
+        slow.statuses = [500]
+        assert router.call("prompt") == ("model-fast", AI_RESULT)
+        assert router.stats["fast"].hedges == 1  # 失败转移不算对冲
+        threading.Event().wait(2.2)  # 等落后的请求完成并计入统计
+        assert router.stats["slow"].errors == 1
+
+
+def test_gemini_client_configured_once_and_cached_per_thread(monkeypatch):
+    """genai 只导入并配置一次，每个线程复用自己的 GenerativeModel"""
+    class FakeGenAI:
+        configured = 0
+        GenerativeModel = staticmethod(lambda name: object())
+
+        @classmethod
+        def configure(cls, api_key):
+            cls.configured += 1
+
+    monkeypatch.setitem(sys.modules, "google", types.SimpleNamespace(generativeai=FakeGenAI))
+    monkeypatch.setitem(sys.modules, "google.generativeai", FakeGenAI)
+    monkeypatch.setattr(pipeline, "_gemini_genai", None)
+    monkeypatch.setattr(pipeline, "_gemini_local", threading.local())
+
+    pipeline.warm_up_gemini()
+    main_model = pipeline.get_gemini_model()
+    assert pipeline.get_gemini_model() is main_model
+
+    others = []
+    worker = threading.Thread(target=lambda: others.extend([pipeline.get_gemini_model(), pipeline.get_gemini_model()]))
+    worker.start()
+    worker.join()
+    assert others[0] is others[1] and others[0] is not main_model
+    assert FakeGenAI.configured == 1
+
+
+def test_adaptive_concurrency_aimd():
+    """成功时加性增长，429/超时乘性减半，同一轮拥塞只减一次"""
+    controller = pipeline.AdaptiveConcurrency(4, min_limit=1, max_limit=8, latency_target=60)
+
+    for _ in range(5):  # 每个成功请求 +1/limit
+        with controller.call():
+            pass
+    assert controller.limit == 5
+
+    # 同时在途的两个请求都遇到429：只减半一次
+    first, second = controller.acquire(), controller.acquire()
+    controller.release(first, "overload")
+    controller.release(second, "overload")
+    assert controller.limit == 2
+    assert controller.overloads == 2
+
+    # 超时异常也视为过载；普通错误不改变上限
+    with pytest.raises(pipeline.requests.Timeout):
+        with controller.call():
+            raise pipeline.requests.Timeout("read timed out")
+    assert controller.limit == 1
+    with pytest.raises(ValueError):
+        with controller.call():
+            raise ValueError("bad json")
+    assert controller.limit == 1
+
+    for _ in range(100):
+        with controller.call():
+            pass
+    assert controller.limit == 8
+
+
+def test_adaptive_concurrency_blocks_at_limit():
+    """在途请求达到上限时阻塞，释放后放行"""
+    controller = pipeline.AdaptiveConcurrency(1, max_limit=1)
+    started = controller.acquire()
+    assert controller.try_acquire() is None
+
+    acquired = threading.Event()
+
+    def worker():
+        controller.release(controller.acquire(), "ok")
+        acquired.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    assert not acquired.wait(0.1)
+    controller.release(started, "ok")
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_adaptive_concurrency_async_waiters_queue_in_order():
+    """协程没有名额时排队而不是轮询：按先来后到放行；被取消的等待者不占名额（已分到的名额会交给下一个）"""
+    controller = pipeline.AdaptiveConcurrency(1, max_limit=1)
+
+    async def run():
+        order = []
+
+        async def waiter(n):
+            started = await controller.acquire_async()
+            order.append(n)
+            controller.release(started, "error")
+
+        held = await controller.acquire_async()
+        tasks = [asyncio.create_task(waiter(n)) for n in range(5)]
+        await asyncio.sleep(0)
+        assert len(controller._async_waiters) == 5
+        assert controller.try_acquire() is None  # 不插队
+        tasks[2].cancel()
+        await asyncio.to_thread(controller.release, held, "error")  # 从其他线程释放
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert order == [0, 1, 3, 4]
+
+        # 名额已经分给等待者、它还没醒来就被取消：名额归还
+        held = await controller.acquire_async()
+        task = asyncio.create_task(waiter(5))
+        await asyncio.sleep(0)
+        controller.release(held, "error")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert controller.in_flight == 0
+        assert order == [0, 1, 3, 4]
+
+    asyncio.run(run())
+    assert controller.in_flight == 0 and not controller._async_waiters
+
+
+def test_qwen_429_reduces_shared_limit(stand_in, monkeypatch):
+    """call_qwen_api 遇到429时降低共享的并发上限"""
+    controller = pipeline.AdaptiveConcurrency(8, max_limit=8, latency_target=60)
+    monkeypatch.setattr(pipeline, "ai_concurrency", controller)
+    with stand_in([429, 200]):
+        assert pipeline.call_qwen_api("prompt") == AI_RESULT
+    assert controller.limit == 4
+    assert controller.in_flight == 0
+
+
+def test_rate_limiter_spaces_reservations():
+    """请求桶耗尽后，后续预约按速率依次顺延"""
+    limiter = pipeline.RateLimiter(rpm=2)
+    waits = [limiter.reserve()[0] for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(30, abs=0.5)
+    assert waits[3] == pytest.approx(60, abs=0.5)
+
+
+def test_rate_limiter_token_bucket_settles_actual_usage():
+    """token桶按预估预约，收到实际用量后多退少补"""
+    limiter = pipeline.RateLimiter(tpm=1000)
+    wait, reserved = limiter.reserve(600)
+    assert (wait, reserved) == (0.0, 600)
+    limiter.settle(reserved, 200)  # 实际只用了200，退还400
+    assert limiter.reserve(700)[0] == 0.0
+    # 超过整桶的请求按整桶计
+    assert limiter.reserve(5000)[1] == 1000
+
+
+def test_retry_honours_retry_after_and_jitter(monkeypatch):
+    """429 带 Retry-After 时至少等待指定时间并暂停共享限流；退避时间在上下限之间"""
+    limiter = pipeline.RateLimiter()
+    monkeypatch.setattr(pipeline, "ai_rate_limiter", limiter)
+    sleeps = []
+    monkeypatch.setattr(pipeline.time, "sleep", sleeps.append)
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise pipeline.RateLimitedError("API returned 429", retry_after=7)
+        if len(attempts) == 2:
+            raise pipeline.requests.Timeout("read timed out")
+        return "ok"
+
+    assert pipeline.call_with_retries(send, retries=3) == "ok"
+    assert sleeps[0] >= 7
+    assert pipeline.RETRY_BASE_DELAY <= sleeps[1] <= pipeline.RETRY_MAX_DELAY
+    assert limiter.reserve()[0] > 0  # Retry-After 期间其他调用也要等待
+
+
+def test_retry_gives_up_on_exhaustion_and_non_retryable(monkeypatch):
+    """重试耗尽时保留原有的错误信息；解析错误不重试"""
+    monkeypatch.setattr(pipeline, "ai_rate_limiter", pipeline.RateLimiter())
+    monkeypatch.setattr(pipeline.time, "sleep", lambda s: None)
+    calls = []
+
+    def rate_limited():
+        calls.append(1)
+        raise pipeline.RateLimitedError("API returned 429")
+
+    def bad_json():
+        calls.append(1)
+        raise ValueError("Failed to parse JSON")
+
+    with pytest.raises(Exception, match="Rate limited after 1 retries"):
+        pipeline.call_with_retries(rate_limited, retries=1)
+    assert len(calls) == 2
+    calls.clear()
+    with pytest.raises(ValueError):
+        pipeline.call_with_retries(bad_json, retries=3)
+    assert len(calls) == 1
+
+
+def test_parse_retry_after():
+    assert pipeline.parse_retry_after("5") == 5.0
+    assert pipeline.parse_retry_after(None) is None
+    assert pipeline.parse_retry_after("soon") is None
+    assert pipeline.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_ai_cache_reuses_accepted_responses_and_drops_rejected_ones(stand_in, tmp_path, monkeypatch):
+    """被接受的响应命中缓存不再调用API；被校验拒绝的响应从缓存删除，重试时重新调用；--no-ai-cache 时直接调用"""
+    cache = pipeline.AIResponseCache()
+    monkeypatch.setattr(pipeline, "ai_response_cache", cache)
+    cache.open(tmp_path / "ai_cache.sqlite")
+    original = pipeline.build_final_data
+    raw_data = {"title": "t", "originalContentText": "c"}
+    prompt = pipeline.build_prompt("t", "c")
+
+    def reject(raw_data, processed):
+        raise ValueError("tagDimensions 验证失败")
+
+    with stand_in() as server:
+        monkeypatch.setattr(pipeline, "build_final_data", reject)
+        with pytest.raises(ValueError):
+            pipeline.process_with_ai(raw_data)
+        assert cache.get(pipeline.QWEN_MODEL, prompt) is None
+        monkeypatch.setattr(pipeline, "build_final_data", original)
+        assert pipeline.process_with_ai(raw_data)["company"] == "Google"
+        assert server.requests == 2
+        assert pipeline.process_with_ai(raw_data)["company"] == "Google"
+        assert server.requests == 2
+        assert cache.hits == 1
+
+        cache.close()
+        pipeline.process_with_ai(raw_data)
+        assert server.requests == 3
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_pipeline_drops_rejected_responses_from_ai_cache(stand_in, tmp_path, monkeypatch, engine):
+    """流水线中被校验拒绝的响应不留在缓存中：重跑 bad 文件时重新调用API，两种引擎相同"""
+    if engine == "async":
+        pytest.importorskip("aiohttp")
+    html_dir = tmp_path / "html"
+    html_dir.mkdir()
+    (html_dir / "1.html").write_text(
+        "<html><head><title>Google SDE 面经</title></head><body><div class='post'>一轮电面，问了LRU缓存</div></body></html>",
+        encoding="utf-8")
+    original = pipeline.build_final_data
+
+    def reject(raw_data, processed):
+        raise ValueError("tagDimensions 验证失败")
+
+    out_dir = tmp_path / "out"
+    with stand_in() as server:
+        monkeypatch.setattr(pipeline, "build_final_data", reject)
+        pipeline.run_pipeline(html_dir, out_dir, engine=engine)
+        assert (out_dir / "bad" / "1.error.txt").exists()
+        monkeypatch.setattr(pipeline, "build_final_data", original)
+        pipeline.run_pipeline(html_dir, out_dir, engine=engine)
+        assert (out_dir / "final" / "1.json").exists()
+        assert server.requests == 4  # 每次运行：API检查 + AI调用一次（第二次没有命中被拒绝的缓存响应）
+
+
+def test_ai_cache_eviction_by_age_and_size(tmp_path):
+    """过期记录与超出大小上限的最旧记录被清理"""
+    cache = pipeline.AIResponseCache(max_mb=1, max_age_days=1)
+    cache.open(tmp_path / "ai_cache.sqlite")
+    payload = {"processedContent": "x" * 300_000}
+    for i in range(5):
+        cache.put("m", f"p{i}", payload)
+    cache._conn.execute("UPDATE ai_responses SET created_at = created_at - 2 * 86400 WHERE cache_key = ?",
+                        (cache.key("m", "p4"),))
+    cache._conn.execute("UPDATE ai_responses SET created_at = created_at - 10 WHERE cache_key = ?",
+                        (cache.key("m", "p0"),))
+    cache._conn.commit()
+
+    assert cache.get("m", "p4") is None  # 过期记录不会命中
+    assert cache.evict() == 2  # p4 过期；剩余超出1MB，删除最旧的 p0
+    assert cache.get("m", "p0") is None
+    assert all(cache.get("m", f"p{i}") == payload for i in (1, 2, 3))
+    assert cache.get("other-model", "p1") is None  # 不同模型不共用缓存
+    cache.close()
+
+
+def test_renormalize_rebuilds_derived_fields_offline(stand_in, tmp_path, monkeypatch):
+    """renormalize 用保存的AI原始响应重建推导字段，不访问网络，并同步状态库指纹"""
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    out_dir = tmp_path / "out"
+    with stand_in():
+        pipeline.run_pipeline(html_dir, out_dir)
+
+    ai_files = sorted((out_dir / "ai").glob("*.json"))
+    final_files = sorted((out_dir / "final").glob("*.json"))
+    assert [p.name for p in ai_files] == [p.name for p in final_files]
+    assert json.loads(ai_files[0].read_text(encoding="utf-8"))["response"] == AI_RESULT
+
+    # 模拟旧版规范化留下的结果，以及一个无法通过校验的响应
+    stale_path, broken_path = final_files[0], final_files[1]
+    stale = json.loads(stale_path.read_text(encoding="utf-8"))
+    stale.update(company="旧公司名", usefulVotes=3)
+    stale_path.write_text(json.dumps(stale, ensure_ascii=False), encoding="utf-8")
+    broken_before = broken_path.read_bytes()
+    (out_dir / "ai" / broken_path.name).write_text(json.dumps({"model": "m", "response": {"title": "t"}}), encoding="utf-8")
+
+    monkeypatch.setattr(pipeline.requests.Session, "request", lambda *a, **k: pytest.fail("不应访问网络"))
+    pipeline.renormalize(out_dir, workers=1)
+
+    renormalized = json.loads(stale_path.read_text(encoding="utf-8"))
+    assert renormalized["company"] == "Google"
+    assert renormalized["usefulVotes"] == 3  # 非推导字段保持不变
+    assert broken_path.read_bytes() == broken_before
+
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    size, mtime_ns = conn.execute("SELECT final_size, final_mtime_ns FROM processing_state WHERE file_id = ?",
+                                  (stale_path.stem,)).fetchone()
+    assert (size, mtime_ns) == (stale_path.stat().st_size, stale_path.stat().st_mtime_ns)
+
+
+def test_record_then_replay_without_network(stand_in, tmp_path, monkeypatch):
+    """录制的响应与耗时可以在没有API Key、不访问网络的情况下回放，结果与录制时相同；未录制的提示词按失败处理"""
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    cassette = tmp_path / "calls.jsonl"
+    with stand_in() as server:
+        server.delay = 0.1
+        pipeline.run_pipeline(html_dir, tmp_path / "recorded", use_ai_cache=False, record=cassette)
+
+    entries = [json.loads(line) for line in cassette.read_text(encoding="utf-8").splitlines()]
+    assert len(entries) == len(list(html_dir.glob("*.html")))
+    assert all(e["response"] == AI_RESULT and e["model"] == pipeline.QWEN_MODEL and e["latency"] >= 0.1 for e in entries)
+
+    for name in ("QWEN_API_KEY", "AI_API_KEY", "AI_TYPE"):
+        monkeypatch.setattr(pipeline, name, None)
+    monkeypatch.setattr(pipeline.requests.Session, "request", lambda *a, **k: pytest.fail("不应访问网络"))
+    sleeps = []
+    monkeypatch.setattr(pipeline.time, "sleep", sleeps.append)
+    pipeline.run_pipeline(html_dir, tmp_path / "replayed", replay=cassette)
+    for recorded in sorted((tmp_path / "recorded" / "final").glob("*.json")):
+        replayed = json.loads((tmp_path / "replayed" / "final" / recorded.name).read_text(encoding="utf-8"))
+        assert replayed["processedContent"] == json.loads(recorded.read_text(encoding="utf-8"))["processedContent"]
+    assert sorted(sleeps)[-len(entries):] == sorted(e["latency"] for e in entries)
+
+    # 只保留第一条录制（并模拟录制中断留下的半行），其余文件因没有录制而失败
+    cassette.write_text(json.dumps(entries[0], ensure_ascii=False) + "\n" + '{"key": "trunc', encoding="utf-8")
+    pipeline.run_pipeline(html_dir, tmp_path / "partial", replay=cassette, replay_zero_latency=True)
+    assert len(list((tmp_path / "partial" / "final").glob("*.json"))) == 1
+    errors = list((tmp_path / "partial" / "bad").glob("*.error.txt"))
+    assert len(errors) == len(entries) - 1 and "CassetteMissError" in errors[0].read_text(encoding="utf-8")
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    """失败率达到阈值后熔断；冷却后只放行一个探测请求，探测成功则恢复并唤醒等待的调用；故障超过 max_wait 时快速失败"""
+    breaker = pipeline.CircuitBreaker("qwen", failure_rate=0.5, min_calls=4, window=4, cooldown=0.05, max_wait=5)
+    for ok in (True, False, True):
+        breaker.record(ok)
+    assert breaker.state == "closed"  # 样本不足
+    breaker.record(False)
+    assert breaker.state == "open" and breaker.opens == 1
+
+    assert breaker.acquire() is True and breaker.state == "half-open"
+    waiter = []
+    thread = threading.Thread(target=lambda: waiter.append(breaker.acquire()))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()  # 探测结果出来之前其他调用等待
+    breaker.record(True, probe=True)
+    thread.join(1)
+    assert waiter == [False] and breaker.state == "closed" and breaker.open_seconds > 0
+
+    breaker = pipeline.CircuitBreaker("qwen", failure_rate=1.0, min_calls=1, cooldown=10, max_wait=0.05)
+    breaker.record(False)
+    with pytest.raises(pipeline.CircuitOpenError):
+        breaker.acquire()
+    assert breaker.fast_failures == 1
+    assert not pipeline._is_retryable(pipeline.CircuitOpenError("open"))
+
+    call = pipeline.AICall("qwen", pipeline.QWEN_MODEL)
+    assert pipeline._is_outage(pipeline.requests.ConnectionError("refused"), call)
+    assert pipeline._is_outage(pipeline.requests.Timeout("read timed out"), call)
+    assert pipeline._is_outage(pipeline.RateLimitedError("API returned 429"), call)
+    assert not pipeline._is_outage(OSError("disk full"), call)  # 本地错误不是服务商故障
+    assert not pipeline._is_outage(UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid"), call)
+    assert not pipeline._is_outage(ValueError("Failed to parse JSON"), call)
+    call.http_status = 503
+    assert pipeline._is_outage(Exception("API returned 503"), call)
+
+
+def test_circuit_probe_slot_released_when_probe_is_interrupted(monkeypatch):
+    """探测请求被 BaseException 中断（如取消）时归还探测名额，下一个调用方立即探测而不是等到 max_wait"""
+    monkeypatch.setattr(pipeline, "ai_circuits", pipeline.CircuitBreakers())
+    pipeline.ai_circuits.configure(failure_rate=1.0, min_calls=1, window=1, cooldown=0.0, max_wait=30)
+    call = pipeline.AICall("qwen", pipeline.QWEN_MODEL)
+    pipeline.ai_circuits.get("qwen").record(False)
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        pipeline.call_with_retries(interrupted, retries=0, call=call)
+    started = time.monotonic()
+    assert pipeline.call_with_retries(lambda: "ok", retries=0, call=call) == "ok"
+    assert time.monotonic() - started < 1 and pipeline.ai_circuits.get("qwen").state == "closed"
+
+    async def cancelled():
+        raise asyncio.CancelledError
+
+    pipeline.ai_circuits.get("qwen").record(False)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(pipeline.call_with_retries_async(cancelled, retries=0, call=call))
+    assert not pipeline.ai_circuits.get("qwen")._probing
+
+
+def test_outage_defers_files_instead_of_marking_bad(stand_in, tmp_path, monkeypatch):
+    """服务商持续超时：熔断后剩余文件快速失败，不写入bad、不更新状态，恢复后下次运行正常处理"""
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    monkeypatch.setattr(pipeline, "API_TIMEOUT", 0.2)
+    monkeypatch.setattr(pipeline, "CIRCUIT_MIN_CALLS", 1)
+    monkeypatch.setattr(pipeline, "CIRCUIT_COOLDOWN", 10)
+    monkeypatch.setattr(pipeline, "CIRCUIT_MAX_WAIT", 0.1)
+    out_dir = tmp_path / "out"
+    with stand_in() as server:
+        server.delay = 0.5  # 启动时的API检查（5秒超时）通过，之后每个请求都超时
+        started = time.monotonic()
+        pipeline.run_pipeline(html_dir, out_dir, use_ai_cache=False, near_dup_distance=None)
+    assert time.monotonic() - started < 5
+    assert not list((out_dir / "bad").glob("*.error.txt")) and not list((out_dir / "final").glob("*.json"))
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    assert conn.execute("SELECT COUNT(*) FROM processing_state").fetchone()[0] == 0
+    conn.close()
+
+    with stand_in():
+        pipeline.run_pipeline(html_dir, out_dir, use_ai_cache=False, near_dup_distance=None)
+    assert len(list((out_dir / "final").glob("*.json"))) == len(list(html_dir.glob("*.html")))
+
+
+def test_async_tasks_save_the_model_of_their_own_call(stand_in, tmp_path):
+    """async引擎的并发任务共用一个线程：每个文件保存的模型名来自自己的调用，不会被其他任务覆盖"""
+    pytest.importorskip("aiohttp")
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    cassette = tmp_path / "calls.jsonl"
+    with stand_in():
+        pipeline.run_pipeline(html_dir, tmp_path / "recorded", use_ai_cache=False, record=cassette)
+
+    # 第一条回放较慢：它等待期间另一个任务完成并保存结果
+    entries = [json.loads(line) for line in cassette.read_text(encoding="utf-8").splitlines()]
+    for n, entry in enumerate(entries):
+        entry.update(model=f"model-{n}", latency=0.3 if n == 0 else 0.0)
+    cassette.write_text("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries), encoding="utf-8")
+    out_dir = tmp_path / "replayed"
+    pipeline.run_pipeline(html_dir, out_dir, engine="async", replay=cassette)
+
+    expected = {e["key"]: e["model"] for e in entries}
+    saved = {}
+    for html_path in html_dir.glob("*.html"):
+        prepared = pipeline.prepare_file(html_path, pipeline.compute_content_hash(html_path), out_dir / "raw")
+        payload = json.loads((out_dir / "ai" / f"{prepared['file_id']}.json").read_text(encoding="utf-8"))
+        prompt = prepared["prompt"]
+        saved[pipeline.ai_cassette.key(prompt)] = payload["model"]
+    assert saved == expected
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    assert sorted(row[0] for row in conn.execute("SELECT model FROM prompt_metrics")) == sorted(expected.values())
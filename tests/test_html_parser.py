@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTML解析快速通道测试
+确保 lxml 单次解析的输出与 BeautifulSoup 路径完全一致
+"""
+
+import sys
+from pathlib import Path
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+from html_utils import parse_html_fast
+from pipeline import _parse_html_bs4, parse_html
+
+
+EDGE_CASES = [
+    # jammer 两侧文本：标题中保持独立，正文重新解析后合并
+    '<div class="thread_subject">Goo<font class="jammer">x</font>gle  <b>SDE</b></div>'
+    '<div class="post_time"> 2022 <!-- c --> x</div>'
+    '<div class="article_body">foo<font class="jammer">x</font>bar<font class="jammer">y</font>'
+    '   <font class="jammer">y</font>baz</div>',
+    # 属性排序/引号、多值属性、转义、script/style、pre/textarea、template/ruby
+    '<div class="thread_subject">t</div>'
+    '<div class="article_body  x"  data-a=\'He said "hi"\' title="Bob\'s &quot;bar&quot;">'
+    '<br><img src="a.png?x=1&y=2"><p class=" a  b ">a &lt; b &amp; c&nbsp;d</p>'
+    '<script>if (a<b) {x="</p>"}</script><style>p>a{}</style><pre>  \n  x  \n</pre>  \n  <!--   -->'
+    '<textarea>  </textarea><template><p>tpl</p></template>'
+    '<ruby>漢<rp>(</rp><rt>kan</rt><rp>)</rp></ruby></div>',
+    # 嵌套 jammer、表格单元格、多值 rel/headers
+    '<div class="thread_subject">t</div><div class="article_body"><div class="jammer">'
+    '<span class="jammer">n</span>x</div>tail<table><tr><td headers=" h1  h2 ">c</td></tr></table>'
+    '<a rel="nofollow  noopener" href="#">l</a></div>',
+    # BOM + DOCTYPE、游离的 <td>
+    '﻿<!DOCTYPE html><div class=thread_subject>A\tB</div>'
+    '<div class="article_body"><td>cell</td> <font class="jammer">z</font> text</div>',
+]
+
+
+def test_fast_path_matches_bs4_on_edge_cases():
+    """快速通道与 bs4 逐字段一致"""
+    for raw_html in EDGE_CASES:
+        fast = parse_html_fast(raw_html)
+        assert fast is not None
+        assert fast == _parse_html_bs4(raw_html)
+
+
+def test_fast_path_declines_ambiguous_markup():
+    """无法保证一致的结构返回 None，由 bs4 处理"""
+    assert parse_html_fast('<div class="article_body"><p>no title</p></div>') is None
+    assert parse_html_fast('<div class="thread_subject">t</div><div class="article_body"><input disabled></div>') is None
+    assert parse_html_fast("") is None
+
+
+def test_parse_html_engines_agree_on_sample_files():
+    """test_input 中的样例文件两种引擎结果一致"""
+    html_files = sorted((project_root / "hh_pipeline" / "test_input").glob("*.html"))
+    assert html_files
+    for html_path in html_files:
+        assert parse_html(html_path, engine="lxml") == parse_html(html_path, engine="bs4")
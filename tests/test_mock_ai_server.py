@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Qwen API 模拟服务器测试
+确保合成输出能通过 Pipeline 的校验，故障注入（429、格式错误、延迟）按配置生效，完整 Pipeline 可以离线跑通
+"""
+
+import json
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+import pipeline
+from mock_ai_server import MockProfile, MockQwenServer, parse_latency, synthesize_response
+
+
+HTML_DIR = project_root / "hh_pipeline" / "test_input"
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """启动模拟服务器并把 Pipeline 指向它"""
+    servers = []
+
+    def start(**profile):
+        server = MockQwenServer(MockProfile(**profile)).start()
+        servers.append(server)
+        monkeypatch.setattr(pipeline, "QWEN_API_URL", server.url)
+        monkeypatch.setattr(pipeline, "QWEN_API_KEY", "mock")
+        monkeypatch.setattr(pipeline, "AI_API_KEY", "mock")
+        monkeypatch.setattr(pipeline, "AI_TYPE", "qwen")
+        monkeypatch.setattr(pipeline.time, "sleep", lambda s: None)
+        monkeypatch.setattr(pipeline, "ai_circuits", pipeline.CircuitBreakers())
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_synthetic_output_passes_pipeline_validation():
+    """单篇与批量提示词的合成结果都能通过 build_final_data 校验，且相同输入结果相同"""
+    raw_data = pipeline.parse_html(sorted(HTML_DIR.glob("*.html"))[0])
+    prompt = pipeline.build_prompt(raw_data["title"], raw_data["originalContentText"])
+    processed = synthesize_response(prompt)
+    assert processed == synthesize_response(prompt)
+    final_data = pipeline.build_final_data(raw_data, dict(processed))
+    assert pipeline.is_content_already_processed(final_data["processedContent"])
+
+    batch = synthesize_response(pipeline.build_batch_prompt([("Google 电面", "问了 two sum"), ("Meta onsite", "系统设计")]))
+    by_index = pipeline.split_batch_response(batch, 2)
+    assert [by_index[i]["company"] for i in (1, 2)] == ["Google", "Meta"]
+
+
+def test_latency_distributions():
+    """fixed / uniform / lognormal 采样在预期范围内，无效配置报错"""
+    rng = random.Random(1)
+    assert parse_latency("fixed:0.5")(rng) == 0.5
+    assert all(0.2 <= parse_latency("uniform:0.2,0.4")(rng) <= 0.4 for _ in range(100))
+    samples = sorted(parse_latency("lognormal:1.0,0.5")(rng) for _ in range(1001))
+    assert 0.8 < samples[500] < 1.25 and samples[-1] > 2 * samples[500]  # 中位数接近1秒且有长尾
+    for spec in ("fixed", "uniform:1", "gamma:1,2", "fixed:x"):
+        with pytest.raises(ValueError):
+            parse_latency(spec)
+    with pytest.raises(ValueError):
+        MockProfile(rate_429=0.6, malformed_rate=0.6)
+
+
+def test_fault_injection(mock_api):
+    """429 按配置返回（携带 Retry-After），格式错误的输出在解析时失败，两者都计入 counts"""
+    server = mock_api(rate_429=1.0, retry_after=2)
+    response = pipeline.get_http_session().post(server.url, json={"input": {"messages": [{"content": "prompt"}]}})
+    assert response.status_code == 429 and response.headers["Retry-After"] == "2"
+
+    server = mock_api(malformed_rate=1.0)
+    with pytest.raises(ValueError):
+        pipeline.call_qwen_api("prompt", retries=0)
+    assert server.counts == {"requests": 1, "ok": 0, "429": 0, "timeout": 0, "malformed": 1}
+
+
+def test_streaming_output_is_parsed(mock_api, monkeypatch):
+    """SSE 增量输出拼接后得到完整结果"""
+    mock_api(latency="fixed:0.05")
+    monkeypatch.setattr(pipeline.qwen_streaming, "enabled", True)
+    prompt = pipeline.build_prompt("Amazon SDE 面经", "一轮 OA，两轮 VO。")
+    assert pipeline.call_qwen_api(prompt) == synthesize_response(prompt)
+
+
+def test_run_pipeline_offline_with_injected_429(mock_api, tmp_path):
+    """有429时完整 Pipeline 仍全部成功：重试后每个文件都生成 final"""
+    server = mock_api(rate_429=0.3, seed=2)  # 第3个请求返回429
+    out_dir = tmp_path / "out"
+    pipeline.run_pipeline(HTML_DIR, out_dir, use_ai_cache=False, near_dup_distance=None)
+
+    final_files = list((out_dir / "final").glob("*.json"))
+    assert len(final_files) == len(list(HTML_DIR.glob("*.html")))
+    assert server.counts["429"] > 0
+    for final_path in final_files:
+        assert json.loads(final_path.read_text(encoding="utf-8"))["tagDimensions"]["category"] == "SWE"
+
+
+def test_ai_calls_recorded_with_usage_and_attempts(mock_api, tmp_path):
+    """每次AI调用写入 ai_calls：对应文件、尝试次数（429重试）、token用量与HTTP状态"""
+    mock_api(rate_429=0.3, seed=2)  # 第3、4个请求返回429：其中一个文件尝试了3次
+    out_dir = tmp_path / "out"
+    pipeline.run_pipeline(HTML_DIR, out_dir, use_ai_cache=False, near_dup_distance=None)
+
+    conn = pipeline.init_state_db(out_dir / "state.sqlite")
+    rows = conn.execute("SELECT content_hash, provider, attempts, input_tokens, output_tokens, http_status, ok "
+                        "FROM ai_calls").fetchall()
+    hashes = {row[0] for row in conn.execute("SELECT content_hash FROM processing_state WHERE status = 'ok'")}
+    assert len(rows) == len(hashes) and {row[0] for row in rows} == hashes
+    assert sorted(row[2] for row in rows) == [1] * (len(rows) - 1) + [3]
+    assert all(row[1] == "qwen" and row[3] > 0 and row[4] > 0 and row[5] == 200 and row[6] == 1 for row in rows)
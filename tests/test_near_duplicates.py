@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似去重测试
+确保 SimHash 对页面框架/干扰文字不敏感，LSH 分段索引不漏掉阈值内的候选
+"""
+
+import random
+import sys
+from pathlib import Path
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+import pipeline
+from pipeline import NearDuplicateIndex, init_state_db, simhash64
+
+
+POST = "\n".join([
+    "一面：面试官问了项目经历，然后写了一道二叉树的层序遍历，要求讲清楚时间复杂度。",
+    "二面：系统设计，设计一个短链接服务，讨论了哈希冲突、缓存和数据库分片。",
+    "三面：行为面试，问了最有挑战的项目以及和同事意见不一致时怎么处理。",
+    "总结：准备充分的话难度中等，建议多练习系统设计和口头表达。",
+])
+
+
+def _distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def test_simhash_ignores_page_chrome_and_jammer_text():
+    """转载帖多出的模板、水印和空白只改变少量位，不同内容相差很远"""
+    repost = ("本帖最后由 匿名 于 2024-9-4 21:34 编辑\n" + POST.replace("，", " ，").replace("二面", ".1point3acres\n二面")
+              + "\n以下内容需要积分高于 188 您已经可以浏览\n求大米！")
+    other = "\n".join(["OA 两道题：滑动窗口求最长无重复子串，以及区间合并。",
+                       "VO 四轮：两轮coding，一轮BQ，一轮和hiring manager聊项目，整体偏简单。"] * 2)
+
+    assert _distance(simhash64(POST), simhash64(repost)) <= pipeline.NEAR_DUP_MAX_DISTANCE
+    assert _distance(simhash64(POST), simhash64(other)) > 10
+    assert simhash64("太短了") is None
+
+
+def test_index_finds_every_candidate_within_distance():
+    """任意翻转不超过阈值的位都能通过分段找到；超过阈值的不返回；remove 后不再命中"""
+    rng = random.Random(7)
+    index = NearDuplicateIndex(max_distance=4)
+    base = rng.getrandbits(64)
+    index.add("canonical", "100", base)
+    for _ in range(200):
+        flipped = base
+        for bit in rng.sample(range(64), rng.randint(0, 4)):
+            flipped ^= 1 << bit
+        assert index.find(flipped) == ("canonical", "100", _distance(base, flipped))
+    assert index.find(base ^ 0b111111) is None
+
+    index.remove("canonical")
+    assert index.find(base) is None and len(index) == 0
+
+
+def test_index_loads_only_successful_canonicals(tmp_path):
+    """从状态库加载时只包含 status=ok 的规范结果，64位指纹往返不变"""
+    conn = init_state_db(tmp_path / "state.sqlite")
+    high = (1 << 63) | 12345  # 最高位为1，存储时按有符号整数
+    pipeline.save_simhash(conn, [("a", "1", high), ("b", "2", 99)])
+    pipeline.update_state_many(conn, [pipeline.state_row("a", "ok", "1"), pipeline.state_row("b", "bad", "2")])
+
+    index = NearDuplicateIndex.load(conn, max_distance=3)
+    assert len(index) == 1
+    assert index.find(high ^ 1) == ("a", "1", 1)
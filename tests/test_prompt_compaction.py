@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+提示词压缩测试
+确保去模板、确定性截断、按模型的token上限与提示词指标记录的行为正确
+"""
+
+import sys
+from pathlib import Path
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+import pipeline
+from pipeline import (
+    StateWriter, TRUNCATION_MARKER, compact_content, estimate_tokens, init_state_db,
+    prompt_metrics_row, strip_boilerplate, truncate_to_budget,
+)
+
+
+POST = """本帖最后由 匿名 于 2024-9-4 21:34 编辑
+一轮电面，   问了   two sum。
+.1point3acres
+
+
+以下内容需要积分高于 188 您已经可以浏览
+二轮现场：系统设计。
+张三 发表于 2024-9-5 10:00
+请问二轮是几个人...
+求加米～
+总结：多刷题。
+查看更多Google工资与职级
+基本工资
+$154,095
+股票期权
+$128,974
+上一篇：
+下一篇的标题"""
+
+
+def test_strip_boilerplate_keeps_only_post_content():
+    """模板行、水印、引用、签名、薪资组件与页脚都被删除，空白被合并"""
+    assert strip_boilerplate(POST) == "一轮电面， 问了 two sum。\n\n二轮现场：系统设计。\n总结：多刷题。"
+
+
+def test_truncate_to_budget_is_deterministic_and_bounded():
+    """超出上限时保留开头与结尾，结果不超过上限且每次相同"""
+    text = "\n".join(f"第{i}轮：问了一道很长的算法题，要求写出最优解并分析复杂度。" for i in range(200))
+    truncated, was_truncated = truncate_to_budget(text, 300)
+    assert was_truncated
+    assert estimate_tokens(truncated) <= 300
+    assert truncated.startswith("第0轮") and truncated.endswith("第199轮：问了一道很长的算法题，要求写出最优解并分析复杂度。")
+    assert TRUNCATION_MARKER in truncated
+    assert truncate_to_budget(text, 300) == (truncated, True)
+
+    # 单行超长时按字符截断开头
+    one_line, _ = truncate_to_budget("面" * 1000, 100)
+    assert one_line.startswith("面") and estimate_tokens(one_line) <= 100
+
+    # 上限足够或为0时原样返回
+    assert truncate_to_budget(text, 0) == (text, False)
+    assert truncate_to_budget("短", 10) == ("短", False)
+
+
+def test_compact_content_uses_per_model_budget(monkeypatch):
+    """PROMPT_TOKEN_BUDGETS 按模型覆盖默认上限，指标反映压缩前后的大小"""
+    text = "\n".join(["题目：设计一个限流器。"] * 100)
+    monkeypatch.setattr(pipeline, "AI_TYPE", "qwen")
+    monkeypatch.setattr(pipeline, "PROMPT_TOKEN_BUDGET", 0)
+    monkeypatch.setattr(pipeline, "PROMPT_TOKEN_BUDGETS", {pipeline.QWEN_MODEL: 50})
+
+    compacted, metrics = compact_content(text)
+    assert metrics["truncated"] and metrics["compact_tokens"] <= 50 < metrics["content_tokens"]
+    assert compacted in pipeline.build_prompt("标题", text)
+
+    monkeypatch.setattr(pipeline, "AI_TYPE", "gemini")
+    assert compact_content(text) == (text, {"content_tokens": estimate_tokens(text),
+                                            "compact_tokens": estimate_tokens(text), "truncated": False})
+
+
+def test_state_writer_records_prompt_metrics(tmp_path):
+    """提示词指标与状态更新一起写入 prompt_metrics 表"""
+    db_path = tmp_path / "state.sqlite"
+    init_state_db(db_path).close()
+
+    metrics = {"content_tokens": 900, "compact_tokens": 600, "prompt_tokens": 1400, "truncated": True}
+    writer = StateWriter(db_path)
+    writer.update("h1", "ok", "1")
+    writer.record_prompt_metrics(prompt_metrics_row("h1", "1", metrics, 2.5, model="qwen-plus"))
+    writer.close()
+    assert writer.written == 1
+
+    conn = init_state_db(db_path)
+    assert conn.execute("SELECT file_id, model, content_tokens, compact_tokens, prompt_tokens, truncated, ai_seconds "
+                        "FROM prompt_metrics WHERE content_hash = 'h1'").fetchone() == ("1", "qwen-plus", 900, 600, 1400, 1, 2.5)
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态数据库测试
+确保批量写入、批量查询与幂等判定的行为正确
+"""
+
+import sys
+from pathlib import Path
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+import hashlib
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import pipeline
+from pipeline import StateWriter, init_state_db, lookup_states, plan_work, write_final
+
+
+def test_state_writer_batches_and_flushes(tmp_path):
+    """写线程批量提交，close() 后所有更新都已落盘"""
+    db_path = tmp_path / "state.sqlite"
+    init_state_db(db_path).close()
+
+    writer = StateWriter(db_path, batch_size=7, flush_interval=60)
+    for i in range(20):
+        writer.update(f"hash{i}", "ok", str(i))
+    writer.update("hash3", "bad", "3", "boom")  # 后写覆盖先写
+    writer.flush()
+
+    conn = init_state_db(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM processing_state").fetchone()[0] == 20
+
+    writer.update("late", "ok", "late")
+    writer.close()
+    assert writer.written == 22
+    assert conn.execute("SELECT status, error_reason FROM processing_state WHERE content_hash = 'hash3'").fetchone() == ("bad", "boom")
+    assert conn.execute("SELECT COUNT(*) FROM processing_state").fetchone()[0] == 21
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_state_writer_skips_bad_rows_and_keeps_running(tmp_path):
+    """某一行写入出错（非锁冲突）时只丢弃该行：同批的其他更新照常写入，写线程继续处理之后的更新"""
+    db_path = tmp_path / "state.sqlite"
+    init_state_db(db_path).close()
+
+    writer = StateWriter(db_path, batch_size=100, flush_interval=60)
+    writer.update("a", "ok", "1")
+    writer.record_near_duplicate("b", "a", {"distance": 1})  # 无法绑定的参数：sqlite3.ProgrammingError
+    writer.update("c", "ok", "3")
+    writer.flush()
+    writer.update("d", "ok", "4")
+    writer.close()
+
+    conn = init_state_db(db_path)
+    assert {row[0] for row in conn.execute("SELECT content_hash FROM processing_state")} == {"a", "c", "d"}
+    assert conn.execute("SELECT COUNT(*) FROM near_duplicates").fetchone()[0] == 0
+    assert writer.written == 3
+
+
+def test_state_writer_dead_thread_raises_from_flush_and_close(tmp_path, monkeypatch):
+    """写线程意外退出：flush() 不会永远阻塞，flush()/close() 抛出写线程的异常"""
+    db_path = tmp_path / "state.sqlite"
+    init_state_db(db_path).close()
+
+    def boom(conn, rows, commit=True):
+        raise RuntimeError("disk on fire")
+
+    monkeypatch.setitem(StateWriter._WRITERS, "state", boom)
+    writer = StateWriter(db_path, batch_size=1)
+    writer.update("a", "ok", "1")
+    with pytest.raises(RuntimeError, match="disk on fire"):
+        writer.flush()
+    with pytest.raises(RuntimeError, match="disk on fire"):
+        writer.close()
+
+
+def test_lookup_states_joins_only_requested_hashes(tmp_path):
+    """批量查询只返回请求中存在的记录"""
+    conn = init_state_db(tmp_path / "state.sqlite")
+    conn.executemany(
+        "INSERT INTO processing_state (content_hash, status, file_id) VALUES (?, ?, ?)",
+        [("a", "ok", "1"), ("b", "bad", "2"), ("c", "ok", "3")],
+    )
+    conn.commit()
+
+    states = lookup_states(conn, ["a", "b", "b", "missing"])
+    assert {h: row[:2] for h, row in states.items()} == {"a": ("ok", "1"), "b": ("bad", "2")}
+    # 临时表已清理，可重复调用
+    assert lookup_states(conn, ["c"])["c"][:2] == ("ok", "3")
+
+
+def test_init_state_db_adds_fingerprint_columns_to_old_schema(tmp_path):
+    """旧版状态库自动补齐指纹列，已有记录保留"""
+    db_path = tmp_path / "state.sqlite"
+    conn = sqlite3.connect(str(db_path))
+    conn.execute("CREATE TABLE processing_state (content_hash TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                 "file_id TEXT, error_reason TEXT, created_at TIMESTAMP, updated_at TIMESTAMP)")
+    conn.execute("INSERT INTO processing_state (content_hash, status, file_id) VALUES ('a', 'ok', '1')")
+    conn.commit()
+    conn.close()
+
+    conn = init_state_db(db_path)
+    assert lookup_states(conn, ["a"]) == {"a": ("ok", "1", None, None, None, None)}
+
+
+CLEAN_CONTENT = "## 面试经过\n\n" + "一轮电面，两轮现场。\n" * 20
+
+
+def _plan(tmp_path, html_files, conn):
+    # 线程池与进程池接口一致，测试中避免启动子进程
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        return plan_work(html_files, conn, tmp_path / "final", pool)
+
+
+def test_plan_work_skips_by_fingerprint_without_reading_final(tmp_path, monkeypatch):
+    """指纹一致时只做 stat，不重新加载final文件；指纹不一致时全量校验并更新指纹"""
+    html_dir = tmp_path / "html"
+    final_dir = tmp_path / "final"
+    html_dir.mkdir()
+    final_dir.mkdir()
+    html_path = html_dir / "100.html"
+    html_path.write_text("<html>100</html>", encoding="utf-8")
+    final_path = final_dir / "100.json"
+    fingerprint = write_final(final_path, {"processedContent": CLEAN_CONTENT})
+    assert fingerprint[3] is True
+
+    conn = init_state_db(tmp_path / "state.sqlite")
+    content_hash = pipeline.compute_content_hash(html_path)
+    pipeline.update_state(conn, content_hash, "ok", "100", fingerprint=fingerprint)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("final文件不应被重新校验")
+    monkeypatch.setattr(pipeline, "verify_final", fail)
+    work, skipped = _plan(tmp_path, [html_path], conn)
+    assert not work and len(skipped) == 1 and not skipped[0]["record_ok"]
+    monkeypatch.undo()
+
+    # mtime 变化但内容不变：校验和命中，沿用质量标记并刷新指纹
+    os.utime(final_path, ns=(1, 1))
+    work, skipped = _plan(tmp_path, [html_path], conn)
+    assert not work and skipped[0]["record_ok"]
+    assert skipped[0]["fingerprint"][:2] == (final_path.stat().st_size, 1)
+
+    # 内容被改成未清洗的文本：全量校验失败，重新处理
+    final_path.write_text(json.dumps({"processedContent": "<div>raw</div>"}), encoding="utf-8")
+    work, skipped = _plan(tmp_path, [html_path], conn)
+    assert len(work) == 1 and not skipped
+
+
+def test_plan_work_respects_stored_quality_flag(tmp_path):
+    """指纹一致但记录的质量检查未通过 → 直接重新处理"""
+    html_dir = tmp_path / "html"
+    final_dir = tmp_path / "final"
+    html_dir.mkdir()
+    final_dir.mkdir()
+    html_path = html_dir / "200.html"
+    html_path.write_text("<html>200</html>", encoding="utf-8")
+    fingerprint = write_final(final_dir / "200.json", {"processedContent": "too short"})
+    assert fingerprint[3] is False
+
+    conn = init_state_db(tmp_path / "state.sqlite")
+    pipeline.update_state(conn, pipeline.compute_content_hash(html_path), "ok", "200", fingerprint=fingerprint)
+    work, skipped = _plan(tmp_path, [html_path], conn)
+    assert len(work) == 1 and not skipped
+
+
+def _age(path, seconds=60):
+    """把修改时间调到过去，避开 manifest 的时间窗口"""
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - seconds * 10**9))
+
+
+def test_hash_inputs_uses_manifest_until_stat_changes(tmp_path, monkeypatch):
+    """stat 签名不变的文件不重新hash；内容变化或 paranoid 时重新计算"""
+    html_dir = tmp_path / "html"
+    html_dir.mkdir()
+    html_files = []
+    for name in ("1", "2", "3"):
+        html_path = html_dir / f"{name}.html"
+        html_path.write_text(f"<html>{name}</html>", encoding="utf-8")
+        _age(html_path)
+        html_files.append(html_path)
+    fresh = html_dir / "4.html"
+    fresh.write_text("<html>4</html>", encoding="utf-8")  # 刚修改的文件不写入 manifest
+    html_files.append(fresh)
+
+    conn = init_state_db(tmp_path / "state.sqlite")
+    expected = [pipeline.compute_content_hash(p) for p in html_files]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert pipeline.hash_inputs(html_files, conn, pool) == (expected, 4)
+        assert pipeline.hash_inputs(html_files, conn, pool) == (expected, 1)
+
+        html_files[1].write_text("<html>changed</html>", encoding="utf-8")
+        _age(html_files[1])
+        expected[1] = pipeline.compute_content_hash(html_files[1])
+        assert pipeline.hash_inputs(html_files, conn, pool) == (expected, 2)
+
+        assert pipeline.hash_inputs(html_files, conn, pool, paranoid=True) == (expected, 4)
+
+
+def test_prescan_only_hashes_and_prepare_file_reads_each_file_once(tmp_path, monkeypatch):
+    """预扫描只计算hash不写raw存储；prepare_file 未命中raw存储时只读取一次文件，命中时不读取"""
+    html_files = sorted((project_root / "hh_pipeline" / "test_input").glob("*.html"))
+    raw_dir = tmp_path / "raw"
+    conn = init_state_db(tmp_path / "state.sqlite")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        hashes, rehashed = pipeline.hash_inputs(html_files, conn, pool)
+    assert rehashed == len(html_files)
+    assert not raw_dir.exists()
+
+    opened = []
+    enter = pipeline.HtmlInput.__enter__
+    monkeypatch.setattr(pipeline.HtmlInput, "__enter__", lambda self: opened.append(self.path) or enter(self))
+    for html_path, content_hash in zip(html_files, hashes):
+        result = pipeline.prepare_file(html_path, content_hash, raw_dir)
+        assert result["status"] == "ready"
+        assert result["raw_data"] == pipeline.parse_html(html_path)
+    assert opened == html_files
+    for html_path, content_hash in zip(html_files, hashes):
+        assert pipeline.prepare_file(html_path, content_hash, raw_dir)["status"] == "ready"
+    assert opened == html_files
+
+
+def test_prepare_file_uses_hash_of_content_it_parsed(tmp_path):
+    """文件在预扫描之后被修改：状态按实际解析的内容的hash记录"""
+    html_path = tmp_path / "1.html"
+    html_path.write_text("<html><head><title>t</title></head><body><div class='post'>旧内容</div></body></html>",
+                         encoding="utf-8")
+    planned = pipeline.compute_content_hash(html_path)
+    html_path.write_text("<html><head><title>t</title></head><body><div class='post'>新内容</div></body></html>",
+                         encoding="utf-8")
+    result = pipeline.prepare_file(html_path, planned, tmp_path / "raw")
+    assert result["content_hash"] == pipeline.compute_content_hash(html_path) != planned
+    assert "新内容" in result["raw_data"]["originalContentText"]
+
+
+@pytest.mark.parametrize("mmap_threshold", [1, 1 << 30])
+def test_html_input_mmap_and_read_paths_match_read_text(tmp_path, monkeypatch, mmap_threshold):
+    """mmap 与直接读取两条路径：hash 与文件字节一致，text() 与 read_text(errors="ignore") 一致（CRLF、单独CR、非法UTF-8）"""
+    monkeypatch.setattr(pipeline, "MMAP_THRESHOLD", mmap_threshold)
+    data = "<p>第一行\r\n第二行\r第三行\n</p>\r\n".encode("utf-8") + b"\xff\xfe tail\r"
+    html_path = tmp_path / "1.html"
+    html_path.write_bytes(data)
+
+    with pipeline.HtmlInput(html_path) as source:
+        assert (source._mmap is not None) == (mmap_threshold == 1)
+        assert source.hash("sha256") == hashlib.sha256(data).hexdigest()
+        assert source.text() == html_path.read_text(encoding="utf-8", errors="ignore")
+    assert source._mmap is None and source._file is None
+
+
+def test_check_hash_algo_refuses_mismatched_db(tmp_path):
+    """没有记录算法的旧库视为 sha256：配置为 blake2b 时拒绝运行并提示 migrate-hash；新库记录当前算法"""
+    conn = init_state_db(tmp_path / "old.sqlite")
+    conn.execute("INSERT INTO processing_state (content_hash, status, file_id) VALUES ('a', 'ok', '1')")
+    conn.commit()
+    ok, message = pipeline.check_hash_algo(conn, "blake2b")
+    assert not ok
+    assert "sha256" in message and "migrate-hash" in message
+    assert pipeline.check_hash_algo(conn, "sha256") == (True, "sha256")
+
+    conn = init_state_db(tmp_path / "new.sqlite")
+    assert pipeline.check_hash_algo(conn, "blake2b") == (True, "blake2b")
+    assert not pipeline.check_hash_algo(conn, "sha256")[0]
+    with pytest.raises(ValueError):
+        pipeline.check_hash_algo(conn, "md5")
+
+
+def test_raw_store_round_trip_and_sharded_path(tmp_path):
+    """raw记录按hash前两位分目录保存，读取结果与写入的字段相同"""
+    fields = {"title": "Google SDE 面经", "publishTimeRaw": "2024-01-01", "originalContentHtml": "<p>一轮</p>",
+              "originalContentText": "一轮"}
+    content_hash = "ab" + "0" * 62
+    pipeline.save_raw_fields(tmp_path, content_hash, fields)
+
+    path = pipeline.raw_store_path(tmp_path, content_hash)
+    assert path == tmp_path / "ab" / f"{content_hash}.json.gz"
+    assert path.exists()
+    assert not list(path.parent.glob(".*.tmp"))  # 临时文件已原子替换
+    assert pipeline.load_raw_fields(tmp_path, content_hash) == fields
+    assert pipeline.load_raw_fields(tmp_path, "cd" + "0" * 62) is None
+
+
+def test_raw_store_version_mismatch_is_reparsed(tmp_path, monkeypatch):
+    """RAW_FORMAT_VERSION 变化后旧记录视为未命中：prepare_file 重新解析并按新版本写回"""
+    html_path = project_root / "hh_pipeline" / "test_input" / "test1.html"
+    content_hash = pipeline.compute_content_hash(html_path)
+    pipeline.save_raw_fields(tmp_path, content_hash, {"title": "过期的解析结果", "originalContentText": "旧"})
+
+    monkeypatch.setattr(pipeline, "RAW_FORMAT_VERSION", pipeline.RAW_FORMAT_VERSION + 1)
+    assert pipeline.load_raw_fields(tmp_path, content_hash) is None
+    result = pipeline.prepare_file(html_path, content_hash, tmp_path)
+    assert result["status"] == "ready"
+    assert result["raw_data"] == pipeline.parse_html(html_path)
+    assert pipeline.load_raw_fields(tmp_path, content_hash)["title"] == result["raw_data"]["title"]
+
+
+def test_corrupt_raw_record_falls_back_to_parsing(tmp_path):
+    """截断或损坏的 .gz 记录不报错，重新解析HTML并覆盖该记录"""
+    html_path = project_root / "hh_pipeline" / "test_input" / "test1.html"
+    content_hash = pipeline.compute_content_hash(html_path)
+    assert pipeline.prepare_file(html_path, content_hash, tmp_path)["status"] == "ready"
+    path = pipeline.raw_store_path(tmp_path, content_hash)
+
+    for damaged in (path.read_bytes()[:20], b"not gzip at all"):
+        path.write_bytes(damaged)
+        assert pipeline.load_raw_fields(tmp_path, content_hash) is None
+        result = pipeline.prepare_file(html_path, content_hash, tmp_path)
+        assert result["status"] == "ready"
+        assert result["raw_data"] == pipeline.parse_html(html_path)
+        assert pipeline.load_raw_fields(tmp_path, content_hash) is not None
+
+
+def test_ai_call_stats_percentiles_tokens_and_timeline(tmp_path):
+    """ai_calls 汇总：分位数只统计成功调用，批量请求按篇数计文件，吞吐按完成时间分桶"""
+    db_path = tmp_path / "state.sqlite"
+    init_state_db(db_path).close()
+    writer = StateWriter(db_path)
+    t0 = 1_700_000_000.0
+    for i in range(100):  # 单篇请求：延迟 0.01..1.00s，第 i 个在 t0+i 开始
+        writer.record_ai_call((t0 + i, f"h{i % 50}", 1, "qwen", "qwen-plus", 1 + (i % 10 == 0), (i + 1) / 100,
+                               900, 100, 200, 1, None))
+    writer.record_ai_call((t0 + 100, None, 4, "gemini", "gemini-1.5-flash", 1, 2.0, 3000, 1000, 200, 1, None))
+    writer.record_ai_call((t0 + 101, "h0", 1, "qwen", "qwen-plus", 4, 99.0, 0, 0, 429, 0, "Exception: Rate limited"))
+    writer.close()
+
+    conn = init_state_db(db_path)
+    stats = pipeline.ai_call_stats(conn, bucket_seconds=60)
+    assert (stats["calls"], stats["failed"], stats["retried"]) == (102, 1, 11)
+    assert (stats["p50"], stats["p99"]) == (0.51, 1.0)  # 失败调用的99秒不计入分位数
+    assert stats["files"] == 54  # 50 个不同的 content_hash + 批量请求的 4 篇
+    assert stats["tokens_per_file"] == (100 * 1000 + 4000) / 54
+    assert stats["statuses"] == {"200": 101, "429": 1}
+    assert stats["by_model"][("gemini", "gemini-1.5-flash")]["calls"] == 1
+    assert [b["calls"] for b in stats["timeline"]] == [60, 41, 1]  # 失败调用在 t0+200 完成
+    assert pipeline.ai_call_stats(init_state_db(tmp_path / "empty.sqlite")) is None
+
+
+def test_migrate_hash_rekeys_every_hash_keyed_table(tmp_path):
+    """切换hash算法后近似去重索引、复用关系、提示词指标与AI调用记录都换成新hash，不会丢失"""
+    html_dir = project_root / "hh_pipeline" / "test_input"
+    html_files = sorted(html_dir.glob("*.html"))
+    old_hashes, new_hashes = [], []
+    for html_path in html_files:
+        with pipeline.HtmlInput(html_path) as source:
+            old_hashes.append(source.hash("sha256"))
+            new_hashes.append(source.hash("blake2b"))
+    canonical, duplicate = old_hashes[:2]
+
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    conn = init_state_db(out_dir / "state.sqlite")
+    pipeline.set_meta(conn, "hash_algo", "sha256")
+    pipeline.update_state_many(conn, [pipeline.state_row(h, "ok", str(i)) for i, h in enumerate(old_hashes)])
+    pipeline.save_simhash(conn, [(canonical, "0", 12345)])
+    pipeline.save_near_duplicates(conn, [(duplicate, canonical, 2)])
+    metrics = {"content_tokens": 10, "compact_tokens": 8, "prompt_tokens": 20, "truncated": False}
+    pipeline.save_prompt_metrics(conn, [pipeline.prompt_metrics_row(canonical, "0", metrics, 1.0)])
+    pipeline.save_ai_calls(conn, [(1.0, canonical, 1, "qwen", "qwen-plus", 1, 0.5, 10, 20, 200, 1, None)])
+    conn.close()
+
+    pipeline.migrate_hash_algo(html_dir, out_dir, "blake2b")
+
+    conn = init_state_db(out_dir / "state.sqlite")
+    index = pipeline.NearDuplicateIndex.load(conn, max_distance=3)
+    assert index.find(12345) == (new_hashes[0], "0", 0)
+    assert conn.execute("SELECT content_hash, canonical_hash FROM near_duplicates").fetchall() == [(new_hashes[1], new_hashes[0])]
+    assert conn.execute("SELECT content_hash FROM prompt_metrics").fetchall() == [(new_hashes[0],)]
+    assert conn.execute("SELECT content_hash FROM ai_calls").fetchall() == [(new_hashes[0],)]
+    for table, column in pipeline.HASH_KEYED_COLUMNS:
+        stale = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {column} IN (?, ?)", (canonical, duplicate))
+        assert stale.fetchone()[0] == 0
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式输出测试
+确保增量JSON检查在格式明显错误时尽早中止，对正常输出（含代码块标记、任意分块）不误判
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+from pipeline import MalformedStreamError, QwenStreamReader, StreamingJSONGuard, parse_sse_data
+
+
+VALID = {
+    "title": "Meta 面经 \\\"转义\\\" {括号}",
+    "processedContent": "## 基本信息\n\n- 公司: Meta\n",
+    "company": "Meta",
+    "role": "SWE",
+    "difficulty": 4,
+    "tags": ["算法", "系统设计"],
+    "tagDimensions": {"technologies": [], "recruitType": "intern", "custom": [{"unknown": "nested ok"}]},
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 10000])
+def test_guard_accepts_valid_output_in_any_chunking(chunk_size):
+    """任意分块喂入合法输出（带或不带代码块标记）都能完整通过"""
+    for text in (json.dumps(VALID, ensure_ascii=False), "```json\n" + json.dumps(VALID, indent=2) + "\n```",
+                 json.dumps({"results": [dict(VALID, id="1")]})):
+        guard = StreamingJSONGuard()
+        for start in range(0, len(text), chunk_size):
+            guard.feed(text[start:start + chunk_size])
+        assert json.loads(guard.finish().strip("`json\n")) is not None
+
+
+@pytest.mark.parametrize("text, error_at", [
+    ("抱歉，我无法处理这篇内容。", 1),
+    ('{"summary": "不在schema中的字段"}', 10),
+    ('{"title": "ok", "difficulty": [1, 2]}', 31),
+    ('{"tags": ["a"]] }', 15),
+    ('{"title": "ok"} 以上是结果', 17),
+])
+def test_guard_aborts_at_first_bad_character(text, error_at):
+    """格式错误在出错的那个字符处立即抛出，不必等后续内容"""
+    guard = StreamingJSONGuard()
+    for i, ch in enumerate(text, 1):
+        if i < error_at:
+            guard.feed(ch)
+        else:
+            with pytest.raises(MalformedStreamError):
+                guard.feed(ch)
+            return
+    pytest.fail("没有中止")
+
+
+def test_guard_finish_rejects_truncated_output():
+    """流在对象闭合前结束视为格式错误"""
+    guard = StreamingJSONGuard()
+    guard.feed('{"title": "半截')
+    with pytest.raises(MalformedStreamError):
+        guard.finish()
+
+
+def test_stream_reader_joins_incremental_sse_chunks():
+    """SSE 增量输出拼接后解析，非 data 行被忽略，用量取自最后一块"""
+    reader = QwenStreamReader(started=0.0)
+    text = json.dumps(VALID, ensure_ascii=False)
+    for i in range(0, len(text), 50):
+        reader.feed_line("id:1")
+        reader.feed_line(":HTTP_STATUS/200")
+        chunk = {"output": {"choices": [{"message": {"content": text[i:i + 50]}}]}, "usage": {"total_tokens": i + 1}}
+        reader.feed_line("data:" + json.dumps(chunk, ensure_ascii=False))
+    assert reader.finish() == VALID
+    assert reader.usage == (len(text) - 1) // 50 * 50 + 1
+    assert parse_sse_data("event:result") is None
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+标签提取器测试
+确保预编译的关键词匹配器与逐个关键词搜索的结果一致：优先级、单词边界与重叠命中都不变
+"""
+
+import random
+import re
+import sys
+from pathlib import Path
+
+# 添加项目根目录到路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root / "hh_pipeline"))
+
+from tag_extractor import KeywordMatcher, TagExtractor
+
+
+def _search_each(keywords, text, word_boundary):
+    """参考实现：按优先级逐个关键词搜索"""
+    for keyword, value in keywords:
+        if word_boundary:
+            if re.search(r'\b' + re.escape(keyword.lower()) + r'\b', text, re.IGNORECASE):
+                return value
+        elif keyword.lower() in text.lower():
+            return value
+    return None
+
+
+def test_keyword_matcher_matches_per_keyword_search():
+    """随机关键词表（互为前缀、跨词重叠、含符号与中文）和随机文本上，结果与逐个搜索相同"""
+    rng = random.Random(3)
+    alphabet = ["a", "b", "go", " ", "+", "-", "买", "它"]
+    for _ in range(300):
+        keywords = [("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))).strip() or "a", n)
+                    for n in range(rng.randint(1, 12))]
+        rng.shuffle(keywords)
+        for word_boundary in (True, False):
+            matcher = KeywordMatcher(keywords, word_boundary=word_boundary)
+            for _ in range(20):
+                text = "".join(rng.choice(alphabet + ["A", "x"]) for _ in range(rng.randint(0, 16)))
+                assert matcher.search(text) == _search_each(keywords, text, word_boundary), (keywords, text)
+
+    # 低优先级的命中在前、且与高优先级的命中重叠时，仍返回高优先级的结果
+    assert KeywordMatcher([("ab cdef", "long"), ("go ab", "short")]).search("go ab cdef") == "long"
+    assert KeywordMatcher([]).search("anything") is None
+
+
+def test_tag_extractor_keeps_priority_semantics():
+    """公司别名优先匹配较长的别名；类别按配置顺序而不是在文本中出现的位置"""
+    extractor = TagExtractor()
+    tags = extractor.extract_all("买它 SDE 实习 面经", "先做了 machine learning 的题，然后聊了 backend 项目")
+    assert tags["company"] == "Meta"
+    assert tags["category"] == "SWE"  # SWE 的优先级高于 Data
+    assert tags["recruitType"] == "intern"
+    assert extractor.extract_all("随便聊聊")["category"] == "Other"
+
+
+def test_pipeline_shares_one_extractor_and_compiles_matchers_lazily(monkeypatch):
+    """build_final_data 在进程内共用同一个验证器与提取器；只做规范化时不编译匹配器"""
+    import pipeline
+    from mock_ai_server import synthesize_result
+
+    monkeypatch.setattr(pipeline, "_tag_tools", None)
+    created = []
+    monkeypatch.setattr(pipeline, "TagExtractor", lambda: created.append(TagExtractor()) or created[-1])
+    raw_data = {"title": "Google SDE 面经", "originalContentText": "一轮电面", "originalContentHtml": ""}
+    for _ in range(3):
+        pipeline.build_final_data(raw_data, synthesize_result(raw_data["title"], raw_data["originalContentText"]))
+    assert len(created) == 1
+    assert created[0]._matchers is None  # 热路径只调用 _normalize_value